@@ -1,8 +1,36 @@
-from flask import Flask, render_template, jsonify, request, send_file, session
-from os import makedirs
+from flask import Flask, render_template, jsonify, request, send_file, session, url_for, Response, g
+from datetime import datetime, timezone
+from functools import wraps
+import click
+import hashlib
+import io
+import json
+import os
+import secrets
+import shutil
+import time
+import traceback
+import zipfile
 import cv2
 import numpy as np
 import trimesh
+from image_store import WorkingImageStore, mapped_allocator, read_image, write_image
+from werkzeug.exceptions import HTTPException
+from workspaces import SESSION_KEY, WorkspaceManager
+import batch
+import edit_pipeline
+import encoding
+import history
+import ingest
+import jobs
+import metrics
+import noise
+import result_cache
+import scene_export
+import scene_index
+import scene_store
+import static_assets
+import tiles
 # Flask - библиотека для запуска нашего приложения Flask - app
 # render_template - нужен для то чтобы ваша страница html отобразилась корреткно
 # redirect - нам понадобится для обработки запросы формы где мы перенаприм пользователя на страницу админ панели
@@ -10,95 +38,958 @@ import trimesh
 # request - обработчик запросов GET/POST и дргуих 
 
 def get_actual_index(error = ""):
+  if request.path.startswith('/api/edit/'):
+    return edit_result(error)
   index = "index.html"
   context = {}
+  top_option = session.get("top_option", "")
   if top_option != "":
     context["option_top_div"] = top_option
-  if path_to_current_image != "":
+  if has_current_image():
     context["content"] = "contents/image_display.html"
-    context["image_path"] = path_to_current_image
+    context["image_path"] = url_for('preview', v=g.state.get("version", 0))
+    context["image_size"] = current_size()
   if error != "":
     context["error"] = error
-  return render_template(index, **context)
-
-app = Flask(__name__)
-
-import secrets
-app.secret_key = secrets.token_hex(32)
+  context["export_formats"] = encoding.EXPORT_FORMATS
+  with metrics.stage("render"):
+    return render_template(index, **context)
 
+# Встроенную раздачу static отключаем: файлы отдаёт маршрут static ниже, с отпечатками и сжатием
+app = Flask(__name__, static_folder=None)
 
-path_to_current_image = "" # для выбранной пользователем картикни
-top_option = "" # для выбранной опции меню
 UPLOAD_PATH = "static/uploads/"
+UPLOAD_MAX_BYTES = 1024 * 1024 * 1024 # больше байт в одном запросе не принимаем (кроме пакетной обработки)
+IMAGE_STORE_BUDGET = 512 * 1024 * 1024 # сколько байт декодированных изображений держим в памяти
+MAPPED_IMAGE_BYTES = 256 * 1024 * 1024 # изображения от этого размера не держим в памяти, а отображаем из файла
+MAPPED_STORE_BUDGET = 8 * 1024 * 1024 * 1024 # сколько байт таких изображений держим открытыми (это место на диске)
+WORKSPACE_TTL = 6 * 60 * 60 # через сколько секунд простоя удаляем рабочее пространство
+PREVIEW_MAX_EDGE = 1600 # длинная сторона превью в пикселях; полное разрешение считаем только при скачивании
+PREVIEW_QUALITY = 85 # качество JPEG/WebP для превью
+HISTORY_KEYFRAME_INTERVAL = 5 # через сколько операций запоминаем полный кадр для быстрой отмены
+HISTORY_MAX_STEPS = 50 # сколько шагов можно отменить; более старые правки вклеиваются в исходник
+HISTORY_MAX_MEMORY = 256 * 1024 * 1024 # лимит кадров истории в памяти на одно пространство
+HISTORY_MAX_DISK = 512 * 1024 * 1024 # лимит кадров истории на диске на одно пространство
+BATCH_PATH = os.path.join(UPLOAD_PATH, "batches")
+BATCH_TTL = 24 * 60 * 60 # сколько хранятся результаты пакетной обработки
+BATCH_WORKERS = os.cpu_count() or 1 # сколько изображений пакета обрабатываем одновременно
+BATCH_MAX_FILES = 1000 # сколько изображений можно прислать в одном пакете
+BATCH_MAX_BYTES = 2 * 1024 * 1024 * 1024 # сколько байт можно распаковать из архива пакета
+ENCODED_CACHE_BUDGET = 128 * 1024 * 1024 # сколько байт готовых файлов для скачивания держим в памяти
+RESULT_CACHE_PATH = os.path.join(UPLOAD_PATH, "results")
+RESULT_CACHE_BUDGET = 4 * 1024 * 1024 * 1024 # сколько байт результатов правок, общих для всех сессий, держим на диске
+RESULT_CACHE_MAX_ENTRY = 64 * 1024 * 1024 # результаты крупнее в общий кеш не пишем (примерно 20 Мп в BGR)
+TILE_SIZE = 1024 # сторона плитки для фильтров больших изображений
+TILE_WORKERS = os.cpu_count() or 1 # сколько плиток обрабатываем параллельно
+JOB_WORKERS = 2 # сколько тяжёлых вычислений в полном разрешении идёт одновременно (каждое само делится на плитки)
+JOB_PER_SESSION = 1 # сколько из них может занять одна сессия
+JOB_TTL = 10 * 60 # сколько секунд помним завершённую задачу
+JOB_EVENT_INTERVAL = 15 # через сколько секунд тишины поток событий задачи шлёт пустое сообщение, чтобы прокси не закрыл соединение
+PROFILER_ENABLED = os.environ.get("PROFILER") == "1" # выборочный профилировщик доступен только при явном включении
+PROFILER_INTERVAL = 0.01 # как часто профилировщик снимает стеки, в секундах
+
+
+def load_secret_key():
+  # Ключ сессии должен быть общим для всех процессов, иначе cookie одного
+  # воркера не примет другой. Берём из окружения или из файла, созданного один раз
+  if os.environ.get("SECRET_KEY"):
+    return os.environ["SECRET_KEY"]
+  os.makedirs(app.instance_path, exist_ok=True)
+  key_path = os.path.join(app.instance_path, "secret_key")
+  try:
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+      f.write(secrets.token_hex(32))
+  except FileExistsError:
+    pass
+  with open(key_path, "r") as f:
+    return f.read().strip()
+
+app.secret_key = load_secret_key()
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES
+
+tiles.configure(tile_size=TILE_SIZE, workers=TILE_WORKERS)
+
+# Декодированные исходники и результаты правок живут в памяти, на диск пишем только
+# при скачивании или checkpoint. Состояние (список операций) лежит в state.json пространства,
+# поэтому любой процесс может заново вычислить картинку из исходника
+image_store = WorkingImageStore(IMAGE_STORE_BUDGET, MAPPED_STORE_BUDGET, MAPPED_IMAGE_BYTES)
+
+
+# Готовые закодированные файлы для /download по ключу (изображение, формат, качество)
+encoded_store = WorkingImageStore(ENCODED_CACHE_BUDGET)
+
+# Результаты правок по содержимому входа и операциям - общие для всех сессий, процессов и пакетов
+shared_results = result_cache.shared(RESULT_CACHE_PATH, RESULT_CACHE_BUDGET, MAPPED_IMAGE_BYTES, RESULT_CACHE_MAX_ENTRY)
+
+
+def forget_workspace(workspace_id):
+  image_store.discard_if(lambda key: key[0] == workspace_id)
+  encoded_store.discard_if(lambda key: key[0] == workspace_id)
+  history.forget(workspace_id)
+
+
+workspaces = WorkspaceManager(UPLOAD_PATH, WORKSPACE_TTL, on_remove=forget_workspace)
+# Папки пакетной обработки устроены так же, как рабочие пространства: id, state.json, TTL
+batch_folders = WorkspaceManager(BATCH_PATH, BATCH_TTL)
+batch_runner = batch.BatchRunner(BATCH_WORKERS, shared_results)
+# Фоновые вычисления полного разрешения для скачивания, с очередью на каждую сессию
+job_queue = jobs.JobQueue(JOB_WORKERS, JOB_PER_SESSION, JOB_TTL)
+profiler = metrics.SamplingProfiler(PROFILER_INTERVAL)
+
+
+@app.before_request
+def start_request_metrics():
+  # Этапы запроса (read, compute, write, render) копятся в g.metrics_timings
+  g.metrics_started = time.perf_counter()
+  g.metrics_token, g.metrics_timings = metrics.begin(request.endpoint or "unknown")
+  profiler.enter(request.endpoint or "unknown")
+
+
+@app.after_request
+def record_request_metrics(response):
+  if "metrics_started" not in g:
+    return response
+  total = time.perf_counter() - g.metrics_started
+  metrics.request_duration.observe(total, request.endpoint or "unknown", request.method, str(response.status_code))
+  if request.content_length:
+    metrics.bytes_total.inc(request.content_length, "in")
+  if response.content_length:  # у потоковых ответов размер заранее неизвестен
+    metrics.bytes_total.inc(response.content_length, "out")
+  response.headers["Server-Timing"] = metrics.server_timing(g.metrics_timings, total)
+  return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+  profiler.leave()
+  if "metrics_token" in g:
+    metrics.end(g.pop("metrics_token"))
+
+
+def measured_job(route, func):
+  # Фоновые задачи замеряются и профилируются как отдельный маршрут
+  def run(job):
+    profiler.enter(route)
+    try:
+      with metrics.scope(route):
+        return func(job)
+    finally:
+      profiler.leave()
+  return run
+
+
+@metrics.registry.collector
+def collect_store_metrics():
+  rows = []
+  for name, store in (("images", image_store), ("encoded", encoded_store)):
+    stats = store.stats()
+    for key in ("hits", "misses", "evictions", "checkpoints"):
+      rows.append((f"photoeditor_store_{key}_total", "counter", f"Хранилище изображений: {key}", {"store": name}, stats[key]))
+    rows.append(("photoeditor_store_bytes", "gauge", "Байты в хранилище изображений",
+                 {"store": name, "kind": "memory"}, stats["used_bytes"]))
+    rows.append(("photoeditor_store_bytes", "gauge", "Байты в хранилище изображений",
+                 {"store": name, "kind": "mapped"}, stats["mapped_bytes"]))
+    rows.append(("photoeditor_store_entries", "gauge", "Записи в хранилище изображений", {"store": name}, stats["entries"]))
+  stats = shared_results.stats()
+  for key in ("hits", "misses", "evictions", "writes", "skipped"):
+    rows.append((f"photoeditor_store_{key}_total", "counter", f"Хранилище изображений: {key}", {"store": "results"}, stats[key]))
+  rows.append(("photoeditor_store_bytes", "gauge", "Байты в хранилище изображений",
+               {"store": "results", "kind": "disk"}, stats["used_bytes"]))
+  for status, count in job_queue.stats()["jobs"].items():
+    rows.append(("photoeditor_jobs", "gauge", "Фоновые задачи по состоянию", {"status": status}, count))
+  return rows
+
+
+def with_workspace(view):
+  # Находит пространство текущей сессии и держит его блокировку на время запроса
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    workspaces.collect_garbage()
+    g.workspace = workspaces.for_session(session)
+    with g.workspace.lock():
+      g.state = g.workspace.load_state()
+      return view(*args, **kwargs)
+  return wrapper
+
+
+def has_current_image():
+  return bool(g.get("state", {}).get("image"))
+
+
+def source_key():
+  return (g.workspace.id, g.state["source_id"], "source")
+
+
+def source_error():
+  # Фоновое декодирование загрузки не удалось (ingest_job): полного исходника нет, только превью
+  error = g.state.get("ingest_error")
+  return f"{error}. Загрузите изображение заново" if error else None
+
+
+def get_source_image():
+  with metrics.stage("read"):
+    return image_store.load(source_key(), g.workspace.file(g.state["image"]))
+
+
+def bump_version():
+  # Версия меняется при любой правке: по ней браузер перезапрашивает превью,
+  # а время изменения идёт в Last-Modified при скачивании
+  g.state["version"] = g.state.get("version", 0) + 1
+  g.state["modified"] = time.time()
+  # Результаты для прежних версий больше не нужны - их фоновые вычисления отменяем
+  job_queue.cancel_owner(g.workspace.id, g.state["version"])
+
+
+def active_ops():
+  # Операции до курсора истории; всё, что после него, - отменённые правки для повтора
+  ops = g.state.get("ops", [])
+  return ops[:g.state.get("position", len(ops))]
+
+
+def keyframe_cache():
+  return history.KeyframeCache(g.workspace, image_store, HISTORY_MAX_MEMORY, HISTORY_MAX_DISK)
+
+
+def render_ops(workspace, source_id, source, ops, source_hash=None, keyframes=True):
+  # Результаты полного разрешения от MAPPED_IMAGE_BYTES пишутся в файлы папки scratch пространства,
+  # поэтому память процесса не растёт вместе с размером изображения.
+  # source_hash - отпечаток пикселей исходника; с ним результат ищется и в общем кеше.
+  # keyframes=False - для фоновых задач: они считают без блокировки пространства, а кадры
+  # истории читаются, пишутся и чистятся только под ней (иначе задача могла бы вернуть
+  # кадр старого исходника после его замены)
+  with metrics.stage("compute"), tiles.use_allocator(mapped_allocator(workspace.file("scratch"), MAPPED_IMAGE_BYTES)):
+    image = edit_pipeline.render(
+      source,
+      ops,
+      cache=image_store,
+      cache_prefix=(workspace.id, source_id),
+      keyframes=history.KeyframeCache(workspace, image_store, HISTORY_MAX_MEMORY, HISTORY_MAX_DISK) if keyframes else None,
+      keyframe_interval=HISTORY_KEYFRAME_INTERVAL,
+      shared=shared_results,
+      shared_prefix=(source_hash,) if source_hash else None,
+    )
+  metrics.count_pixels("compute", image)
+  return image
+
+
+def get_current_image(ops=None):
+  # Вычисляем список операций только сейчас, когда картинка действительно нужна
+  return render_ops(g.workspace, g.state["source_id"], get_source_image(), active_ops() if ops is None else ops,
+                    g.state.get("source_hash"))
+
+
+def get_preview_image():
+  # Превью считаем по уменьшенной копии исходника с пересчитанными параметрами операций
+  width, height = g.state["size"]
+  scale = edit_pipeline.proxy_scale(width, height, PREVIEW_MAX_EDGE)
+  proxy_key = (g.workspace.id, g.state["source_id"], "proxy", PREVIEW_MAX_EDGE)
+  proxy = image_store.get(proxy_key)
+  if proxy is None and g.state.get("proxy") == proxy_filename(g.state["source_id"]):
+    # Уменьшенная копия сохранена при загрузке - полный исходник не нужен
+    with metrics.stage("read"):
+      proxy = image_store.load(proxy_key, g.workspace.file(g.state["proxy"]))
+  if proxy is None:
+    source = get_source_image()
+    with metrics.stage("compute"):
+      proxy = edit_pipeline.make_proxy(source, scale)
+    if scale < 1.0:
+      save_proxy(proxy)
+      g.workspace.save_state(g.state)
+    else:
+      image_store.put(proxy_key, proxy, dirty=False)
+  # Без уменьшения превью считается по самому исходнику
+  proxy_hash = g.state.get("proxy_hash") if scale < 1.0 else g.state.get("source_hash")
+  with metrics.stage("compute"):
+    image = edit_pipeline.render(
+      proxy,
+      edit_pipeline.scale_ops(active_ops(), scale),
+      cache=image_store,
+      cache_prefix=(g.workspace.id, g.state["source_id"], "preview", PREVIEW_MAX_EDGE),
+      keyframes=keyframe_cache(),
+      keyframe_interval=HISTORY_KEYFRAME_INTERVAL,
+      shared=shared_results,
+      shared_prefix=(proxy_hash,) if proxy_hash else None,
+    )
+  metrics.count_pixels("compute", image)
+  return image
+
+
+def current_size():
+  width, height = g.state["size"]
+  return edit_pipeline.output_size(active_ops(), width, height)
+
+
+def append_op(op):
+  # Новая правка после отмены отбрасывает ветку повтора
+  ops = active_ops()
+  ops.append(op)
+  g.state["ops"] = ops
+  g.state["position"] = len(ops)
+  bump_version()
+  g.workspace.save_state(g.state)
+  if len(ops) > HISTORY_MAX_STEPS:
+    # Старые шаги вклеиваются в исходник в фоне: правка только записывает операцию
+    job_queue.submit(g.workspace.id, ("bake", g.workspace.id, g.state["source_id"]),
+                     measured_job("job:bake", bake_job(g.workspace, g.state["source_id"])))
+
+
+def bake_history(count):
+  # Первые count операций вычисляются и становятся новым исходником, отменить их уже нельзя
+  ops = g.state["ops"]
+  image = get_current_image(ops[:count])
+  position = g.state.get("position", len(ops)) - count
+  set_source_image(None, image, ops=ops[count:], position=position)
+
+
+def bake_count(state):
+  # Вклеиваем сразу несколько старых шагов, чтобы не переписывать исходник на каждой правке.
+  # Отменённые шаги (после курсора) не вклеиваются
+  ops = state.get("ops", [])
+  if len(ops) <= HISTORY_MAX_STEPS:
+    return 0
+  return min(len(ops) - HISTORY_MAX_STEPS + HISTORY_KEYFRAME_INTERVAL, state.get("position", len(ops)))
+
+
+def bake_job(workspace, source_id):
+  # Вклеивание истории в фоне: вычисление без блокировки, замена исходника - под ней,
+  # если за это время исходник и вклеиваемые шаги не поменялись
+  def run(job):
+    with workspace.lock():
+      state = workspace.load_state()
+      if state.get("source_id") != source_id:
+        raise jobs.Cancelled()
+      count = bake_count(state)
+      ops = state["ops"][:count]
+      filename, source_hash = state["image"], state.get("source_hash")
+    if not count:
+      return {"baked": 0}
+    with metrics.stage("read"):
+      source = image_store.load((workspace.id, source_id, "source"), workspace.file(filename))
+    if source is None:
+      raise ValueError("Не удалось прочитать исходник")
+    image = render_ops(workspace, source_id, source, ops, source_hash, keyframes=False)
+    job.check()
+    with app.app_context(), workspace.lock():
+      g.workspace = workspace
+      g.state = workspace.load_state()
+      if (g.state.get("source_id") != source_id or g.state["ops"][:count] != ops
+          or g.state.get("position", len(g.state["ops"])) < count):
+        raise jobs.Cancelled()
+      position = g.state.get("position", len(g.state["ops"])) - count
+      set_source_image(None, image, ops=g.state["ops"][count:], position=position)
+    return {"baked": count}
+  return run
+
+
+def proxy_filename(source_id):
+  return f"proxy_{source_id}_{PREVIEW_MAX_EDGE}.npy"
+
+
+def save_proxy(proxy):
+  # Превью исходника тоже на диске: после вытеснения из памяти оно читается без полного исходника
+  g.state["proxy"] = proxy_filename(g.state["source_id"])
+  g.state["proxy_hash"] = result_cache.content_hash(proxy)
+  with metrics.stage("write"):
+    write_image(g.workspace.file(g.state["proxy"]), proxy)
+  image_store.put((g.workspace.id, g.state["source_id"], "proxy", PREVIEW_MAX_EDGE), proxy,
+                  path=g.workspace.file(g.state["proxy"]), dirty=False)
+
+
+def set_source_image(filename, image=None, ops=None, position=None, size=None, proxy=None):
+  # Новый исходник: старые результаты и кадры истории этого пространства больше не нужны.
+  # filename=None - исходник image сохраняется в .npy, дальше он читается без декодирования.
+  # size и proxy задают размер и превью исходника, который ещё не декодирован
+  image_store.discard_if(lambda key: key[0] == g.workspace.id)
+  keyframe_cache().clear()
+  old_files = [g.state.get("image"), g.state.get("proxy")]
+  g.state["source_id"] = secrets.token_hex(8)
+  g.state.pop("ingest_error", None)
+  if filename is None:
+    filename = f"source_{g.state['source_id']}.npy"
+    with metrics.stage("write"):
+      write_image(g.workspace.file(filename), image)
+    if image.nbytes >= MAPPED_IMAGE_BYTES:
+      # Большой исходник дальше читаем через отображение, декодированная копия не нужна
+      image = read_image(g.workspace.file(filename), MAPPED_IMAGE_BYTES)
+  g.state["image"] = filename
+  g.state["proxy"] = None
+  g.state["proxy_hash"] = None
+  # Отпечаток пикселей - адрес исходника в общем кеше; у ещё не декодированного его посчитает ingest_job
+  g.state["source_hash"] = result_cache.content_hash(image) if image is not None else None
+  g.state["ops"] = ops or []
+  g.state["position"] = len(g.state["ops"]) if position is None else position
+  bump_version()
+  for name in old_files:
+    if name and name != filename and os.path.exists(g.workspace.file(name)):
+      os.remove(g.workspace.file(name))
+  if image is not None:
+    # Уже декодированное изображение сразу кладём в память, без повторного чтения файла
+    image_store.put(source_key(), image, path=g.workspace.file(filename), dirty=False)
+  elif size is None:
+    image = get_source_image()
+    if image is None:
+      return False
+  if image is not None:
+    size = (image.shape[1], image.shape[0])
+  g.state["size"] = list(size)
+
+  scale = edit_pipeline.proxy_scale(size[0], size[1], PREVIEW_MAX_EDGE)
+  if proxy is None and image is not None and scale < 1.0:
+    proxy = edit_pipeline.make_proxy(image, scale)
+  if proxy is not None:
+    save_proxy(proxy)
+  g.workspace.save_state(g.state)
+  return True
+
+
+def ingest_job(workspace, source_id, filename):
+  # Полное декодирование загруженного файла в фоне: результат становится исходником в .npy.
+  # Ошибку запоминаем в state.json: превью и скачивание ответят, что файл надо загрузить заново
+  def record_error(state, error):
+    state["ingest_error"] = error
+    workspace.save_state(state)
+    image_store.discard((workspace.id, source_id, "source"))
+    raise ValueError(error)
+
+  def run(job):
+    source_key = (workspace.id, source_id, "source")
+    with metrics.stage("read"):
+      image = image_store.load(source_key, workspace.file(filename))
+    metrics.count_pixels("read", image)
+    job.check()
+    with workspace.lock():
+      state = workspace.load_state()
+      if state.get("source_id") != source_id or state.get("image") != filename:
+        raise jobs.Cancelled()
+      if image is None:
+        record_error(state, "Не удалось прочитать изображение")
+      if [image.shape[1], image.shape[0]] != state["size"]:
+        record_error(state, "Размер изображения не совпадает с заголовком файла")
+      converted = f"source_{source_id}.npy"
+      with metrics.stage("write"):
+        write_image(workspace.file(converted), image)
+      if image.nbytes >= MAPPED_IMAGE_BYTES:
+        image = read_image(workspace.file(converted), MAPPED_IMAGE_BYTES)
+      state["image"] = converted
+      state["source_hash"] = result_cache.content_hash(image)
+      workspace.save_state(state)
+      image_store.put(source_key, image, path=workspace.file(converted), dirty=False)
+      os.remove(workspace.file(filename))
+    return {"width": image.shape[1], "height": image.shape[0]}
+  return run
+
+
+def move_history(step):
+  # step = -1 - отмена, +1 - повтор. Возвращает False, если двигаться некуда
+  ops = g.state.get("ops", [])
+  position = g.state.get("position", len(ops)) + step
+  if position < 0 or position > len(ops):
+    return False
+  g.state["position"] = position
+  bump_version()
+  g.workspace.save_state(g.state)
+  return True
+
+
+def history_info():
+  ops = g.state.get("ops", [])
+  position = g.state.get("position", len(ops))
+  return {
+    "position": position,
+    "steps": [op["op"] for op in ops],
+    "can_undo": position > 0,
+    "can_redo": position < len(ops),
+    "version": g.state.get("version", 0),
+  }
 
 @app.route('/')
+@with_workspace
 def index():
     return get_actual_index()
 
 @app.route('/choose_option')
+@with_workspace
 def choose_option():
-    global top_option
     # Получаем GET-параметр 'file'
     top_option = request.args.get('file')  # вернет None, если параметр отсутствует
+    session["top_option"] = top_option
 
     if top_option == "":
         return get_actual_index(error="Файл не указан!")
 
     return get_actual_index()
 
+@app.errorhandler(413)
+def request_too_large(e):
+  limit = request.max_content_length // (1024 * 1024)
+  message = f"Файл слишком большой, максимум {limit} МБ!"
+  if request.path.startswith('/api/'):
+    return jsonify({'success': False, 'error': message}), 413
+  return with_workspace(get_actual_index)(error=message), 413
+
+ALLOWED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp"}
+
 @app.route('/load', methods=['POST'])
+@with_workspace
 def load():
-  global path_to_current_image
   if request.method == 'POST':
-    makedirs(UPLOAD_PATH, exist_ok=True)
     # Получаем файл из формы
     file = request.files.get('file')
     if file:
-      path_to_current_image = f"{UPLOAD_PATH}{file.filename}"
-      file.save(path_to_current_image)
+      # Имя файла от клиента не используем, только расширение - оно задаёт формат при сохранении
+      ext = os.path.splitext(file.filename or "")[1].lower()
+      if ext not in ALLOWED_EXTENSIONS:
+        return get_actual_index(error="Неподдерживаемый формат изображения!")
+      # Файл пишется на диск потоком; формат и размер проверяем по заголовку, до декодирования
+      upload_name = f"upload_{secrets.token_hex(8)}"
+      upload_path = g.workspace.file(upload_name + ".tmp")
+      try:
+        with metrics.stage("read"):
+          file.save(upload_path)
+          info = ingest.inspect(upload_path)
+        ingest.check_limits(info)
+      except ValueError as e:
+        os.remove(upload_path)
+        return get_actual_index(error=str(e))
+      filename = upload_name + ingest.FORMAT_EXTENSIONS[info.format]
+      os.replace(upload_path, g.workspace.file(filename))
+
+      size = ingest.oriented_size(info)
+      scale = edit_pipeline.proxy_scale(size[0], size[1], PREVIEW_MAX_EDGE)
+      with metrics.stage("read"):
+        proxy = ingest.read_reduced(g.workspace.file(filename), info, edit_pipeline.proxy_size(size[0], size[1], scale))
+      if proxy is not None:
+        # Превью уже есть из уменьшенного декодирования, полное декодирование - в фоне
+        set_source_image(filename, size=size, proxy=proxy)
+        job_queue.submit(g.workspace.id, ("ingest", g.workspace.id, g.state["source_id"]),
+                         measured_job("job:ingest", ingest_job(g.workspace, g.state["source_id"], filename)))
+        return get_actual_index()
+
+      # Декодируем один раз (в 8 бит BGR, с поворотом по EXIF), дальше правки работают с массивом
+      with metrics.stage("read"):
+        image = cv2.imread(g.workspace.file(filename), cv2.IMREAD_COLOR)
+      metrics.count_pixels("read", image)
+      os.remove(g.workspace.file(filename))
+      if image is None:
+        return get_actual_index(error="Не удалось прочитать изображение!")
+      set_source_image(None, image)
       return get_actual_index()
     return get_actual_index(error="Не удалось загрузить файл!")
 
+
+@app.route('/preview')
+@with_workspace
+def preview():
+  # Превью уменьшенного размера в JPEG или WebP (с прозрачностью), если браузер его понимает
+  if has_current_image() and source_error():
+    return source_error(), 409
+  image = get_preview_image() if has_current_image() else None
+  if image is None:
+    return "Нет рабочего изображения", 404
+  if "image/webp" in request.accept_mimetypes:
+    ext, mimetype, params = ".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, PREVIEW_QUALITY]
+  else:
+    ext, mimetype, params = ".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY]
+    image = encoding.flatten(image)
+  with metrics.stage("write"):
+    ok, buffer = cv2.imencode(ext, image, params)
+  metrics.count_pixels("write", image)
+  if not ok:
+    return "Не удалось закодировать изображение", 500
+  response = Response(buffer.tobytes(), mimetype=mimetype)
+  response.vary.add("Accept")
+  return response
+
+
+@app.route('/checkpoint', methods=['POST'])
+@with_workspace
+def checkpoint():
+  # Явное сохранение: результат правок записывается на диск и становится новым исходником.
+  # Отменить вклеенные правки уже нельзя, отменённые остаются доступны для повтора
+  if not has_current_image():
+    return get_actual_index(error="Нет рабочего изображения, загрузите изображение")
+  if source_error():
+    return get_actual_index(error=source_error()), 409
+  bake_history(len(active_ops()))
+  return get_actual_index()
+
+
+@app.route('/undo', methods=['POST'])
+@with_workspace
+def undo():
+  if not has_current_image() or not move_history(-1):
+    return get_actual_index(error="Нечего отменять!")
+  return get_actual_index()
+
+
+@app.route('/redo', methods=['POST'])
+@with_workspace
+def redo():
+  if not has_current_image() or not move_history(1):
+    return get_actual_index(error="Нечего повторять!")
+  return get_actual_index()
+
+
+@app.route('/api/history', methods=['GET'])
+@with_workspace
+def api_history():
+  if not has_current_image():
+    return jsonify({'success': False, 'error': 'Нет рабочего изображения'}), 404
+  return jsonify({'success': True, **history_info()})
+
+
+@app.route('/api/history/<action>', methods=['POST'])
+@with_workspace
+def api_history_move(action):
+  if action not in ('undo', 'redo'):
+    return jsonify({'success': False, 'error': 'Неизвестное действие'}), 404
+  if not has_current_image():
+    return jsonify({'success': False, 'error': 'Нет рабочего изображения'}), 404
+  if not move_history(-1 if action == 'undo' else 1):
+    return jsonify({'success': False, 'error': 'Нечего отменять' if action == 'undo' else 'Нечего повторять'}), 409
+  return jsonify({'success': True, **history_info()})
+
+
+def save_batch_inputs(batch_folder):
+  # Сохраняет присланные файлы и содержимое zip-архива в папку пакета.
+  # Возвращает [(исходное имя, путь)] или бросает ValueError
+  inputs_path = batch_folder.file("in")
+  os.makedirs(inputs_path, exist_ok=True)
+  inputs = []
+
+  def target(name):
+    ext = os.path.splitext(name)[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+      return None
+    if len(inputs) >= BATCH_MAX_FILES:
+      raise ValueError(f"Слишком много изображений, максимум {BATCH_MAX_FILES}")
+    # Имя на диске своё, исходное нужно только для имени результата
+    path = os.path.join(inputs_path, f"{len(inputs):05d}{ext}")
+    inputs.append((os.path.basename(name), path))
+    return path
+
+  for file in request.files.getlist('files'):
+    path = target(file.filename or "")
+    if path:
+      file.save(path)
+
+  archive_file = request.files.get('archive')
+  if archive_file:
+    try:
+      with zipfile.ZipFile(archive_file) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+        if sum(info.file_size for info in members) > BATCH_MAX_BYTES:
+          raise ValueError("Архив слишком большой")
+        for info in members:
+          path = target(info.filename)
+          if path:
+            with archive.open(info) as src, open(path, "wb") as dst:
+              shutil.copyfileobj(src, dst)
+    except zipfile.BadZipFile:
+      raise ValueError("Файл не является zip-архивом")
+  return inputs
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_create():
+  # Пакет может быть больше обычной загрузки, у него свой лимит
+  request.max_content_length = BATCH_MAX_BYTES
+  try:
+    batch_folders.collect_garbage()
+    recipe_text = request.form.get('recipe')
+    if recipe_text is None and 'recipe' in request.files:
+      recipe_text = request.files['recipe'].read().decode('utf-8')
+    if not recipe_text:
+      return jsonify({'success': False, 'error': 'Не указан рецепт'}), 400
+    steps, export = batch.parse_recipe(json.loads(recipe_text))
+
+    batch_folder = batch_folders.create()
+    inputs = save_batch_inputs(batch_folder)
+    if not inputs:
+      shutil.rmtree(batch_folder.path, ignore_errors=True)
+      return jsonify({'success': False, 'error': 'Нет изображений для обработки'}), 400
+
+    batch_runner.submit(batch_folder, inputs, steps, export)
+    return jsonify({
+      'success': True,
+      'batch_id': batch_folder.id,
+      'total': len(inputs),
+      'status_url': url_for('batch_status', batch_id=batch_folder.id),
+      'result_url': url_for('batch_result', batch_id=batch_folder.id),
+    }), 202
+
+  except ValueError as e:
+    # json.JSONDecodeError тоже ValueError
+    return jsonify({'success': False, 'error': str(e)}), 400
+  except HTTPException:
+    raise
+  except Exception as e:
+    print(f"Batch error: {str(e)}")
+    traceback.print_exc()
+    return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+  batch_folder = batch_folders.get(batch_id)
+  if batch_folder is None:
+    return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+  return jsonify({'success': True, **batch.status(batch_folder)})
+
+
+@app.route('/api/batch/<batch_id>/result', methods=['GET'])
+def batch_result(batch_id):
+  # Архив отдаётся потоком: готовые файлы уходят клиенту, пока остальные ещё считаются
+  batch_folder = batch_folders.get(batch_id)
+  if batch_folder is None:
+    return jsonify({'success': False, 'error': 'Пакет не найден'}), 404
+  batch_folder.touch()
+  return Response(
+    batch.stream_zip(batch_folder),
+    mimetype='application/zip',
+    headers={'Content-Disposition': f'attachment; filename=batch_{batch_id}.zip'},
+  )
+
+
+@app.route('/store_stats')
+def store_stats():
+  return jsonify(image_store.stats())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+  # Текстовый формат Prometheus
+  return Response(metrics.registry.expose(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+def profiler_control():
+  # POST action=start|stop|reset; стеки по маршрутам - в /api/profiler/folded
+  if not PROFILER_ENABLED:
+    return jsonify({'success': False, 'error': 'Профилировщик выключен, запустите приложение с PROFILER=1'}), 404
+  if request.method == 'POST':
+    action = request.values.get('action')
+    if action == 'start':
+      profiler.start()
+    elif action == 'stop':
+      profiler.stop()
+    elif action == 'reset':
+      profiler.reset()
+    else:
+      return jsonify({'success': False, 'error': 'Неизвестное действие'}), 400
+  return jsonify({
+    'success': True,
+    'running': profiler.running,
+    'interval': profiler.interval,
+    'samples': profiler.samples,
+    'routes': profiler.routes(),
+    'folded_url': url_for('profiler_folded'),
+  })
+
+
+@app.route('/api/profiler/folded', methods=['GET'])
+def profiler_folded():
+  # Формат folded stacks для flamegraph.pl и speedscope; ?route= - только один маршрут
+  if not PROFILER_ENABLED:
+    return jsonify({'success': False, 'error': 'Профилировщик выключен, запустите приложение с PROFILER=1'}), 404
+  return Response(profiler.folded(request.args.get('route')), content_type="text/plain; charset=utf-8")
+
+
+def download_key(format, quality, compression):
+  # Содержимое файла однозначно задают исходник, активные операции и параметры кодирования
+  ops_digest = edit_pipeline.ops_digest(active_ops())
+  cache_key = (g.workspace.id, g.state["source_id"], ops_digest, format, quality, compression)
+  etag = hashlib.sha1(repr(cache_key[1:]).encode("utf-8")).hexdigest()
+  return cache_key, etag
+
+
+def download_job(cache_key, format, quality, compression, download_url):
+  # Задача выполняется в потоке очереди, без контекста запроса: всё нужное берём сейчас
+  workspace, state, ops = g.workspace, dict(g.state), active_ops()
+
+  def run(job):
+    source_key = (workspace.id, state["source_id"], "source")
+    source = image_store.get(source_key)
+    source_hash = state.get("source_hash")
+    if source is None:
+      # Файл исходника читаем под блокировкой: вклеивание истории может его переписать
+      with workspace.lock():
+        current = workspace.load_state()
+        if current.get("source_id") != state["source_id"]:
+          raise jobs.Cancelled()
+        if current.get("ingest_error"):
+          raise ValueError(current["ingest_error"])
+        # имя файла и отпечаток берём свежие: загруженный JPEG мог уже стать .npy
+        source = image_store.load(source_key, workspace.file(current["image"]))
+        source_hash = current.get("source_hash")
+    buffer = encoded_store.get(cache_key)
+    if buffer is None:
+      image = render_ops(workspace, state["source_id"], source, ops, source_hash, keyframes=False)
+      job.check()
+      with metrics.stage("write"):
+        buffer = encoding.encode_buffer(image, format, quality, compression)
+      metrics.count_pixels("write", image)
+      encoded_store.put(cache_key, buffer, dirty=False)
+    return {"bytes": int(buffer.nbytes), "download_url": download_url}
+  return run
+
+
+def session_job(job_id):
+  # Задачи видны только той сессии, которая их создала
+  job = job_queue.get(job_id)
+  if job is None or job.owner != session.get(SESSION_KEY):
+    return None
+  return job
+
+
+def job_info(job):
+  info = job.to_dict()
+  info["status_url"] = url_for('job_status', job_id=job.id)
+  info["events_url"] = url_for('job_events', job_id=job.id)
+  return info
+
+
+@app.route('/api/jobs/render', methods=['POST'])
+@with_workspace
+def job_render():
+  # Полное разрешение считается в фоне; когда задача готова, /download отдаёт файл из кеша
+  if not has_current_image():
+    return jsonify({'success': False, 'error': 'Нет рабочего изображения'}), 404
+  if source_error():
+    return jsonify({'success': False, 'error': source_error()}), 409
+  try:
+    format, quality, compression = encoding.normalize_options(
+      request.values.get('format'), request.values.get('quality'), request.values.get('compression'))
+  except ValueError as e:
+    return jsonify({'success': False, 'error': str(e)}), 400
+  cache_key, etag = download_key(format, quality, compression)
+  download_url = url_for('download_file', format=format, quality=quality, compression=compression)
+  job = job_queue.submit(g.workspace.id, cache_key,
+                         measured_job("job:render", download_job(cache_key, format, quality, compression, download_url)),
+                         version=g.state["version"])
+  return jsonify(job_info(job)), 200 if job.status == "done" else 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+  job = session_job(job_id)
+  if job is None:
+    return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+  return jsonify(job_info(job))
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+  # Server-Sent Events: сообщение при каждой смене состояния, последнее - когда задача завершилась
+  job = session_job(job_id)
+  if job is None:
+    return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+  info = job_info(job)
+
+  def stream():
+    last_status, last_sent = None, 0
+    while True:
+      done = job.wait(0 if last_status is None else 1)
+      data = job.to_dict()
+      if data["status"] != last_status or done:
+        yield f"event: status\ndata: {json.dumps(dict(info, **data), ensure_ascii=False)}\n\n"
+        last_status, last_sent = data["status"], time.time()
+      elif time.time() - last_sent >= JOB_EVENT_INTERVAL:
+        yield ": keep-alive\n\n"
+        last_sent = time.time()
+      if done:
+        return
+
+  return Response(stream(), mimetype='text/event-stream',
+                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+  job = session_job(job_id)
+  if job is None:
+    return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+  job_queue.cancel(job)
+  return jsonify(job_info(job))
+
+
 @app.route('/download', methods=['GET'])
+@with_workspace
 def download_file():
-  global path_to_current_image
-  if (path_to_current_image != ""):
-
-    image = cv2.imread(path_to_current_image)
-    format = request.args.get('format') 
-    quality = request.args.get('quality')
-    quality = int(quality) 
-    
-    params = []
-    if format == 'jpeg':
-      params = [cv2.IMWRITE_JPEG_QUALITY, quality]
-    file_ext = f".{format}"
-    
-    uload_path = UPLOAD_PATH + "/yourPic" + file_ext
-    buffer = cv2.imwrite(uload_path, image, params)
+  if has_current_image() and source_error():
+    return get_actual_index(error=source_error()), 409
+  if has_current_image():
 
-    return send_file(
-        uload_path,
-        as_attachment=True
+    try:
+      format, quality, compression = encoding.normalize_options(
+        request.args.get('format'), request.args.get('quality'), request.args.get('compression'))
+    except ValueError as e:
+      return get_actual_index(error=str(e))
+
+    cache_key, etag = download_key(format, quality, compression)
+    last_modified = datetime.fromtimestamp(int(g.state.get("modified", 0)), timezone.utc)
+
+    # Повторный запрос того же результата: 304 без вычисления и кодирования.
+    # Сверяем только ETag (отпечаток операций): Last-Modified точен до секунды, и правка
+    # в ту же секунду, что и прошлое скачивание, по If-Modified-Since дала бы старый файл
+    if request.if_none_match.contains(etag):
+      response = Response(status=304)
+      response.set_etag(etag)
+      response.last_modified = last_modified
+      return response
+
+    buffer = encoded_store.get(cache_key)
+    if buffer is None:
+      image = get_current_image()
+      with metrics.stage("write"):
+        buffer = encoding.encode_buffer(image, format, quality, compression)
+      metrics.count_pixels("write", image)
+      encoded_store.put(cache_key, buffer, dirty=False)
+
+    ext, mimetype = encoding.EXPORT_FORMATS[format]
+    response = send_file(
+        io.BytesIO(buffer),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name="yourPic" + ext,
+        etag=etag,
+        max_age=0,
+        conditional=True,
     )
+    response.last_modified = last_modified  # только для сведения, после проверки условий
+    response.cache_control.private = True
+    return response
   return get_actual_index(error="Нет рабочего изображения, загрузите изображение")
 
 @app.route('/brightcontr', methods=['POST'])
+@with_workspace
 def brightcontr():
-    global path_to_current_image
-    img = cv2.imread(path_to_current_image)
+    if not has_current_image():
+        return get_actual_index(error="Нет изображения для обработки!")
     alpha = float(request.form.get('contrast'))
     beta = float(request.form.get('brightness'))  # контраст
-    img_contrast = cv2.convertScaleAbs(img, alpha=alpha, beta=beta)
 
-    path_to_current_image = UPLOAD_PATH + "/yourPic.png"
-    cv2.imwrite(path_to_current_image, img_contrast)
+    append_op({"op": "brightcontr", "contrast": alpha, "brightness": beta})
+    return get_actual_index()
+
+@app.route('/gamma', methods=['POST'])
+@with_workspace
+def gamma():
+    if not has_current_image():
+        return get_actual_index(error="Нет изображения для обработки!")
+    try:
+        op = edit_pipeline.gamma_op(request.form.get('gamma', 1.0), request.form.get('channel'))
+    except ValueError as e:
+        return get_actual_index(error=str(e))
+
+    append_op(op)
     return get_actual_index()
 
 @app.route('/mirror', methods=['POST'])
+@with_workspace
 def mirror():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
@@ -109,17 +1000,7 @@ def mirror():
         if axis not in ['x', 'y', 'both']:
             return get_actual_index(error="Неверно указана ось отражения!")
 
-        image = cv2.imread(path_to_current_image)
-
-        if axis == 'x':
-            mirrored_image = cv2.flip(image, 1)
-        elif axis == 'y':
-            mirrored_image = cv2.flip(image, 0)
-        else:  # both
-            mirrored_image = cv2.flip(image, -1)
-
-        # Сохраняем результат
-        cv2.imwrite(path_to_current_image, mirrored_image)
+        append_op({"op": "mirror", "axis": axis})
 
         return get_actual_index()
 
@@ -127,9 +1008,9 @@ def mirror():
 
 
 @app.route('/rotate', methods=['POST'])
+@with_workspace
 def rotate():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
@@ -144,72 +1025,15 @@ def rotate():
 
         try:
             angle = float(angle)
-            # Загружаем изображение
-            image = cv2.imread(path_to_current_image)
-            height, width = image.shape[:2]
-
-            # Определяем центр вращения
-            if center_x and center_y:
-                try:
-                    center_x = float(center_x)
-                    center_y = float(center_y)
-                    # Если указаны относительные координаты (0-1), преобразуем в абсолютные
-                    if center_x <= 1.0 and center_y <= 1.0:
-                        center_x = int(center_x * width)
-                        center_y = int(center_y * height)
-                    else:
-                        center_x = int(center_x)
-                        center_y = int(center_y)
-                except ValueError:
-                    return get_actual_index(error="Неверный формат координат центра!")
-            else:
-                # Центр по умолчанию - центр изображения
-                center_x = width // 2
-                center_y = height // 2
-
-            # Получаем матрицу поворота
-            rotation_matrix = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
-
-            if keep_size:
-                # Сохраняем исходные размеры изображения
-                rotated_image = cv2.warpAffine(
-                    image,
-                    rotation_matrix,
-                    (width, height),  # Исходные размеры
-                    flags=cv2.INTER_LINEAR,
-                    borderMode=cv2.BORDER_CONSTANT,
-                    borderValue=(255, 255, 255)  # Белый цвет для фона
-                )
-            else:
-                # Вычисляем новые размеры только если угол не кратен 90 градусам
-                if angle % 90 == 0:
-                    # Для углов, кратных 90 градусам, используем исходные или транспонированные размеры
-                    if angle % 180 == 0:
-                        new_width, new_height = width, height
-                    else:
-                        new_width, new_height = height, width
-                else:
-                    # Только для нестандартных углов вычисляем новые размеры
-                    cos_val = abs(rotation_matrix[0, 0])
-                    sin_val = abs(rotation_matrix[0, 1])
-                    new_width = int((height * sin_val) + (width * cos_val))
-                    new_height = int((height * cos_val) + (width * sin_val))
-
-                    # Корректируем матрицу преобразования для учета новых размеров
-                    rotation_matrix[0, 2] += (new_width / 2) - center_x
-                    rotation_matrix[1, 2] += (new_height / 2) - center_y
-
-                rotated_image = cv2.warpAffine(
-                    image,
-                    rotation_matrix,
-                    (new_width, new_height),
-                    flags=cv2.INTER_LINEAR,
-                    borderMode=cv2.BORDER_CONSTANT,
-                    borderValue=(255, 255, 255)
-                )
+            width, height = current_size()
 
-            # Сохраняем результат
-            cv2.imwrite(path_to_current_image, rotated_image)
+            # Определяем центр вращения, None - центр изображения
+            try:
+                center = edit_pipeline.rotation_center(center_x, center_y, width, height)
+            except ValueError:
+                return get_actual_index(error="Неверный формат координат центра!")
+
+            append_op({"op": "rotate", "angle": angle, "center": center, "keep_size": keep_size})
 
             return get_actual_index()
 
@@ -222,9 +1046,9 @@ def rotate():
 
 
 @app.route('/color_balance', methods=['POST'])
+@with_workspace
 def color_balance():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
@@ -233,16 +1057,7 @@ def color_balance():
             green = float(request.form.get('green', 0))
             blue = float(request.form.get('blue', 0))
 
-            image = cv2.imread(path_to_current_image)
-
-            b, g, r = cv2.split(image)
-
-            r = cv2.add(r, int(red * 255))
-            g = cv2.add(g, int(green * 255))
-            b = cv2.add(b, int(blue * 255))
-
-            balanced_image = cv2.merge([b, g, r])
-            cv2.imwrite(path_to_current_image, balanced_image)
+            append_op({"op": "color_balance", "red": red, "green": green, "blue": blue})
 
             return get_actual_index()
 
@@ -253,9 +1068,9 @@ def color_balance():
 
 
 @app.route('/add_noise', methods=['POST'])
+@with_workspace
 def add_noise():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
@@ -263,24 +1078,19 @@ def add_noise():
             noise_type = request.form.get('noise_type')
             amount = float(request.form.get('amount', 0.1))
 
-            image = cv2.imread(path_to_current_image)
-
-            if noise_type == 'gaussian':
-                mean = 0
-                sigma = amount * 255
-                gaussian = np.random.normal(mean, sigma, image.shape).astype(np.uint8)
-                noisy_image = cv2.add(image, gaussian)
-            elif noise_type == 'salt_pepper':
-                prob = amount
-                noisy_image = np.copy(image)
-                salt = np.random.random(image.shape[:2]) < prob / 2
-                pepper = np.random.random(image.shape[:2]) < prob / 2
-                noisy_image[salt] = 255
-                noisy_image[pepper] = 0
-            else:
-                return get_actual_index(error="Неверный тип шума!")
+            seed = request.form.get('seed', '').strip()
+            seed = int(seed) if seed else secrets.randbits(32)
 
-            cv2.imwrite(path_to_current_image, noisy_image)
+            if noise_type not in noise.NOISE_TYPES:
+                return get_actual_index(error="Неверный тип шума!")
+            if not 0 <= amount <= 1:
+                return get_actual_index(error="Интенсивность должна быть от 0 до 1!")
+            # Операция вычисляется позже: неверное зерно ломало бы каждое превью
+            if not 0 <= seed < noise.SEED_LIMIT:
+                return get_actual_index(error=f"Зерно должно быть от 0 до {noise.SEED_LIMIT - 1}!")
+
+            # Зерно запоминаем, чтобы при повторном вычислении шум не менялся
+            append_op({"op": "add_noise", "noise_type": noise_type, "amount": amount, "seed": seed})
             return get_actual_index()
 
         except Exception as e:
@@ -290,28 +1100,16 @@ def add_noise():
 
 
 @app.route('/blur', methods=['POST'])
+@with_workspace
 def blur():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
         try:
-            blur_type = request.form.get('blur_type')
-            kernel_size = int(request.form.get('kernel_size', 5))
-
-            image = cv2.imread(path_to_current_image)
-
-            if blur_type == 'average':
-                blurred = cv2.blur(image, (kernel_size, kernel_size))
-            elif blur_type == 'gaussian':
-                blurred = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
-            elif blur_type == 'median':
-                blurred = cv2.medianBlur(image, kernel_size)
-            else:
-                return get_actual_index(error="Неверный тип размытия!")
-
-            cv2.imwrite(path_to_current_image, blurred)
+            # Операция вычисляется позже, поэтому неверные параметры ловим заранее
+            op = edit_pipeline.blur_op(request.form.get('blur_type'), request.form.get('kernel_size', 5))
+            append_op(op)
             return get_actual_index()
 
         except Exception as e:
@@ -321,9 +1119,9 @@ def blur():
 
 
 @app.route('/resize', methods=['POST'])
+@with_workspace
 def resize():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
@@ -332,35 +1130,13 @@ def resize():
             value = float(request.form.get('value', 1.0))
             method = request.form.get('method', 'auto')
 
-            image = cv2.imread(path_to_current_image)
-            height, width = image.shape[:2]
+            width, height = current_size()
+            new_width, new_height, method = edit_pipeline.resize_target(resize_type, value, method, width, height)
 
-            if resize_type == 'scale':
-                new_width = int(width * value)
-                new_height = int(height * value)
-            else:
-                if resize_type == 'width':
-                    new_width = int(value)
-                    new_height = int(height * (value / width))
-                else:
-                    new_height = int(value)
-                    new_width = int(width * (value / height))
+            if new_width <= 0 or new_height <= 0:
+                return get_actual_index(error="Новый размер изображения слишком мал!")
 
-            if method == 'auto':
-                if value > 1:
-                    method = 'cubic'
-                else:
-                    method = 'linear'
-
-            if method == 'nearest':
-                interpolation = cv2.INTER_NEAREST
-            elif method == 'linear':
-                interpolation = cv2.INTER_LINEAR
-            else:
-                interpolation = cv2.INTER_CUBIC
-
-            resized_image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
-            cv2.imwrite(path_to_current_image, resized_image)
+            append_op({"op": "resize", "width": new_width, "height": new_height, "method": method})
 
             return get_actual_index()
 
@@ -371,16 +1147,15 @@ def resize():
 
 
 @app.route('/crop', methods=['POST'])
+@with_workspace
 def crop():
-    global path_to_current_image
-    if path_to_current_image == "":
+    if not has_current_image():
         return get_actual_index(error="Нет изображения для обработки!")
 
     if request.method == 'POST':
         try:
             crop_type = request.form.get('crop_type')
-            image = cv2.imread(path_to_current_image)
-            height, width = image.shape[:2]
+            width, height = current_size()
 
             if crop_type == 'rectangular':
                 x = int(request.form.get('x', 0))
@@ -393,7 +1168,7 @@ def crop():
                 if x + w > width or y + h > height:
                     return get_actual_index(error="Область вырезки выходит за пределы изображения!")
 
-                cropped = image[y:y + h, x:x + w]
+                op = {"op": "crop", "x": x, "y": y, "width": w, "height": h}
 
             elif crop_type == 'freeform':
                 points_str = request.form.get('points', '')
@@ -406,22 +1181,20 @@ def crop():
                         x, y = map(int, point.split(','))
                         points.append([x, y])
 
-                if len(points) < 3:
-                    return get_actual_index(error="Нужно указать как минимум 3 точки!")
-
-                mask = np.zeros((height, width), dtype=np.uint8)
-                points_array = np.array(points, dtype=np.int32)
-                cv2.fillPoly(mask, [points_array], 255)
-
-                cropped = cv2.bitwise_and(image, image, mask=mask)
-
-                x, y, w, h = cv2.boundingRect(points_array)
-                cropped = cropped[y:y + h, x:x + w]
+                op = edit_pipeline.freeform_crop_op(
+                    points,
+                    feather=request.form.get('feather', 0),
+                    alpha=request.form.get('alpha') == 'on',
+                )
+                # Многоугольник целиком за краем: вырезать нечего, а вычисление бы упало
+                _, _, w, h = edit_pipeline.freeform_bounds(op["points"], width, height)
+                if w <= 0 or h <= 0:
+                    return get_actual_index(error="Область вырезки выходит за пределы изображения!")
 
             else:
                 return get_actual_index(error="Неверный тип вырезки!")
 
-            cv2.imwrite(path_to_current_image, cropped)
+            append_op(op)
             return get_actual_index()
 
         except Exception as e:
@@ -430,26 +1203,105 @@ def crop():
     return get_actual_index(error="Ошибка при обработке изображения!")
 
 
+def edit_result(error=""):
+  # Ответ JSON-версии правки: вместо всей страницы - адрес нового превью и размер
+  if error:
+    return jsonify({'success': False, 'error': error}), 400
+  if not has_current_image():
+    return jsonify({'success': False, 'error': 'Нет рабочего изображения'}), 404
+  width, height = current_size()
+  return jsonify({
+    'success': True,
+    'image_url': url_for('preview', v=g.state.get("version", 0)),
+    'width': width,
+    'height': height,
+    **history_info(),
+  })
+
+
+# JSON-версии правок: /api/edit/blur и т. д. - те же обработчики, ответ собирает edit_result
+EDIT_ENDPOINTS = ('load', 'checkpoint', 'undo', 'redo', 'brightcontr', 'gamma', 'mirror', 'rotate',
+                  'color_balance', 'add_noise', 'blur', 'resize', 'crop')
+for endpoint in EDIT_ENDPOINTS:
+  app.add_url_rule(f'/api/edit/{endpoint}', f'api_edit_{endpoint}', app.view_functions[endpoint], methods=['POST'])
+
+
 # 3d начинается здесь
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
-import json
-import os
-from datetime import datetime
-import trimesh
-import tempfile
-import traceback
 
 # Папка для сохранения сцен
 SCENES_FOLDER = 'saved_scenes'
 os.makedirs(SCENES_FOLDER, exist_ok=True)
+# Формат новых сохранений: json - как раньше, compact - столбцы float32 с дельтами (см. scene_store.py).
+# Загружаются оба формата независимо от настройки
+SCENE_STORAGE = os.environ.get('SCENE_STORAGE', 'json')
+scenes_store = scene_store.SceneStore(SCENES_FOLDER)
+
+
+def read_scene_file(path):
+    if path.endswith(scene_store.SCENE_EXTENSION):
+        return scenes_store.load(os.path.basename(path))
+    return scene_index.read_json_scene(path)
+
+
+def new_scene_filename(extension):
+    # Имя занимается сразу (O_EXCL), чтобы два сохранения в одну секунду не затёрли друг друга
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    attempt = 1
+    while True:
+        suffix = '' if attempt == 1 else f'_{attempt}'
+        filename = f"scene_{timestamp}{suffix}{extension}"
+        try:
+            os.close(os.open(os.path.join(SCENES_FOLDER, filename), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            attempt += 1
+
+
+# Индекс сцен для списка; файлы, положенные в папку вручную, подхватывает `flask reindex-scenes`
+scenes_index = scene_index.SceneIndex(SCENES_FOLDER, extensions=('.json', scene_store.SCENE_EXTENSION),
+                                      reader=read_scene_file)
+SCENES_PAGE_SIZE = 100
+SCENES_MAX_PAGE_SIZE = 1000
+# Ограничение на размер сцены для экспорта в файл сетки
+SCENE_EXPORT_MAX_OBJECTS = 20000
 
 @app.route('/main3d')
 def main3d():
     return render_template('main3d.html')
 
-@app.route('/static/<path:path>')
-def serve_static(path):
-    return send_from_directory('static', path)
+# Стили и скрипты собираются при запуске: отпечаток содержимого в имени и готовые gzip/brotli.
+# Загрузки пользователей лежат в static/uploads, но наружу не отдаются
+# Режим отладки включается и после импорта (app.run(debug=True)), поэтому читаем его при каждом запросе
+asset_manifest = static_assets.AssetManifest(os.path.join(app.root_path, 'static'), exclude=('uploads',),
+                                             auto_reload=lambda: app.debug)
+
+
+@app.url_defaults
+def fingerprint_static(endpoint, values):
+    # url_for('static', filename='styles.css') -> /static/styles.<отпечаток>.css
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = asset_manifest.url_path(values['filename'])
+
+
+@app.route('/static/<path:filename>', endpoint='static')
+def serve_static(filename):
+    asset, fingerprinted = asset_manifest.find(filename)
+    if asset is None:
+        return "Файл не найден", 404
+    content_encoding, body = asset.select(lambda name: request.accept_encodings[name])
+    response = Response(body, mimetype=asset.mimetype)
+    if content_encoding != 'identity':
+        response.content_encoding = content_encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{asset.etag}-{content_encoding}")
+    if fingerprinted:
+        # Под этим именем содержимое не меняется никогда
+        response.cache_control.public = True
+        response.cache_control.max_age = static_assets.IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/save_scene', methods=['POST'])
 def save_scene():
@@ -458,21 +1310,35 @@ def save_scene():
         if not data:
             return jsonify({'success': False, 'error': 'Нет данных'}), 400
         
-        # Генерируем уникальное имя файла
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"scene_{timestamp}.json"
+        compact = SCENE_STORAGE == 'compact'
+        if compact:
+            # Прошлая версия сцены с тем же именем - из неё берутся неизменённые объекты
+            base = scenes_index.latest(str(data.get('name') or ''), scene_store.SCENE_EXTENSION)
+        filename = new_scene_filename(scene_store.SCENE_EXTENSION if compact else '.json')
         filepath = os.path.join(SCENES_FOLDER, filename)
-        
-        # Сохраняем данные сцены
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        try:
+            with metrics.stage("write"):
+                if compact:
+                    written = scenes_store.save(filename, data, base=base)
+                else:
+                    # Сохраняем данные сцены
+                    with open(filepath, 'w', encoding='utf-8') as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    written = len(data.get('objects', []))
+        except Exception:
+            os.remove(filepath)
+            raise
+        scenes_index.add(filename, data)
         
         return jsonify({
             'success': True, 
             'filename': filename,
+            'objects_written': written,
             'message': 'Сцена успешно сохранена'
         })
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Save scene error: {str(e)}")
         traceback.print_exc()
@@ -489,16 +1355,21 @@ def load_scene():
         if not filename:
             return jsonify({'success': False, 'error': 'Не указано имя файла'}), 400
         
+        if not isinstance(filename, str) or os.path.basename(filename) != filename:
+            return jsonify({'success': False, 'error': 'Неверное имя файла'}), 400
         filepath = os.path.join(SCENES_FOLDER, filename)
         
-        if not os.path.exists(filepath):
+        # В папке сцен лежат ещё индекс и пакеты объектов - отдаём только сами сцены
+        if not filename.endswith(scenes_index.extensions) or not os.path.isfile(filepath):
             return jsonify({'success': False, 'error': 'Файл не найден'}), 404
         
-        with open(filepath, 'r', encoding='utf-8') as f:
-            scene_data = json.load(f)
+        with metrics.stage("read"):
+            scene_data = read_scene_file(filepath)
         
         return jsonify({'success': True, 'scene': scene_data})
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Load scene error: {str(e)}")
         traceback.print_exc()
@@ -507,37 +1378,71 @@ def load_scene():
 @app.route('/api/list_scenes', methods=['GET'])
 def list_scenes():
     try:
-        scenes = []
-        for filename in os.listdir(SCENES_FOLDER):
-            if filename.endswith('.json'):
-                filepath = os.path.join(SCENES_FOLDER, filename)
-                created_time = os.path.getctime(filepath)
-                
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        scene_data = json.load(f)
-                    
-                    scenes.append({
-                        'filename': filename,
-                        'name': scene_data.get('name', filename.replace('.json', '')),
-                        'created': datetime.fromtimestamp(created_time).strftime('%Y-%m-%d %H:%M:%S'),
-                        'objects_count': len(scene_data.get('objects', [])),
-                        'scene_size': scene_data.get('sceneSize', {'width': 10, 'height': 10, 'depth': 10})
-                    })
-                except Exception as e:
-                    print(f"Error reading scene file {filename}: {e}")
-                    continue
-        
-        # Сортируем по дате создания (новые сверху)
-        scenes.sort(key=lambda x: x['created'], reverse=True)
-        
-        return jsonify({'success': True, 'scenes': scenes})
+        try:
+            offset = max(int(request.args.get('offset', 0)), 0)
+            limit = min(max(int(request.args.get('limit', SCENES_PAGE_SIZE)), 1), SCENES_MAX_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Неверные параметры страницы'}), 400
+        sort = request.args.get('sort', 'created')
+        if sort not in scene_index.SORT_COLUMNS:
+            return jsonify({'success': False, 'error': f'Нельзя сортировать по {sort}'}), 400
+        # По умолчанию новые сверху, как и раньше
+        descending = request.args.get('order', 'desc') != 'asc'
+
+        with metrics.stage("read"):
+            items, total = scenes_index.list(offset=offset, limit=limit, sort=sort, descending=descending,
+                                             name=request.args.get('name', '').strip())
+        scenes = [{
+            'filename': item['filename'],
+            'name': item['name'],
+            'created': datetime.fromtimestamp(item['created']).strftime('%Y-%m-%d %H:%M:%S'),
+            'objects_count': item['objects_count'],
+            'scene_size': item['scene_size']
+        } for item in items]
+
+        return jsonify({'success': True, 'scenes': scenes, 'total': total, 'offset': offset, 'limit': limit})
     
     except Exception as e:
         print(f"List scenes error: {str(e)}")
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.cli.command('reindex-scenes')
+@click.option('--rebuild', is_flag=True, help='Построить индекс заново, а не только сверить с папкой')
+def reindex_scenes(rebuild):
+    """Сверяет индекс сцен с файлами в папке сцен."""
+    result = scenes_index.rebuild() if rebuild else scenes_index.reconcile()
+    click.echo(f"Добавлено: {result['added']}, обновлено: {result['updated']}, удалено: {result['removed']}")
+    for item in result['failed']:
+        click.echo(f"Не удалось прочитать {item['filename']}: {item['error']}")
+
+@app.route('/api/export_scene', methods=['POST'])
+def export_scene():
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'success': False, 'error': 'Нет данных'}), 400
+
+        format = request.args.get('format', 'glb').lower()
+        if format not in scene_export.EXPORT_FORMATS:
+            return jsonify({'success': False, 'error': f'Неподдерживаемый формат: {format}'}), 400
+        if len(data.get('objects') or []) > SCENE_EXPORT_MAX_OBJECTS:
+            return jsonify({'success': False, 'error': 'Слишком много объектов в сцене'}), 400
+
+        with metrics.stage("compute"):
+            payload, mimetype = scene_export.export_scene(data, format)
+        return send_file(io.BytesIO(payload), mimetype=mimetype, as_attachment=True,
+                         download_name=f"scene.{format}")
+
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Export scene error: {str(e)}")
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/test', methods=['GET'])
 def test_api():
     """Тестовый endpoint для проверки работы API"""
@@ -568,6 +1473,7 @@ if __name__ == '__main__':
         }
         with open(test_scene_path, 'w', encoding='utf-8') as f:
             json.dump(test_scene, f, ensure_ascii=False, indent=2)
+        scenes_index.add('test_scene.json', test_scene)
         print(f"Создана тестовая сцена: {test_scene_path}")
     
     print(f"Сервер запущен: http://localhost:5000")
@@ -0,0 +1,295 @@
+# Пакетная обработка: один рецепт на много изображений.
+# Рецепт - JSON со списком шагов из тех же операций, что и в редакторе, с теми же
+# именами параметров, что в формах, например:
+#   {"steps": [{"op": "resize", "resize_type": "width", "value": 800},
+#              {"op": "color_balance", "red": 0.1},
+#              {"op": "export", "format": "jpeg", "quality": 85}]}
+# Каждое изображение обрабатывается в пуле процессов с ограниченным числом
+# воркеров. Состояние пакета (очередь, готовность, время по этапам) хранится
+# в state.json папки пакета, поэтому его видит любой процесс приложения.
+# Результат правок ищется в общем кеше на диске (result_cache) - тот же снимок
+# с тем же рецептом, обработанный раньше пакетом или в редакторе, не
+# пересчитывается.
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+import zipfile
+
+import cv2
+
+import edit_pipeline
+from encoding import EXPORT_FORMATS, encode_image, normalize_options
+import ingest
+import noise
+import result_cache
+import tiles
+
+
+STEP_OPS = {"brightcontr", "mirror", "rotate", "color_balance", "gamma", "levels", "curves", "add_noise", "blur",
+            "resize", "crop", "export"}
+# Воркер держит изображение целиком в памяти, поэтому пределы строже, чем у /load
+MAX_PIXELS = 100_000_000
+MAX_SIDE = 30000
+
+
+def _number(step, name, default=None, cast=float):
+    value = step.get(name, default)
+    if value is None:
+        raise ValueError(f"Не указан параметр {name}")
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Неверное значение параметра {name}: {value}")
+
+
+def compile_step(step, width, height):
+    """Переводит шаг рецепта в операцию конвейера для изображения width x height."""
+    name = step.get("op")
+    if name == "brightcontr":
+        return {"op": "brightcontr", "contrast": _number(step, "contrast", 1.0),
+                "brightness": _number(step, "brightness", 0)}
+    if name == "mirror":
+        if step.get("axis") not in ("x", "y", "both"):
+            raise ValueError("Неверно указана ось отражения")
+        return {"op": "mirror", "axis": step["axis"]}
+    if name == "rotate":
+        center = edit_pipeline.rotation_center(step.get("center_x"), step.get("center_y"), width, height)
+        return {"op": "rotate", "angle": _number(step, "angle"), "center": center,
+                "keep_size": bool(step.get("keep_size", False))}  # как в маршруте /rotate без флажка
+    if name == "color_balance":
+        return {"op": "color_balance", "red": _number(step, "red", 0),
+                "green": _number(step, "green", 0), "blue": _number(step, "blue", 0)}
+    if name == "gamma":
+        return edit_pipeline.gamma_op(_number(step, "gamma"), step.get("channel"))
+    if name == "levels":
+        return edit_pipeline.levels_op(
+            _number(step, "in_black", 0, int), _number(step, "in_white", 255, int), _number(step, "gamma", 1.0),
+            _number(step, "out_black", 0, int), _number(step, "out_white", 255, int), step.get("channel"))
+    if name == "curves":
+        return edit_pipeline.curves_op(step.get("points") or [], step.get("channel"))
+    if name == "add_noise":
+        if step.get("noise_type") not in noise.NOISE_TYPES:
+            raise ValueError("Неверный тип шума")
+        amount = _number(step, "amount", 0.1)
+        if not 0 <= amount <= 1:
+            raise ValueError("Интенсивность шума должна быть от 0 до 1")
+        # Без явного зерна шум у каждого изображения свой
+        seed = step.get("seed")
+        seed = secrets.randbits(32) if seed is None else _number(step, "seed", cast=int)
+        if not 0 <= seed < noise.SEED_LIMIT:
+            raise ValueError(f"Зерно шума должно быть от 0 до {noise.SEED_LIMIT - 1}")
+        return {"op": "add_noise", "noise_type": step["noise_type"], "amount": amount, "seed": seed}
+    if name == "blur":
+        return edit_pipeline.blur_op(step.get("blur_type"), _number(step, "kernel_size", 5, int))
+    if name == "resize":
+        new_width, new_height, method = edit_pipeline.resize_target(
+            step.get("resize_type", "scale"), _number(step, "value", 1.0), step.get("method", "auto"), width, height)
+        if new_width <= 0 or new_height <= 0:
+            raise ValueError("Новый размер изображения слишком мал")
+        return {"op": "resize", "width": new_width, "height": new_height, "method": method}
+    if name == "crop":
+        x, y = _number(step, "x", 0, int), _number(step, "y", 0, int)
+        w, h = _number(step, "width", 100, int), _number(step, "height", 100, int)
+        if x < 0 or y < 0 or w <= 0 or h <= 0:
+            raise ValueError("Координаты и размеры должны быть положительными")
+        if x + w > width or y + h > height:
+            raise ValueError("Область вырезки выходит за пределы изображения")
+        return {"op": "crop", "x": x, "y": y, "width": w, "height": h}
+    raise ValueError(f"Неизвестная операция: {name}")
+
+
+def parse_recipe(recipe):
+    """Проверяет рецепт и возвращает (шаги обработки, параметры экспорта)."""
+    steps = recipe.get("steps") if isinstance(recipe, dict) else recipe
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Рецепт должен содержать непустой список шагов")
+    export = {"format": "png"}
+    operations = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get("op") not in STEP_OPS:
+            raise ValueError(f"Шаг {index + 1}: неизвестная операция")
+        if step["op"] == "export":
+            if index != len(steps) - 1:
+                raise ValueError("Экспорт должен быть последним шагом")
+            format, quality, compression = normalize_options(
+                step.get("format"), step.get("quality"), step.get("compression"))
+            export = {"format": format, "quality": quality, "compression": compression}
+            continue
+        # Пробная компиляция ловит ошибки параметров до запуска пакета
+        try:
+            compile_step(step, 10000, 10000)
+        except ValueError as e:
+            if step["op"] != "crop":  # вырезку можно проверить только на настоящем размере
+                raise ValueError(f"Шаг {index + 1}: {e}")
+        operations.append(step)
+    return operations, export
+
+
+def process_image(input_path, output_path, steps, export, shared=None):
+    """Выполняется в процессе пула: читает, обрабатывает и кодирует одно изображение.
+
+    shared - общий кеш результатов (result_cache.ResultCache), тот же, что у редактора.
+    """
+    timings = {}
+    started = time.perf_counter()
+    # Размер проверяем по заголовку, чтобы не декодировать огромный файл
+    ingest.check_limits(ingest.inspect(input_path), MAX_PIXELS, MAX_SIDE)
+    image = cv2.imread(input_path)
+    if image is None:
+        raise ValueError("Не удалось прочитать изображение")
+    timings["decode"] = time.perf_counter() - started
+
+    mark = time.perf_counter()
+    height, width = image.shape[:2]
+    ops = []
+    for step in steps:
+        op = compile_step(step, width, height)
+        width, height = edit_pipeline.op_output_size(op, width, height)
+        ops.append(op)
+    shared_prefix = (result_cache.content_hash(image),) if shared is not None else None
+    image = edit_pipeline.render(image, ops, shared=shared, shared_prefix=shared_prefix)
+    timings["render"] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    data = encode_image(image, export["format"], export.get("quality"), export.get("compression"))
+    with open(output_path, "wb") as f:
+        f.write(data)
+    timings["encode"] = time.perf_counter() - mark
+    timings["total"] = time.perf_counter() - started
+    return {"width": image.shape[1], "height": image.shape[0], "bytes": len(data), "timings": timings}
+
+
+def _init_worker():
+    # Параллельность даёт сам пул процессов, внутри воркера потоки не плодим
+    tiles.configure(workers=1)
+    cv2.setNumThreads(1)
+
+
+class BatchRunner:
+    def __init__(self, workers, shared=None):
+        self.workers = workers  # сколько изображений обрабатывается одновременно
+        self.shared = shared  # в воркер уходит только папка кеша, см. ResultCache.__reduce__
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def submit(self, batch, inputs, steps, export):
+        """inputs - список (исходное имя, путь к сохранённому файлу в папке пакета)."""
+        os.makedirs(batch.file("out"), exist_ok=True)
+        extension = EXPORT_FORMATS[export["format"]][0]
+        used_names = set()
+        items = []
+        for index, (name, path) in enumerate(inputs):
+            output_name = os.path.splitext(name)[0] + extension
+            if output_name in used_names:
+                output_name = f"{os.path.splitext(name)[0]}_{index}{extension}"
+            used_names.add(output_name)
+            items.append({"name": name, "input": path, "output": output_name,
+                          "status": "queued", "error": None, "timings": None})
+        with batch.lock():
+            batch.save_state({"created": time.time(), "finished": None, "export": export, "items": items})
+
+        executor = self._get_executor()
+        for index, item in enumerate(items):
+            future = executor.submit(process_image, item["input"], batch.file(os.path.join("out", item["output"])),
+                                     steps, export, self.shared)
+            future.add_done_callback(lambda future, index=index: self._finish(batch, index, future))
+        return batch
+
+    def _finish(self, batch, index, future):
+        with batch.lock():
+            state = batch.load_state()
+            item = state["items"][index]
+            try:
+                item.update(future.result())
+                item["status"] = "done"
+            except Exception as e:
+                item["status"] = "error"
+                item["error"] = str(e)
+            if all(item["status"] in ("done", "error") for item in state["items"]):
+                state["finished"] = time.time()
+            batch.save_state(state)
+
+
+def status(batch):
+    state = batch.load_state()
+    items = state.get("items", [])
+    done = sum(1 for item in items if item["status"] == "done")
+    failed = sum(1 for item in items if item["status"] == "error")
+    finished = state.get("finished")
+    return {
+        "id": batch.id,
+        "total": len(items),
+        "done": done,
+        "failed": failed,
+        "progress": (done + failed) / len(items) if items else 1.0,
+        "finished": finished is not None,
+        "elapsed": (finished or time.time()) - state.get("created", time.time()),
+        "items": [{key: item[key] for key in ("name", "output", "status", "error", "timings")} for item in items],
+    }
+
+
+class _ZipStream:
+    # zipfile пишет сюда, а мы отдаём накопленные байты кусками в ответ
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(batch, poll_interval=0.2, stall_timeout=600):
+    """Генератор zip-архива с результатами: файлы добавляются по мере готовности.
+
+    В конец архива кладётся status.json с временем обработки каждого файла.
+    Если stall_timeout секунд ни одно изображение не завершилось (например,
+    процесс с пулом перезапустили), архив закрывается с тем, что успело.
+    """
+    stream = _ZipStream()
+    sent = set()
+    last_progress = time.time()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as archive:
+        while True:
+            items = batch.load_state().get("items", [])
+            for index, item in enumerate(items):
+                if index in sent or item["status"] not in ("done", "error"):
+                    continue
+                sent.add(index)
+                last_progress = time.time()
+                if item["status"] == "done":
+                    # Готовые JPEG/PNG/WebP уже сжаты, поэтому храним без повторного сжатия
+                    archive.write(batch.file(os.path.join("out", item["output"])), item["output"])
+                    yield stream.take()
+            if len(sent) == len(items) or time.time() - last_progress > stall_timeout:
+                break
+            time.sleep(poll_interval)
+        archive.writestr("status.json", json.dumps(status(batch), ensure_ascii=False, indent=2))
+    yield stream.take()
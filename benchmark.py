@@ -0,0 +1,348 @@
+# Замер скорости операций редактора.
+# Каждая операция со всеми вариантами параметров выполняется через
+# edit_pipeline.render на синтетических изображениях заданных размеров
+# (в мегапикселях). Для каждого случая считаются p50/p95 времени, пропускная
+# способность (Мп/с по медиане) и пиковый прирост памяти процесса (RSS).
+# Результат пишется в JSON; если передать прошлый JSON как --baseline, будут
+# показаны изменения по медиане, а при замедлении сверх порога скрипт
+# завершится с кодом 1.
+# С --accuracy время не замеряется: размытие всех размеров из BLUR_SIZES
+# сравнивается с точным результатом OpenCV (там, где он есть), печатаются
+# наибольшая и средняя ошибка в уровнях яркости.
+#
+#   python benchmark.py --sizes 1,12,50 --output bench.json
+#   python benchmark.py --sizes 1,12 --only blur --baseline bench.json
+#   python benchmark.py --sizes 1 --accuracy
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import blur
+import edit_pipeline
+import tiles
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Размеры ядра в случаях размытия: время не должно расти вместе с размером
+BLUR_SIZES = (5, 31, 101, 301, 1001)
+
+
+def make_image(megapixels, seed=0):
+    """Синтетическое BGR-изображение 4:3: плавные градиенты с мелким шумом."""
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[..., 0] = x
+    image[..., 1] = y
+    image[..., 2] = (x + y) / 2
+    grain = np.random.default_rng(seed).integers(0, 16, (height, width), dtype=np.uint8)
+    image += grain[..., None]
+    return image
+
+
+def make_pattern(megapixels):
+    """Трудный для приближённого размытия узор 4:3: полосы по 8 пикселей и резкий край."""
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    stripes = (np.arange(width) // 8 % 2 * 255).astype(np.uint8)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = stripes[None, :, None]
+    image[height // 2:, :, 1] = 255 - image[height // 2:, :, 1]
+    return image
+
+
+def cases(width, height):
+    """[(имя случая, список операций)] для изображения width x height."""
+    center = [width / 2, height / 2]
+    w, h = width // 2, height // 2
+    result = [
+        ("brightcontr", [{"op": "brightcontr", "contrast": 1.3, "brightness": 20}]),
+        ("color_balance", [{"op": "color_balance", "red": 0.1, "green": 0.0, "blue": -0.1}]),
+        ("gamma", [{"op": "gamma", "gamma": 2.2, "channel": "all"}]),
+        # Пять тоновых операций - всё равно один проход cv2.LUT
+        ("tone/chain", [
+            {"op": "brightcontr", "contrast": 1.2, "brightness": -10},
+            {"op": "gamma", "gamma": 1.4, "channel": "all"},
+            {"op": "levels", "in_black": 16, "in_white": 235, "gamma": 1.0, "out_black": 0, "out_white": 255,
+             "channel": "all"},
+            {"op": "curves", "points": [[0, 0], [128, 150], [255, 255]], "channel": "green"},
+            {"op": "color_balance", "red": 0.05, "green": 0.0, "blue": -0.05},
+        ]),
+    ]
+    for axis in ("x", "y", "both"):
+        result.append((f"mirror/{axis}", [{"op": "mirror", "axis": axis}]))
+    for angle in (90, 30):
+        for keep_size in (True, False):
+            result.append((f"rotate/{angle}/keep_size={keep_size}",
+                           [{"op": "rotate", "angle": angle, "center": center, "keep_size": keep_size}]))
+    # Четверть оборота вокруг центра изображения - без интерполяции, через cv2.rotate
+    for angle in (90, 180):
+        result.append((f"rotate/{angle}/quarter", [{"op": "rotate", "angle": angle, "center": None, "keep_size": False}]))
+    result.append(("chain/mirror+rotate90", [{"op": "mirror", "axis": "x"},
+                                            {"op": "rotate", "angle": 90, "center": None, "keep_size": False}]))
+    for scale in (0.25, 0.5, 2.0):
+        for method in ("nearest", "linear", "cubic"):
+            result.append((f"resize/x{scale}/{method}",
+                           [{"op": "resize", "width": int(width * scale), "height": int(height * scale),
+                             "method": method}]))
+    result.append(("crop/rect", [{"op": "crop", "x": width // 4, "y": height // 4, "width": w, "height": h}]))
+    points = [[width // 4 + w // 2, height // 4], [width // 4 + w, height // 4 + h],
+              [width // 4, height // 4 + h]]
+    result.append(("crop/freeform", [{"op": "crop_freeform", "points": points}]))
+    result.append(("crop/freeform/feather+alpha",
+                   [{"op": "crop_freeform", "points": points, "feather": 20, "alpha": True}]))
+    # Контур от руки: десятки тысяч вершин на окружности
+    angles = np.linspace(0, 2 * np.pi, 20000, endpoint=False)
+    radius = min(w, h) / 2 * (1 + 0.05 * np.sin(angles * 50))
+    lasso = np.stack([width // 2 + radius * np.cos(angles), height // 2 + radius * np.sin(angles)], axis=1)
+    result.append(("crop/freeform/20000_points",
+                   [{"op": "crop_freeform", "points": np.rint(lasso).astype(int).tolist()}]))
+    for blur_type in ("average", "gaussian", "median"):
+        for kernel_size in BLUR_SIZES:
+            result.append((f"blur/{blur_type}/{kernel_size}",
+                           [{"op": "blur", "blur_type": blur_type, "kernel_size": kernel_size}]))
+    for noise_type in ("gaussian", "salt_pepper", "poisson", "speckle"):
+        result.append((f"add_noise/{noise_type}",
+                       [{"op": "add_noise", "noise_type": noise_type, "amount": 0.1, "seed": 1}]))
+    # Типичная цепочка правок: склеивается в одну геометрию и одну LUT
+    result.append(("chain/rotate+resize+tone", [
+        {"op": "rotate", "angle": 15, "center": center, "keep_size": True},
+        {"op": "resize", "width": w, "height": h, "method": "linear"},
+        {"op": "brightcontr", "contrast": 1.1, "brightness": 5},
+        {"op": "color_balance", "red": 0.05, "green": 0.0, "blue": 0.0},
+    ]))
+    return result
+
+
+def _current_rss():
+    # /proc есть только в Linux; в других системах пиковый прирост не замеряется
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class PeakMemory:
+    """Пиковый прирост RSS за время блока with, замеряется опросом в фоне."""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        self.start = _current_rss()
+        self.peak = self.start or 0
+        self._stop = threading.Event()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+        return self
+
+    def sample(self):
+        if self.start is not None:
+            self.peak = max(self.peak, _current_rss())
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.start is not None:
+            self._thread.join()
+            self.sample()
+
+    @property
+    def delta_mb(self):
+        if self.start is None:
+            return None
+        return (self.peak - self.start) / 2 ** 20
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q))
+
+
+def run_case(image, ops, repeat, warmup):
+    for _ in range(warmup):
+        edit_pipeline.render(image, ops)
+    times = []
+    with PeakMemory() as memory:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = edit_pipeline.render(image, ops)
+            times.append(time.perf_counter() - started)
+            # Короткие операции опрос может пропустить, поэтому замеряем и пока результат жив
+            memory.sample()
+            del result
+    return times, memory.delta_mb
+
+
+def run(sizes, repeat, warmup, only=None):
+    results = []
+    for megapixels in sizes:
+        image = make_image(megapixels)
+        height, width = image.shape[:2]
+        for name, ops in cases(width, height):
+            if only and not any(part in name for part in only):
+                continue
+            times, rss_mb = run_case(image, ops, repeat, warmup)
+            p50 = percentile(times, 50)
+            result = {
+                "case": name,
+                "megapixels": megapixels,
+                "width": width,
+                "height": height,
+                "runs": repeat,
+                "p50_ms": p50 * 1000,
+                "p95_ms": percentile(times, 95) * 1000,
+                "mean_ms": float(np.mean(times)) * 1000,
+                "mpix_per_s": width * height / 1e6 / p50 if p50 > 0 else None,
+                "peak_rss_delta_mb": rss_mb,
+            }
+            results.append(result)
+            print(f"{megapixels:>5g} Мп  {name:<32} p50 {result['p50_ms']:9.1f} мс  "
+                  f"p95 {result['p95_ms']:9.1f} мс  {result['mpix_per_s'] or 0:8.1f} Мп/с  "
+                  f"RSS +{rss_mb or 0:7.1f} МБ", flush=True)
+        del image
+    return results
+
+
+def exact_blur(image, blur_type, kernel_size):
+    """Эталон размытия целиком средствами OpenCV; None, если OpenCV такое окно не считает."""
+    if blur_type == "average":
+        return cv2.blur(image, (kernel_size, kernel_size))
+    if blur_type == "gaussian":
+        if kernel_size % 2:
+            return cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
+        # Чётного ядра OpenCV не принимает: эталон - ближайшее нечётное с той же sigma
+        size = kernel_size + 1
+        return cv2.GaussianBlur(image, (size, size), blur.gaussian_sigma(kernel_size))
+    if (kernel_size | 1) <= blur.EXACT_MEDIAN_MAX:
+        return cv2.medianBlur(image, kernel_size | 1)
+    return None
+
+
+def accuracy(sizes, only=None):
+    """Ошибка размытия относительно эталона OpenCV по всем типам и размерам."""
+    results = []
+    for megapixels in sizes:
+        for image_name, image in (("градиент", make_image(megapixels)), ("узор", make_pattern(megapixels))):
+            for blur_type in blur.BLUR_TYPES:
+                for kernel_size in BLUR_SIZES:
+                    name = f"blur/{blur_type}/{kernel_size}"
+                    if only and not any(part in name for part in only):
+                        continue
+                    reference = exact_blur(image, blur_type, kernel_size)
+                    if reference is None:
+                        print(f"{megapixels:>5g} Мп  {image_name:<9} {name:<24} нет эталона", flush=True)
+                        continue
+                    error = cv2.absdiff(blur.blur_image(image, blur_type, kernel_size), reference)
+                    result = {"case": name, "image": image_name, "megapixels": megapixels,
+                              "max_error": int(error.max()), "mean_error": float(error.mean())}
+                    results.append(result)
+                    print(f"{megapixels:>5g} Мп  {image_name:<9} {name:<24} ошибка: наибольшая "
+                          f"{result['max_error']:3d}, средняя {result['mean_error']:.3f}", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Печатает изменение медианы относительно прошлого прогона, возвращает список замедлений."""
+    previous = {(item["case"], item["megapixels"]): item for item in baseline.get("results", [])}
+    regressions = []
+    print("\nСравнение с базовым прогоном (p50):")
+    for item in results:
+        old = previous.get((item["case"], item["megapixels"]))
+        if old is None or not old["p50_ms"]:
+            continue
+        ratio = item["p50_ms"] / old["p50_ms"]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  ЗАМЕДЛЕНИЕ"
+            regressions.append({"case": item["case"], "megapixels": item["megapixels"], "ratio": ratio})
+        print(f"{item['megapixels']:>5g} Мп  {item['case']:<32} {old['p50_ms']:9.1f} -> "
+              f"{item['p50_ms']:9.1f} мс  x{ratio:.2f}{mark}")
+    return regressions
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tile_size": tiles.TILE_SIZE,
+        "tile_workers": tiles.WORKERS,
+        "opencv_threads": cv2.getNumThreads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замер скорости операций редактора")
+    parser.add_argument("--sizes", default="1,12,50", help="размеры изображений в мегапикселях через запятую")
+    parser.add_argument("--repeat", type=int, default=5, help="замеров на случай")
+    parser.add_argument("--warmup", type=int, default=1, help="прогревочных запусков на случай")
+    parser.add_argument("--only", default="", help="подстроки имён случаев через запятую, например blur,resize")
+    parser.add_argument("--workers", type=int, help="потоков для плиточной обработки")
+    parser.add_argument("--tile-size", type=int, help="сторона плитки в пикселях")
+    parser.add_argument("--accuracy", action="store_true",
+                        help="вместо времени сравнить размытие с точным результатом OpenCV")
+    parser.add_argument("--output", help="куда записать результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="допустимое замедление медианы относительно базового прогона (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    tiles.configure(tile_size=args.tile_size, workers=args.workers)
+    sizes = [float(size) for size in args.sizes.split(",") if size]
+    only = [part for part in args.only.split(",") if part]
+
+    if args.accuracy:
+        report = {"environment": environment(), "settings": {"sizes": sizes, "only": only},
+                  "accuracy": accuracy(sizes, only)}
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return 0
+
+    results = run(sizes, args.repeat, args.warmup, only)
+    report = {
+        "environment": environment(),
+        "settings": {"sizes": sizes, "repeat": args.repeat, "warmup": args.warmup, "only": only},
+        # ru_maxrss в Linux в килобайтах
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else None,
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
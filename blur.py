@@ -0,0 +1,164 @@
+# Размытие, цена которого не растёт с размером ядра.
+# kernel_size - ширина окна в пикселях, как в форме; годится любое целое >= 1.
+#
+#   average  - cv2.blur: скользящие суммы по строкам и столбцам (то же, что
+#              интегральное изображение), цена на пиксель от размера не зависит.
+#              Результат точный.
+#   gaussian - sigma берётся из размера так же, как в OpenCV при sigma=0
+#              (gaussian_sigma). Три режима:
+#              * kernel_size <= EXACT_GAUSSIAN_MAX - точный cv2.GaussianBlur,
+#                для нечётных размеров тот же, что с sigma=0 (до 7 - готовые
+#                ядра OpenCV); цена ~ kernel_size, но размер ограничен;
+#              * sigma < DOWNSCALE_SIGMA * 2 - BOX_PASSES проходов box-фильтра
+#                нечётных ширин w и w + 2 во float32, последний - смесь этих
+#                двух box, так что дисперсия совпадает точно (box_plan).
+#                Отличие двумерного ядра от гауссова по норме L1 не больше
+#                0.056, отсюда худший случай - 255 * 0.056 / 2 ~ 7 уровней на
+#                специально подобранном узоре, на фотографиях - 1-2 уровня;
+#              * иначе - уменьшение в f = sigma // DOWNSCALE_SIGMA раз
+#                (INTER_AREA), точное гауссово размытие копии с поправкой на
+#                дисперсию уменьшения и увеличения, увеличение INTER_LINEAR.
+#                Ошибка линейной интерполяции размытого сигнала не больше
+#                255 * 0.968 / 4 * (f / sigma)^2 ~ 1 уровень при
+#                sigma / f >= DOWNSCALE_SIGMA, плюс округление до uint8 копии.
+#                В полосе шириной около 2 * sigma у краёв изображения ошибка до
+#                ~10 уровней: копия продолжается за край не так, как исходник;
+#   median   - окно нечётное, чётный размер округляется вверх. До
+#              EXACT_MEDIAN_MAX - точный cv2.medianBlur (для окон больше 5 это
+#              гистограммный алгоритм с постоянной ценой на пиксель). Больше -
+#              медиана уменьшенной копии (INTER_AREA в f = ceil(kernel_size /
+#              EXACT_MEDIAN_MAX) раз, окно копии не больше EXACT_MEDIAN_MAX),
+#              увеличенная обратно: это медиана средних по блокам f x f. Края
+#              смещаются не больше чем на f / 2 пикселя; на фотографиях ошибка
+#              1-2 уровня, на шуме до 7 (99-й перцентиль), а узор мельче f
+#              пикселей (шахматка в пиксель) усредняется до серого.
+# Точные цифры ошибок для типовых размеров печатает benchmark.py --accuracy.
+#
+# Фильтры с окном считаются плитками с полями (tiles.run_tiled); плитка растёт
+# вместе с полем, чтобы поля не съедали большую часть работы при больших окнах.
+# Режимы с уменьшением считаются целиком: копия в f^2 раз меньше исходника.
+
+import math
+
+import cv2
+
+import tiles
+
+
+BLUR_TYPES = ("average", "gaussian", "median")
+
+EXACT_GAUSSIAN_MAX = 31  # до этого размера ядра гауссово размытие точное
+BOX_PASSES = 4  # проходов box-фильтра в приближении гауссова
+DOWNSCALE_SIGMA = 8.0  # sigma, которая остаётся на уменьшенной копии
+# В гистограмме окна cv2.medianBlur 16-битные счётчики: окно больше 255 x 255
+# их переполняет, и результат неверный (или OpenCV падает на проверке)
+EXACT_MEDIAN_MAX = 255
+HALO_TILE_RATIO = 8  # сторона плитки не меньше стольких ширин поля
+
+
+def gaussian_sigma(kernel_size):
+    """sigma, которую cv2.GaussianBlur выбирает для ядра kernel_size при sigma=0."""
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+
+def box_plan(sigma, passes=BOX_PASSES):
+    """Проходы box-фильтра с общей дисперсией sigma^2: (ширины, ширина смеси, доля широкого box в смеси).
+
+    Все ширины нечётные: width или width + 2. Последний проход - смесь box
+    ширины width и width + 2 с долей beta у широкого, она добирает остаток
+    дисперсии точно.
+    """
+    width = int(math.sqrt(12 * sigma * sigma / passes + 1))
+    width -= width % 2 == 0
+    narrow, wide = (width * width - 1) / 12, ((width + 2) ** 2 - 1) / 12
+    rest = max(sigma * sigma - passes * narrow, 0.0) / (wide - narrow)
+    wide_passes = min(int(rest), passes - 1)
+    widths = [width + 2] * wide_passes + [width] * (passes - 1 - wide_passes)
+    return widths, width, rest - wide_passes
+
+
+def _run(image, func, halo):
+    tile_size = max(tiles.TILE_SIZE, HALO_TILE_RATIO * halo)
+    return tiles.run_tiled(image, func, halo=halo, tile_size=tile_size)
+
+
+def _average(image, kernel_size):
+    return _run(image, lambda tile, y, x: cv2.blur(tile, (kernel_size, kernel_size)), kernel_size // 2)
+
+
+def _exact_gaussian(image, kernel_size):
+    # Нечётный размер - ровно cv2.GaussianBlur(image, (k, k), 0): до 7 OpenCV берёт
+    # готовые ядра, а не формулу gaussian_sigma. Чётному нужно нечётное ядро,
+    # sigma остаётся от заданного размера
+    sigma = 0 if kernel_size % 2 else gaussian_sigma(kernel_size)
+    size = kernel_size | 1
+    return _run(image, lambda tile, y, x: cv2.GaussianBlur(tile, (size, size), sigma), size // 2)
+
+
+def _box_gaussian_tile(tile, widths, width, beta):
+    values = cv2.boxFilter(tile, cv2.CV_32F, (widths[0], widths[0]))
+    for size in widths[1:]:
+        cv2.boxFilter(values, -1, (size, size), dst=values)
+    narrow = cv2.boxFilter(values, -1, (width, width))
+    cv2.boxFilter(values, -1, (width + 2, width + 2), dst=values)
+    cv2.addWeighted(narrow, 1 - beta, values, beta, 0, dst=values)
+    return cv2.convertScaleAbs(values)  # округление и насыщение до uint8
+
+
+def _box_gaussian(image, sigma):
+    widths, width, beta = box_plan(sigma)
+    halo = sum(size // 2 for size in widths) + width // 2 + 1
+    return _run(image, lambda tile, y, x: _box_gaussian_tile(tile, widths, width, beta), halo)
+
+
+def _reduced(image, factor):
+    height, width = image.shape[:2]
+    size = (max(1, round(width / factor)), max(1, round(height / factor)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def _enlarge(small, image):
+    height, width = image.shape[:2]
+    out = tiles.allocate(image.shape, image.dtype)
+    tiles.check_cancelled()
+    return cv2.resize(small, (width, height), dst=out, interpolation=cv2.INTER_LINEAR)
+
+
+def _downscaled_gaussian(image, sigma):
+    factor = int(sigma // DOWNSCALE_SIGMA)
+    small = _reduced(image, factor)
+    # Уменьшение - это box шириной factor (дисперсия (f^2 - 1) / 12), линейное
+    # увеличение - треугольник (около (f^2 - 1) / 6); копия размывается на остаток
+    small_sigma = math.sqrt(max(sigma * sigma - (factor * factor - 1) / 4, 0.0)) / factor
+    tiles.check_cancelled()
+    small = cv2.GaussianBlur(small, (0, 0), small_sigma)
+    return _enlarge(small, image)
+
+
+def _median(image, kernel_size):
+    kernel_size |= 1
+    if kernel_size <= EXACT_MEDIAN_MAX:
+        return _run(image, lambda tile, y, x: cv2.medianBlur(tile, kernel_size), kernel_size // 2)
+    factor = -(-kernel_size // EXACT_MEDIAN_MAX)
+    small = _reduced(image, factor)
+    tiles.check_cancelled()
+    small = cv2.medianBlur(small, min(round(kernel_size / factor) | 1, EXACT_MEDIAN_MAX))
+    return _enlarge(small, image)
+
+
+def blur_image(image, blur_type, kernel_size):
+    """Размытый image (uint8) новым массивом."""
+    if kernel_size < 1:
+        raise ValueError("Размер ядра должен быть положительным!")
+    if blur_type == "average":
+        return _average(image, kernel_size)
+    if blur_type == "gaussian":
+        if kernel_size <= EXACT_GAUSSIAN_MAX:
+            return _exact_gaussian(image, kernel_size)
+        sigma = gaussian_sigma(kernel_size)
+        if sigma < DOWNSCALE_SIGMA * 2:
+            return _box_gaussian(image, sigma)
+        return _downscaled_gaussian(image, sigma)
+    if blur_type == "median":
+        return _median(image, kernel_size)
+    raise ValueError(f"Неверный тип размытия: {blur_type}")
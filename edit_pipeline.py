@@ -0,0 +1,690 @@
+# Неразрушающий конвейер правок.
+# Маршруты редактора не меняют пиксели, а добавляют операцию в список
+# (state["ops"] рабочего пространства). Список вычисляется только когда нужно
+# показать или скачать картинку. При вычислении соседние операции склеиваются:
+#   - геометрические (rotate, mirror, resize, crop) -> одна матрица и один cv2.warpAffine,
+#     поэтому изображение передискретизируется один раз, а не после каждой правки.
+#     Если итоговая матрица только переставляет пиксели (повороты на 90 градусов,
+#     отражения, вырезки в любом сочетании), она сводится к одному cv2.flip,
+#     cv2.transpose или cv2.rotate без интерполяции, а целочисленное уменьшение
+#     после них - к cv2.resize с INTER_AREA. Вырезка заканчивает склейку:
+#     следующие операции работают уже с вырезанным куском, иначе поворот и
+#     интерполяция у краёв брали бы пиксели из отрезанной части;
+#   - тоновые (brightcontr, color_balance, gamma, levels, curves) -> одна таблица
+#     256 значений на канал и один cv2.LUT;
+#   - остальные (blur, add_noise, crop_freeform) выполняются по одной; размытие
+#     любого размера стоит примерно одинаково (модуль blur).
+# Произвольная вырезка может дать четвёртый канал - прозрачность. Тоновые
+# операции и шум его не трогают, геометрия заполняет углы прозрачным.
+# Выходные массивы выделяются через tiles.allocate, поэтому для очень больших
+# изображений они могут лежать в отображённом в память файле. Промежуточный
+# результат, который никто, кроме вычисления, не видит, следующий тоновый
+# участок или шум меняет на месте, без второго буфера полного размера.
+#
+# Операция - это словарь вида {"op": "rotate", "angle": 30.0, ...}. Все координаты
+# и размеры в операциях абсолютные, в пикселях изображения на входе операции.
+
+import hashlib
+import json
+
+import cv2
+import numpy as np
+
+import blur
+import noise
+import tiles
+
+
+GEOMETRIC_OPS = {"rotate", "mirror", "resize", "crop"}
+TONE_OPS = {"brightcontr", "color_balance", "gamma", "levels", "curves"}
+FILTER_OPS = {"blur", "add_noise", "crop_freeform"}
+
+WHITE = (255, 255, 255)
+
+MAX_FEATHER = 200  # пикселей мягкого края у произвольной вырезки
+MAX_KERNEL_SIZE = 10000  # пикселей окна размытия
+# Меняется, когда те же операции начинают давать другие пиксели: старые записи
+# общего кеша результатов перестают совпадать по ключу
+PIXELS_VERSION = 4
+
+# Канал тоновой операции -> номер в BGR; None - все каналы
+TONE_CHANNELS = {"all": None, "blue": 0, "green": 1, "red": 2}
+
+# Чем больше номер, тем качественнее интерполяция; при склейке берём лучшую из запрошенных
+_INTERPOLATIONS = {"nearest": cv2.INTER_NEAREST, "linear": cv2.INTER_LINEAR, "cubic": cv2.INTER_CUBIC}
+_INTERPOLATION_RANK = ["nearest", "linear", "cubic"]
+
+
+def op_kind(op):
+    name = op["op"]
+    if name in GEOMETRIC_OPS:
+        return "geometric"
+    if name in TONE_OPS:
+        return "tone"
+    if name in FILTER_OPS:
+        return "filter"
+    raise ValueError(f"Неизвестная операция: {name}")
+
+
+def ops_digest(ops):
+    """Короткий отпечаток списка операций - часть ключа кеша результатов."""
+    data = json.dumps([PIXELS_VERSION, ops], sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+# --- Размеры ---------------------------------------------------------------
+
+def op_output_size(op, width, height):
+    name = op["op"]
+    if name == "rotate":
+        return _rotation(op, width, height)[1:]
+    if name == "resize":
+        return op["width"], op["height"]
+    if name == "crop":
+        return op["width"], op["height"]
+    if name == "crop_freeform":
+        x, y, w, h = freeform_bounds(op["points"], width, height, min_size=1)
+        return w, h
+    return width, height
+
+
+def output_size(ops, width, height):
+    """Размер результата списка операций без вычисления пикселей."""
+    for op in ops:
+        width, height = op_output_size(op, width, height)
+    return width, height
+
+
+# --- Параметры из форм -----------------------------------------------------
+
+def rotation_center(center_x, center_y, width, height):
+    """Центр вращения в пикселях или None (центр изображения).
+
+    Значения не больше 1 считаются относительными (0-1), остальные - абсолютными.
+    """
+    if not (center_x and center_y):
+        return None
+    center_x = float(center_x)
+    center_y = float(center_y)
+    # Если указаны относительные координаты (0-1), преобразуем в абсолютные
+    if center_x <= 1.0 and center_y <= 1.0:
+        return [int(center_x * width), int(center_y * height)]
+    return [int(center_x), int(center_y)]
+
+
+def resize_target(resize_type, value, method, width, height):
+    """Новый размер и интерполяция для формы изменения размера."""
+    if resize_type == 'scale':
+        new_width = int(width * value)
+        new_height = int(height * value)
+    else:
+        if resize_type == 'width':
+            new_width = int(value)
+            new_height = int(height * (value / width))
+        else:
+            new_height = int(value)
+            new_width = int(width * (value / height))
+
+    if method == 'auto':
+        if value > 1:
+            method = 'cubic'
+        else:
+            method = 'linear'
+
+    if method not in ('nearest', 'linear'):
+        method = 'cubic'
+    return new_width, new_height, method
+
+
+def _tone_channel(channel):
+    channel = channel or "all"
+    if channel not in TONE_CHANNELS:
+        raise ValueError(f"Неизвестный канал: {channel}")
+    return channel
+
+
+def gamma_op(gamma, channel=None):
+    """Операция гамма-коррекции; gamma > 1 осветляет средние тона, < 1 затемняет."""
+    gamma = float(gamma)
+    if not 0.01 <= gamma <= 10:
+        raise ValueError("Гамма должна быть от 0.01 до 10")
+    return {"op": "gamma", "gamma": gamma, "channel": _tone_channel(channel)}
+
+
+def levels_op(in_black=0, in_white=255, gamma=1.0, out_black=0, out_white=255, channel=None):
+    """Операция уровней: [in_black, in_white] растягивается на [out_black, out_white] с гаммой средних тонов."""
+    values = [int(in_black), int(in_white), int(out_black), int(out_white)]
+    if not all(0 <= value <= 255 for value in values):
+        raise ValueError("Уровни должны быть от 0 до 255")
+    if values[0] >= values[1]:
+        raise ValueError("Входной уровень чёрного должен быть меньше уровня белого")
+    op = gamma_op(gamma, channel)
+    return {"op": "levels", "in_black": values[0], "in_white": values[1], "gamma": op["gamma"],
+            "out_black": values[2], "out_white": values[3], "channel": op["channel"]}
+
+
+def curves_op(points, channel=None):
+    """Операция кривых: точки [[вход, выход], ...] от 0 до 255, между ними - линейно."""
+    try:
+        points = sorted((int(x), int(y)) for x, y in points)
+    except (TypeError, ValueError):
+        raise ValueError("Точки кривой задаются парами [вход, выход]")
+    if len(points) < 2:
+        raise ValueError("Для кривой нужно хотя бы две точки")
+    if not all(0 <= value <= 255 for point in points for value in point):
+        raise ValueError("Точки кривой должны быть от 0 до 255")
+    if len({x for x, _ in points}) != len(points):
+        raise ValueError("У кривой не может быть двух точек с одним входом")
+    return {"op": "curves", "points": [list(point) for point in points], "channel": _tone_channel(channel)}
+
+
+def freeform_crop_op(points, feather=0, alpha=False):
+    """Операция произвольной вырезки по многоугольнику points [[x, y], ...].
+
+    feather - ширина мягкого края в пикселях, alpha=True - вместо чёрной заливки
+    снаружи многоугольника результат получает прозрачность.
+    """
+    try:
+        points = np.array(points, dtype=np.int64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        raise ValueError("Точки задаются парами x,y")
+    # Повторы подряд (их много при рисовании от руки) ничего не меняют в заливке
+    if len(points):
+        keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+        keep[0] |= not keep.any()
+        points = points[keep]
+    if len(points) < 3:
+        raise ValueError("Нужно указать как минимум 3 точки!")
+    feather = int(feather or 0)
+    if not 0 <= feather <= MAX_FEATHER:
+        raise ValueError(f"Растушёвка должна быть от 0 до {MAX_FEATHER} пикселей")
+    return {"op": "crop_freeform", "points": points.tolist(), "feather": feather, "alpha": bool(alpha)}
+
+
+def blur_op(blur_type, kernel_size):
+    """Операция размытия окном kernel_size пикселей; годится любой размер, в том числе чётный."""
+    if blur_type not in blur.BLUR_TYPES:
+        raise ValueError("Неверный тип размытия!")
+    kernel_size = int(kernel_size)
+    if not 1 <= kernel_size <= MAX_KERNEL_SIZE:
+        raise ValueError(f"Размер ядра должен быть от 1 до {MAX_KERNEL_SIZE}!")
+    return {"op": "blur", "blur_type": blur_type, "kernel_size": kernel_size}
+
+
+# --- Превью ----------------------------------------------------------------
+
+def proxy_scale(width, height, max_edge):
+    """Во сколько раз уменьшить изображение, чтобы длинная сторона была не больше max_edge."""
+    return min(1.0, max_edge / max(width, height))
+
+
+def proxy_size(width, height, scale):
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def make_proxy(image, scale):
+    if scale >= 1.0:
+        return image
+    height, width = image.shape[:2]
+    return cv2.resize(image, proxy_size(width, height, scale), interpolation=cv2.INTER_AREA)
+
+
+def _scale_length(value, scale):
+    return max(1, round(value * scale))
+
+
+def scale_ops(ops, scale):
+    """Переводит операции из пикселей оригинала в пиксели уменьшенной копии.
+
+    Превью вычисляется по копии, уменьшенной в scale раз, поэтому все координаты,
+    размеры и радиусы умножаются на scale - тогда превью совпадает с уменьшенным
+    результатом полного вычисления при скачивании.
+    """
+    if scale >= 1.0:
+        return ops
+    scaled = []
+    for op in ops:
+        op = dict(op)
+        name = op["op"]
+        if name == "rotate" and op.get("center"):
+            op["center"] = [op["center"][0] * scale, op["center"][1] * scale]
+        elif name == "resize":
+            op["width"] = _scale_length(op["width"], scale)
+            op["height"] = _scale_length(op["height"], scale)
+        elif name == "crop":
+            op["x"] = round(op["x"] * scale)
+            op["y"] = round(op["y"] * scale)
+            op["width"] = _scale_length(op["width"], scale)
+            op["height"] = _scale_length(op["height"], scale)
+        elif name == "crop_freeform":
+            op["points"] = [[round(x * scale), round(y * scale)] for x, y in op["points"]]
+            if op.get("feather"):
+                op["feather"] = round(op["feather"] * scale)
+        elif name == "blur":
+            op["kernel_size"] = _scale_length(op["kernel_size"], scale)
+        scaled.append(op)
+    return scaled
+
+
+# --- Геометрия -------------------------------------------------------------
+
+def _quarter_turn(angle, width, height, keep_size):
+    # Поворот вокруг центра пиксельной сетки ((w - 1) / 2, (h - 1) / 2): при повороте
+    # на четверть оборота пиксель переходит ровно в пиксель, интерполяция не нужна
+    turns = int(angle // 90) % 4
+    new_width, new_height = (height, width) if turns % 2 and not keep_size else (width, height)
+    cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][turns]
+    center_x, center_y = (width - 1) / 2, (height - 1) / 2
+    new_center_x, new_center_y = (new_width - 1) / 2, (new_height - 1) / 2
+    matrix = np.array([
+        [cos, sin, new_center_x - cos * center_x - sin * center_y],
+        [-sin, cos, new_center_y + sin * center_x - cos * center_y],
+    ], dtype=np.float64)
+    return matrix, new_width, new_height
+
+
+def _rotation(op, width, height):
+    angle = op["angle"]
+    if angle % 90 == 0 and not op.get("center"):
+        return _quarter_turn(angle, width, height, op.get("keep_size"))
+    if op.get("center"):
+        center_x, center_y = op["center"]
+    else:
+        # Центр по умолчанию - центр изображения
+        center_x, center_y = width // 2, height // 2
+    matrix = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
+
+    if op.get("keep_size"):
+        return matrix, width, height
+
+    if angle % 90 == 0:
+        # Для углов, кратных 90 градусам, используем исходные или транспонированные размеры
+        if angle % 180 == 0:
+            return matrix, width, height
+        new_width, new_height = height, width
+    else:
+        cos_val = abs(matrix[0, 0])
+        sin_val = abs(matrix[0, 1])
+        new_width = int((height * sin_val) + (width * cos_val))
+        new_height = int((height * cos_val) + (width * sin_val))
+
+    # Корректируем матрицу преобразования для учета новых размеров
+    matrix[0, 2] += (new_width / 2) - center_x
+    matrix[1, 2] += (new_height / 2) - center_y
+    return matrix, new_width, new_height
+
+
+def op_matrix(op, width, height):
+    """Матрица 3x3 (из координат входа в координаты выхода), новый размер и интерполяция."""
+    name = op["op"]
+    matrix = np.eye(3)
+    interpolation = "nearest"  # целочисленные сдвиги и отражения интерполяции не требуют
+
+    if name == "rotate":
+        rotation, width, height = _rotation(op, width, height)
+        matrix[:2] = rotation
+        interpolation = "linear"
+    elif name == "mirror":
+        if op["axis"] in ("x", "both"):
+            matrix[0, 0], matrix[0, 2] = -1, width - 1
+        if op["axis"] in ("y", "both"):
+            matrix[1, 1], matrix[1, 2] = -1, height - 1
+    elif name == "resize":
+        # Та же привязка центров пикселей, что и в cv2.resize
+        scale_x = op["width"] / width
+        scale_y = op["height"] / height
+        matrix[0, 0], matrix[0, 2] = scale_x, 0.5 * scale_x - 0.5
+        matrix[1, 1], matrix[1, 2] = scale_y, 0.5 * scale_y - 0.5
+        width, height = op["width"], op["height"]
+        interpolation = op.get("method", "linear")
+    elif name == "crop":
+        matrix[0, 2], matrix[1, 2] = -op["x"], -op["y"]
+        width, height = op["width"], op["height"]
+    return matrix, width, height, interpolation
+
+
+def _apply_geometric(image, ops):
+    height, width = image.shape[:2]
+    src_height, src_width = height, width
+
+    # Вся цепочка сводится к одной матрице до того, как тронуты пиксели
+    total = np.eye(3)
+    interpolation = "nearest"
+    for op in ops:
+        matrix, width, height, op_interpolation = op_matrix(op, width, height)
+        total = matrix @ total
+        if _INTERPOLATION_RANK.index(op_interpolation) > _INTERPOLATION_RANK.index(interpolation):
+            interpolation = op_interpolation
+
+    # Повороты на 90 градусов, отражения и вырезки - перестановка пикселей без интерполяции
+    permutation = _axis_permutation(total, width, height, src_width, src_height)
+    if permutation is not None:
+        return _permute(image, permutation, tiles.allocate((height, width) + image.shape[2:], image.dtype))
+
+    # Уменьшение в целое число раз (после перестановки): каждый пиксель - среднее блока kx x ky
+    if interpolation != "nearest":
+        downscale = _integer_downscale(total)
+        if downscale is not None:
+            inner, kx, ky = downscale
+            permutation = _axis_permutation(inner, width * kx, height * ky, src_width, src_height)
+            if permutation is not None:
+                region = _permute(image, permutation)
+                out = tiles.allocate((height, width) + image.shape[2:], image.dtype)
+                return cv2.resize(region, (width, height), dst=out, interpolation=cv2.INTER_AREA)
+
+    # Одиночное изменение размера делаем штатным cv2.resize
+    if len(ops) == 1 and ops[0]["op"] == "resize":
+        op = ops[0]
+        out = tiles.allocate((op["height"], op["width"]) + image.shape[2:], image.dtype)
+        return cv2.resize(image, (op["width"], op["height"]), dst=out,
+                          interpolation=_INTERPOLATIONS[op.get("method", "linear")])
+
+    has_rotation = any(op["op"] == "rotate" for op in ops)
+    return cv2.warpAffine(
+        image,
+        total[:2],
+        (width, height),
+        dst=tiles.allocate((height, width) + image.shape[2:], image.dtype),
+        flags=_INTERPOLATIONS[interpolation],
+        # Поворот оставляет белые углы, как раньше; без поворота края просто продолжаем
+        borderMode=cv2.BORDER_CONSTANT if has_rotation else cv2.BORDER_REPLICATE,
+        borderValue=WHITE,
+    )
+
+
+def _axis_permutation(matrix, width, height, src_width, src_height):
+    """Раскладывает матрицу из перестановки осей со знаками и целого сдвига.
+
+    Возвращает ((y0, y1, x0, x1) - область исходника, swapped, sign_x, sign_y) или None,
+    если матрица не такая или выход берёт пиксели за краем исходника.
+    """
+    linear = np.round(matrix[:2, :2])
+    shift = np.round(matrix[:2, 2])
+    if not (np.allclose(matrix[:2, :2], linear) and np.allclose(matrix[:2, 2], shift)):
+        return None
+    tx, ty = int(shift[0]), int(shift[1])
+    if np.array_equal(np.abs(linear), np.eye(2)):
+        # x' = sx * x + tx, y' = sy * y + ty
+        swapped, sign_x, sign_y = False, int(linear[0, 0]), int(linear[1, 1])
+        xs = (sign_x * (0 - tx), sign_x * (width - 1 - tx))
+        ys = (sign_y * (0 - ty), sign_y * (height - 1 - ty))
+    elif np.array_equal(np.abs(linear), np.eye(2)[::-1]):
+        # x' = sx * y + tx, y' = sy * x + ty: столбцы выхода идут по строкам исходника
+        swapped, sign_x, sign_y = True, int(linear[0, 1]), int(linear[1, 0])
+        ys = (sign_x * (0 - tx), sign_x * (width - 1 - tx))
+        xs = (sign_y * (0 - ty), sign_y * (height - 1 - ty))
+    else:
+        return None
+    x0, x1 = min(xs), max(xs) + 1
+    y0, y1 = min(ys), max(ys) + 1
+    if x0 < 0 or y0 < 0 or x1 > src_width or y1 > src_height:
+        return None
+    return (y0, y1, x0, x1), swapped, sign_x, sign_y
+
+
+# (swapped, sign_x, sign_y) -> код cv2.flip или cv2.rotate
+_FLIPS = {(-1, 1): 1, (1, -1): 0, (-1, -1): -1}
+_ROTATIONS = {(-1, 1): cv2.ROTATE_90_CLOCKWISE, (1, -1): cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+
+def _permute(image, permutation, out=None):
+    (y0, y1, x0, x1), swapped, sign_x, sign_y = permutation
+    region = image[y0:y1, x0:x1]
+    if not swapped and sign_x == sign_y == 1:
+        # Только вырезка: для промежуточного результата хватает среза без копии
+        if out is None:
+            return region
+        out[...] = region
+        return out
+    if out is None:
+        rows, cols = (region.shape[1], region.shape[0]) if swapped else region.shape[:2]
+        out = tiles.allocate((rows, cols) + image.shape[2:], image.dtype)
+    if not swapped:
+        return cv2.flip(region, _FLIPS[(sign_x, sign_y)], dst=out)
+    if (sign_x, sign_y) in _ROTATIONS:
+        return cv2.rotate(region, _ROTATIONS[(sign_x, sign_y)], dst=out)
+    cv2.transpose(region, dst=out)
+    if sign_x == -1:
+        # транспонирование с поворотом на 180 градусов
+        cv2.flip(out, -1, dst=out)
+    return out
+
+
+def _integer_downscale(matrix):
+    """Если matrix - уменьшение в целое число раз (как у resize) после перестановки осей,
+    возвращает (матрица перестановки, kx, ky), иначе None."""
+    scale_x = np.abs(matrix[0, :2]).max()
+    scale_y = np.abs(matrix[1, :2]).max()
+    if not (0 < scale_x < 1 and 0 < scale_y < 1):
+        return None
+    kx, ky = round(1 / scale_x), round(1 / scale_y)
+    if not (np.isclose(kx * scale_x, 1) and np.isclose(ky * scale_y, 1)):
+        return None
+    # Та же привязка центров пикселей, что в op_matrix для resize
+    scale = np.array([[scale_x, 0, 0.5 * scale_x - 0.5], [0, scale_y, 0.5 * scale_y - 0.5], [0, 0, 1]])
+    return np.linalg.inv(scale) @ matrix, kx, ky
+
+
+# --- Тон -------------------------------------------------------------------
+
+def _tone_curve(op):
+    """Таблица 256 значений для gamma, levels и curves - функция одного канала."""
+    name = op["op"]
+    x = np.arange(256, dtype=np.float64)
+    if name == "gamma":
+        return 255.0 * (x / 255.0) ** (1.0 / op["gamma"])
+    if name == "levels":
+        normalized = np.clip((x - op["in_black"]) / (op["in_white"] - op["in_black"]), 0.0, 1.0)
+        return op["out_black"] + (op["out_white"] - op["out_black"]) * normalized ** (1.0 / op["gamma"])
+    # curves: до первой и после последней точки значение держится постоянным
+    points = np.array(op["points"], dtype=np.float64)
+    return np.interp(x, points[:, 0], points[:, 1])
+
+
+def tone_lut(ops, channels=3):
+    """Склеивает тоновые операции в одну таблицу (256, 1, channels) для cv2.LUT.
+
+    Четвёртый канал - прозрачность, его таблица всегда тождественная.
+    """
+    color_channels = min(channels, 3)
+    table = np.repeat(np.arange(256, dtype=np.float64)[:, None], color_channels, axis=1)
+    for op in ops:
+        name = op["op"]
+        if name == "brightcontr":
+            # То же, что cv2.convertScaleAbs: |alpha * x + beta| с округлением и насыщением.
+            # OpenCV считает во float32, повторяем это, чтобы совпасть до последнего бита
+            alpha = np.float64(np.float32(op["contrast"]))
+            beta = np.float64(np.float32(op["brightness"]))
+            table = np.abs((alpha * table + beta).astype(np.float32)).astype(np.float64)
+        elif name == "color_balance":
+            # Порядок каналов OpenCV - BGR
+            offsets = [op["blue"], op["green"], op["red"]]
+            for channel in range(color_channels):
+                table[:, channel] += int(offsets[channel] * 255)
+        else:
+            # gamma, levels, curves: значения таблицы уже целые 0..255 - это индексы в кривую операции
+            curve = _tone_curve(op)
+            channel = TONE_CHANNELS[op.get("channel") or "all"]
+            targets = range(color_channels) if channel is None else [channel] if channel < color_channels else []
+            for target in targets:
+                table[:, target] = curve[table[:, target].astype(np.intp)]
+        # Каждая операция в одиночку насыщала результат до 0..255, делаем так же
+        table = np.clip(np.rint(table), 0, 255)
+    if channels > color_channels:
+        table = np.hstack([table, np.arange(256, dtype=np.float64)[:, None]])
+    return table.astype(np.uint8).reshape(256, 1, channels)
+
+
+def _apply_tone(image, ops, in_place=False):
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    lut = tone_lut(ops, channels)
+    if channels == 1:
+        lut = lut.reshape(256)
+    # Таблица применяется к каждому пикселю отдельно, поэтому можно писать прямо во вход
+    return tiles.run_tiled(image, lambda tile, y, x: cv2.LUT(tile, lut), out=image if in_place else None)
+
+
+# --- Фильтры ---------------------------------------------------------------
+
+def _apply_blur(image, op, in_place=False):
+    return blur.blur_image(image, op["blur_type"], op["kernel_size"])
+
+
+def _apply_noise(image, op, in_place=False):
+    # Зерно хранится в операции, чтобы повторное вычисление дало тот же шум
+    return noise.add_noise(image, op["noise_type"], op["amount"], op["seed"], out=image if in_place else None)
+
+
+def freeform_bounds(points, width, height, min_size=0):
+    """Описанный прямоугольник многоугольника, обрезанный по границам изображения.
+
+    min_size - наименьшая ширина и высота; при вычислении это 1: на уменьшенной
+    копии для превью тонкий многоугольник у края может округлиться за границу.
+    """
+    x, y, w, h = cv2.boundingRect(np.array(points, dtype=np.int32))
+    x0, y0 = min(max(x, 0), width - min_size), min(max(y, 0), height - min_size)
+    x1, y1 = max(min(x + w, width), x0 + min_size), max(min(y + h, height), y0 + min_size)
+    return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+
+def _feather_kernel(feather):
+    """Ядро гауссова размытия маски: sigma = feather / 3, ядро до 3 sigma, то есть радиус feather."""
+    return 2 * feather + 1, feather / 3.0
+
+
+def freeform_mask(points, x, y, width, height, feather=0):
+    """Маска многоугольника в прямоугольнике (x, y, width, height): 255 внутри, 0 снаружи.
+
+    Растр строится только в этом прямоугольнике (плюс поле на размытие), а не по
+    всему кадру, так что цена зависит от размера вырезки и числа вершин.
+    """
+    # За краем прямоугольника многоугольник продолжается - поле нужно, чтобы
+    # размытие видело настоящую границу, а не отражение её внутренней части
+    pad = feather
+    mask = np.zeros((height + 2 * pad, width + 2 * pad), dtype=np.uint8)
+    shifted = np.asarray(points, dtype=np.int32) - np.array([x - pad, y - pad], dtype=np.int32)
+    cv2.fillPoly(mask, [shifted], 255)
+    if feather:
+        ksize, sigma = _feather_kernel(feather)
+        cv2.GaussianBlur(mask, (ksize, ksize), sigma, dst=mask, borderType=cv2.BORDER_CONSTANT)
+    return mask[pad:pad + height, pad:pad + width]
+
+
+def _apply_freeform_crop(image, op, in_place=False):
+    height, width, channels = image.shape
+    x, y, w, h = freeform_bounds(op["points"], width, height, min_size=1)
+    mask = freeform_mask(op["points"], x, y, w, h, op.get("feather", 0))
+    region = image[y:y + h, x:x + w]
+
+    if op.get("alpha") or channels == 4:
+        # Цвет остаётся как есть, маска уходит в прозрачность (и умножается на уже имеющуюся)
+        out = tiles.allocate((h, w, 4), image.dtype)
+        if channels == 4:
+            mask = cv2.multiply(np.ascontiguousarray(region[..., 3]), mask, scale=1.0 / 255)
+        out[..., 3] = mask
+        # Полностью прозрачные пиксели обнуляем: PNG и WebP сжимают их почти даром
+        out[..., :3] = 0
+        np.copyto(out[..., :3], region[..., :3], where=mask[..., None] > 0)
+        return out
+
+    # Чёрная заливка снаружи; на мягком краю цвет плавно уходит в чёрный
+    out = tiles.allocate(region.shape, image.dtype)
+    if op.get("feather"):
+        return cv2.multiply(region, cv2.merge([mask] * channels), dst=out, scale=1.0 / 255)
+    out[...] = 0
+    return cv2.copyTo(region, mask, out)
+
+
+_FILTERS = {
+    "blur": _apply_blur,
+    "add_noise": _apply_noise,
+    "crop_freeform": _apply_freeform_crop,
+}
+
+
+# --- Вычисление ------------------------------------------------------------
+
+def _ends_segment(op):
+    # После вырезки следующая геометрия не должна видеть отрезанное: поворот и
+    # интерполяция у краёв иначе брали бы пиксели из-за границы вырезки
+    return op["op"] == "crop"
+
+
+def segments(ops):
+    """Делит список на участки, которые вычисляются за один проход: [(kind, start, end)]."""
+    result = []
+    for index, op in enumerate(ops):
+        kind = op_kind(op)
+        if result and kind != "filter" and result[-1][0] == kind and not _ends_segment(ops[result[-1][2] - 1]):
+            result[-1] = (kind, result[-1][1], index + 1)
+        else:
+            result.append((kind, index, index + 1))
+    return result
+
+
+def apply_segment(image, kind, ops, in_place=False):
+    """in_place=True разрешает записать результат прямо в image, если операция это умеет."""
+    if kind == "geometric":
+        return _apply_geometric(image, ops)
+    if kind == "tone":
+        return _apply_tone(image, ops, in_place)
+    return _FILTERS[ops[0]["op"]](image, ops[0], in_place)
+
+
+def render(source, ops, cache=None, cache_prefix=(), keyframes=None, keyframe_interval=0,
+           shared=None, shared_prefix=None):
+    """Вычисляет список операций над source.
+
+    cache - хранилище с методами get(key)/put(key, image, dirty=False), обычно
+    WorkingImageStore. В нём запоминается результат и вход последнего участка:
+    следующая правка того же вида пересчитает только последний склеенный участок.
+    keyframes - хранилище полных кадров истории (history.KeyframeCache): кадр
+    сохраняется на границе участка примерно каждые keyframe_interval операций,
+    и при отмене правок вычисление начинается с ближайшего кадра.
+    shared - общий для всех сессий кеш на диске (result_cache.ResultCache),
+    shared_prefix - (result_cache.content_hash(source),); без него общий кеш не
+    используется. Туда пишется только итоговый результат (крупные и
+    отображённые из файла кеш пропускает), а искать в нём можно с любой
+    границы участков.
+    Возвращённый массив может быть общим с кешем - менять его на месте нельзя.
+    """
+    parts = segments(ops)
+    image = source
+    owned = False  # image создан этим вычислением и больше нигде не хранится
+    start = 0
+    if shared_prefix is None:
+        shared = None
+    if cache is not None or keyframes is not None or shared is not None:
+        for index in range(len(parts), 0, -1):
+            digest = ops_digest(ops[:parts[index - 1][2]])
+            key = cache_prefix + (digest,)
+            cached = cache.get(key) if cache is not None else None
+            if cached is None and keyframes is not None:
+                cached = keyframes.get(key)
+            if cached is None and shared is not None:
+                cached = shared.get(shared_prefix + (digest,))
+                if cached is not None and cache is not None:
+                    cache.put(key, cached, dirty=False)
+            if cached is not None:
+                image, start = cached, index
+                break
+
+    for index in range(start, len(parts)):
+        kind, begin, end = parts[index]
+        is_last = index == len(parts) - 1
+        if cache is not None and is_last and index > 0 and index != start:
+            cache.put(cache_prefix + (ops_digest(ops[:begin]),), image, dirty=False)
+            owned = False
+        tiles.check_cancelled()  # фоновая задача могла устареть, пока считался прошлый участок
+        image = apply_segment(image, kind, ops[begin:end], in_place=owned)
+        owned = True
+        if cache is not None and is_last:
+            cache.put(cache_prefix + (ops_digest(ops[:end]),), image, dirty=False)
+            owned = False
+        if shared is not None and is_last:
+            shared.put(shared_prefix + (ops_digest(ops[:end]),), image)
+        # Кадр - на первой границе участков после очередного кратного interval шага
+        if keyframes is not None and keyframe_interval and end // keyframe_interval > begin // keyframe_interval:
+            keyframes.put(cache_prefix + (ops_digest(ops[:end]),), image)
+            owned = False
+    return image
@@ -0,0 +1,98 @@
+# Кодирование результата в файл выбранного формата прямо в память (cv2.imencode).
+# Изображение с прозрачностью (BGRA после произвольной вырезки) в форматы без
+# альфа-канала кладётся на белый фон, иначе JPEG показал бы спрятанные пиксели.
+
+import cv2
+import numpy as np
+
+import tiles
+
+
+# формат -> (расширение для cv2.imencode, MIME-тип)
+EXPORT_FORMATS = {
+    "jpeg": (".jpeg", "image/jpeg"),
+    "png": (".png", "image/png"),
+    "tiff": (".tiff", "image/tiff"),
+    "webp": (".webp", "image/webp"),
+}
+
+# AVIF есть не во всех сборках OpenCV
+if hasattr(cv2, "IMWRITE_AVIF_QUALITY") and cv2.haveImageWriter(".avif"):
+    EXPORT_FORMATS["avif"] = (".avif", "image/avif")
+
+# Форматы, которые сохраняют альфа-канал
+ALPHA_FORMATS = {"png", "tiff", "webp", "avif"}
+BACKGROUND = (255, 255, 255)
+
+DEFAULT_QUALITY = {"jpeg": 95, "webp": 90, "avif": 80}
+DEFAULT_PNG_COMPRESSION = 3  # как у OpenCV по умолчанию
+
+
+def normalize_options(format, quality=None, compression=None):
+    """Приводит параметры к каноническому виду: (format, quality, compression).
+
+    Незначащие для формата параметры обнуляются, чтобы одинаковые файлы
+    имели одинаковый ключ в кеше.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Неподдерживаемый формат: {format}")
+    if format in DEFAULT_QUALITY:
+        quality = DEFAULT_QUALITY[format] if quality in (None, "") else int(quality)
+        if not 1 <= quality <= 100:
+            raise ValueError("Качество должно быть от 1 до 100")
+    else:
+        quality = None
+    if format == "png":
+        compression = DEFAULT_PNG_COMPRESSION if compression in (None, "") else int(compression)
+        if not 0 <= compression <= 9:
+            raise ValueError("Степень сжатия PNG должна быть от 0 до 9")
+    else:
+        compression = None
+    return format, quality, compression
+
+
+def encode_params(format, quality=None, compression=None):
+    if format == "jpeg":
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    if format == "avif":
+        return [cv2.IMWRITE_AVIF_QUALITY, quality]
+    if format == "png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    return []
+
+
+def _flatten_tile(tile, background):
+    alpha = tile[..., 3:].astype(np.float32)
+    alpha *= 1.0 / 255
+    color = tile[..., :3].astype(np.float32)
+    color -= background
+    color *= alpha
+    color += background
+    return np.rint(color).astype(np.uint8)
+
+
+def flatten(image, background=BACKGROUND):
+    """BGRA -> BGR наложением на сплошной фон; остальные изображения возвращает как есть."""
+    if image.ndim != 3 or image.shape[2] != 4:
+        return image
+    background = np.array(background, dtype=np.float32)
+    out = tiles.allocate(image.shape[:2] + (3,), image.dtype)
+    return tiles.run_tiled(image, lambda tile, y, x: _flatten_tile(tile, background), out=out)
+
+
+def encode_buffer(image, format, quality=None, compression=None):
+    """Кодирует изображение и возвращает массив uint8 с содержимым файла."""
+    format, quality, compression = normalize_options(format, quality, compression)
+    if format not in ALPHA_FORMATS:
+        image = flatten(image)
+    ok, buffer = cv2.imencode(EXPORT_FORMATS[format][0], image, encode_params(format, quality, compression))
+    if not ok:
+        raise ValueError(f"Не удалось закодировать изображение в {format}")
+    return buffer
+
+
+def encode_image(image, format, quality=None, compression=None):
+    """Возвращает закодированный файл в виде bytes."""
+    return encode_buffer(image, format, quality, compression).tobytes()
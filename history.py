@@ -0,0 +1,119 @@
+# История правок для отмены и повтора.
+# Сама история - это список операций в state.json и позиция курсора в нём
+# (state["position"]): отмена и повтор только двигают курсор, пиксели не копируются.
+# Чтобы отмена на много шагов назад не пересчитывала всё с исходника, примерно
+# каждые interval операций запоминается полный кадр (keyframe). Кадры лежат в
+# памяти (в WorkingImageStore) и сжатыми PNG в папке history пространства.
+# На каждое пространство действуют лимиты по памяти и по диску; самые старые
+# кадры вытесняются, а их операции остаются - их просто придётся пересчитать.
+
+from collections import OrderedDict
+import os
+import threading
+
+import cv2
+
+from image_store import resident_nbytes
+
+
+HISTORY_DIR = "history"
+
+# Кадры в памяти по пространствам: {id пространства: OrderedDict(ключ -> байты)}
+_memory_keyframes = {}
+_memory_lock = threading.Lock()
+
+
+def forget(workspace_id):
+    with _memory_lock:
+        _memory_keyframes.pop(workspace_id, None)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class KeyframeCache:
+    """Кадры одного пространства. Передаётся в edit_pipeline.render(keyframes=...)."""
+
+    def __init__(self, workspace, store, max_memory_bytes, max_disk_bytes):
+        self.workspace = workspace
+        self.store = store
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = workspace.file(HISTORY_DIR)
+
+    def _store_key(self, key):
+        # Кадры лежат в том же WorkingImageStore, что и кеш вычисления с теми же
+        # ключами; без своей метки вытеснение кадров выбрасывало бы и его записи.
+        # id пространства остаётся первым - по нему пространство чистится целиком
+        return (key[0], "keyframe") + tuple(key[1:])
+
+    def _path(self, key):
+        # key = (id пространства, id исходника, ..., отпечаток операций)
+        return os.path.join(self.directory, "_".join(str(part) for part in key[1:]) + ".png")
+
+    def get(self, key):
+        image = self.store.get(self._store_key(key))
+        if image is not None:
+            return image
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if image is not None:
+            self._remember(key, image)
+        return image
+
+    def put(self, key, image):
+        self._remember(key, image)
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        # Кадры пишем быстро и без потерь: степень сжатия 1
+        ok, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.tobytes())
+        os.replace(tmp_path, path)
+        self._trim_disk()
+
+    def _remember(self, key, image):
+        key = self._store_key(key)
+        self.store.put(key, image, dirty=False)
+        with _memory_lock:
+            keyframes = _memory_keyframes.setdefault(self.workspace.id, OrderedDict())
+            keyframes.pop(key, None)
+            keyframes[key] = resident_nbytes(image)  # отображённые кадры лежат на диске
+            total = sum(keyframes.values())
+            while total > self.max_memory_bytes and len(keyframes) > 1:
+                old_key, size = keyframes.popitem(last=False)
+                self.store.discard(old_key)
+                total -= size
+
+    def _trim_disk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".png"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # кадр уже удалён (clear или другой процесс)
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            _remove(path)
+            total -= size
+
+    def clear(self):
+        forget(self.workspace.id)
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                _remove(os.path.join(self.directory, name))
@@ -0,0 +1,207 @@
+# Хранилище рабочих изображений в памяти.
+# Держит декодированные массивы NumPy, чтобы маршруты редактора не делали
+# cv2.imread/cv2.imwrite на каждый клик. Объём ограничен бюджетом в байтах,
+# при переполнении вытесняются давно не использованные записи (LRU).
+# "Грязные" записи перед вытеснением сохраняются на диск (checkpoint),
+# поэтому правки не теряются.
+# Очень большие изображения в память целиком не читаются: .npy от
+# mapped_min_bytes байт открывается через numpy.memmap только для чтения, и
+# страницы подгружает и вытесняет ОС. Такие записи занимают диск, а не память,
+# и учитываются отдельно - в mapped_budget_bytes.
+
+from collections import OrderedDict
+import math
+import os
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+
+def read_image(path, mapped_min_bytes=None):
+    """Читает изображение: .npy - уже декодированный массив, остальное - через cv2.
+
+    .npy от mapped_min_bytes байт не читается, а отображается в память только для чтения.
+    """
+    if path.endswith(".npy"):
+        try:
+            image = np.load(path, mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        if mapped_min_bytes is None or image.nbytes < mapped_min_bytes:
+            image = np.array(image)
+        return image
+    return cv2.imread(path, cv2.IMREAD_COLOR)
+
+
+def is_mapped(image):
+    return isinstance(image, np.memmap)
+
+
+def resident_nbytes(image):
+    """Сколько байт изображение занимает в памяти процесса; у отображённых - 0."""
+    return 0 if is_mapped(image) else image.nbytes
+
+
+def mapped_allocator(directory, min_bytes):
+    """Выделитель для tiles.use_allocator: массивы от min_bytes - в файле в directory."""
+    def allocate(shape, dtype):
+        dtype = np.dtype(dtype)
+        if math.prod(shape) * dtype.itemsize < min_bytes:
+            return np.empty(shape, dtype)
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".raw", dir=directory)
+        os.close(fd)
+        image = np.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+        try:
+            # Отображение остаётся, пока жив массив, а файл исчезнет вместе с ним
+            os.remove(path)
+        except OSError:
+            pass  # Windows не даёт удалить отображённый файл - его уберёт очистка пространства
+        return image
+    return allocate
+
+
+def write_image(path, image):
+    """Записывает изображение; .npy пишется атомарно через временный файл."""
+    if not path.endswith(".npy"):
+        return cv2.imwrite(path, image)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, image, allow_pickle=False)
+    os.replace(tmp_path, path)
+    return True
+
+
+class _Entry:
+    __slots__ = ("image", "path", "dirty", "mapped")
+
+    def __init__(self, image, path, dirty):
+        self.image = image
+        self.path = path
+        self.dirty = dirty
+        self.mapped = is_mapped(image)
+
+
+class WorkingImageStore:
+    def __init__(self, budget_bytes, mapped_budget_bytes=None, mapped_min_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.mapped_budget_bytes = mapped_budget_bytes  # None - отображённые записи не ограничены
+        self.mapped_min_bytes = mapped_min_bytes  # None - всегда читать в память
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._mapped_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.checkpoints = 0
+
+    def get(self, key):
+        """Возвращает изображение из памяти или None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.image
+
+    def load(self, key, path=None):
+        """Возвращает изображение, при промахе декодирует его с диска."""
+        image = self.get(key)
+        if image is not None:
+            return image
+        path = path or key
+        image = read_image(path, self.mapped_min_bytes)
+        if image is None:
+            return None
+        self.put(key, image, path=path, dirty=False)
+        return image
+
+    def put(self, key, image, path=None, dirty=True):
+        """Кладёт изображение в хранилище. path - куда сохранять при checkpoint."""
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._remove(key)
+                if path is None:
+                    path = old.path
+            entry = _Entry(image, path or key, dirty)
+            self._entries[key] = entry
+            if entry.mapped:
+                self._mapped_bytes += image.nbytes
+            else:
+                self._bytes += image.nbytes
+            self._evict(keep=key)
+
+    def checkpoint(self, key, path=None):
+        """Сохраняет изображение на диск, если оно менялось. Возвращает путь."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if path is not None and path != entry.path:
+                entry.path = path
+                entry.dirty = True
+            if entry.dirty:
+                self._write(entry)
+            return entry.path
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def discard_if(self, predicate):
+        """Удаляет все записи, ключ которых удовлетворяет predicate."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self._bytes,
+                "mapped_budget_bytes": self.mapped_budget_bytes,
+                "mapped_bytes": self._mapped_bytes,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "checkpoints": self.checkpoints,
+            }
+
+    def _write(self, entry):
+        if not write_image(entry.path, entry.image):
+            raise IOError(f"Не удалось сохранить изображение: {entry.path}")
+        entry.dirty = False
+        self.checkpoints += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if entry.mapped:
+            self._mapped_bytes -= entry.image.nbytes
+        else:
+            self._bytes -= entry.image.nbytes
+
+    def _over_budget(self, mapped):
+        if mapped:
+            return self.mapped_budget_bytes is not None and self._mapped_bytes > self.mapped_budget_bytes
+        return self._bytes > self.budget_bytes
+
+    def _evict(self, keep):
+        # Самую свежую запись не вытесняем, даже если она одна больше бюджета
+        for key in list(self._entries):
+            if not (self._over_budget(False) or self._over_budget(True)):
+                break
+            entry = self._entries[key]
+            if key == keep or not self._over_budget(entry.mapped):
+                continue
+            if entry.dirty:
+                self._write(entry)
+            self._remove(key)
+            self.evictions += 1
@@ -0,0 +1,168 @@
+# Приём загруженных изображений.
+# Загрузка пишется на диск потоком, затем формат и размер определяются по
+# заголовку файла, без декодирования пикселей, и слишком большие изображения
+# отклоняются до того, как на них потрачена память. Формат берётся из
+# содержимого файла, а не из расширения, которое прислал клиент.
+# Дальше исходник один раз декодируется в 8-битный BGR (cv2.IMREAD_COLOR
+# приводит 16 бит и оттенки серого к 8-битным трём каналам и поворачивает по
+# EXIF) и хранится как .npy - последующие чтения обходятся без декодирования.
+# У JPEG превью можно получить сразу уменьшенным декодированием
+# (cv2.IMREAD_REDUCED_COLOR_*: libjpeg масштабирует на этапе DCT, это в разы
+# быстрее полного декодирования), а полное декодирование отложить.
+
+from collections import namedtuple
+import math
+import struct
+
+import cv2
+
+
+# Больше пикселей не принимаем. Исходники от MAPPED_IMAGE_BYTES (app.py) после
+# декодирования отображаются из .npy, так что панорамы и сканы больше 100 Мп
+# держат в памяти только превью; полное декодирование всё же проходит через
+# память один раз. Предел чуть ниже встроенного в OpenCV (2^30 пикселей)
+MAX_PIXELS = 1_000_000_000
+MAX_SIDE = 65500  # и стороны длиннее (у JPEG сторона не больше 65535)
+
+# формат -> расширение, под которым храним загруженный файл до перевода в .npy
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "bmp": ".bmp", "tiff": ".tiff", "webp": ".webp"}
+
+# orientation - значение тега EXIF Orientation (1 - без поворота), известно только для JPEG
+ImageInfo = namedtuple("ImageInfo", "format width height orientation")
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _exif_orientation(tiff):
+    try:
+        order = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        offset = struct.unpack(order + "I", tiff[4:8])[0]
+        count = struct.unpack(order + "H", tiff[offset:offset + 2])[0]
+        for index in range(count):
+            entry = tiff[offset + 2 + 12 * index:offset + 14 + 12 * index]
+            tag = struct.unpack(order + "H", entry[:2])[0]
+            if tag == 0x0112:
+                value = struct.unpack(order + "H", entry[8:10])[0]
+                return value if 1 <= value <= 8 else 1
+    except (KeyError, struct.error):
+        pass
+    return 1
+
+
+def _jpeg_info(f):
+    # Идём по маркерам до SOF; по дороге читаем ориентацию из APP1 (Exif)
+    orientation = 1
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            continue  # маркеры без длины
+        if code in (0xD9, 0xDA):
+            return None  # данные начались, а размера так и не было
+        length = struct.unpack(">H", f.read(2))[0]
+        segment = f.read(length - 2)
+        if code == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            orientation = _exif_orientation(segment[6:])
+        elif code in _JPEG_SOF:
+            height, width = struct.unpack(">HH", segment[1:5])
+            return ImageInfo("jpeg", width, height, orientation)
+
+
+def _tiff_info(f, order):
+    f.seek(4)
+    offset = struct.unpack(order + "I", f.read(4))[0]
+    f.seek(offset)
+    count = struct.unpack(order + "H", f.read(2))[0]
+    entries = f.read(12 * count)
+    values = {}
+    for index in range(count):
+        tag, kind = struct.unpack(order + "HH", entries[12 * index:12 * index + 4])
+        if tag in (256, 257):  # ImageWidth, ImageLength
+            field = entries[12 * index + 8:12 * index + 12]
+            values[tag] = struct.unpack(order + ("H" if kind == 3 else "I"), field[:2 if kind == 3 else 4])[0]
+    if 256 not in values or 257 not in values:
+        return None
+    return ImageInfo("tiff", values[256], values[257], 1)
+
+
+def inspect(path):
+    """Формат и размер изображения по заголовку файла. ValueError, если файл не изображение."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(32)
+            info = None
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", head[16:24])
+                info = ImageInfo("png", width, height, 1)
+            elif head.startswith(b"\xff\xd8"):
+                info = _jpeg_info(f)
+            elif head.startswith(b"BM"):
+                if struct.unpack("<I", head[14:18])[0] == 12:  # старый заголовок OS/2
+                    width, height = struct.unpack("<HH", head[18:22])
+                else:
+                    width, height = struct.unpack("<ii", head[18:26])
+                info = ImageInfo("bmp", width, abs(height), 1)
+            elif head[:4] in (b"II*\x00", b"MM\x00*"):
+                info = _tiff_info(f, "<" if head[:2] == b"II" else ">")
+            elif head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+                chunk = head[12:16]
+                if chunk == b"VP8 ":
+                    width, height = struct.unpack("<HH", head[26:30])
+                    info = ImageInfo("webp", width & 0x3FFF, height & 0x3FFF, 1)
+                elif chunk == b"VP8L":
+                    bits = struct.unpack("<I", head[21:25])[0]
+                    info = ImageInfo("webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 1)
+                elif chunk == b"VP8X":
+                    info = ImageInfo("webp", int.from_bytes(head[24:27], "little") + 1,
+                                     int.from_bytes(head[27:30], "little") + 1, 1)
+    except (OSError, struct.error):
+        info = None
+    if info is None or info.width <= 0 or info.height <= 0:
+        raise ValueError("Файл не является изображением поддерживаемого формата!")
+    return info
+
+
+def check_limits(info, max_pixels=MAX_PIXELS, max_side=MAX_SIDE):
+    if max(info.width, info.height) > max_side:
+        raise ValueError(f"Изображение слишком большое: сторона больше {max_side} пикселей!")
+    if info.width * info.height > max_pixels:
+        raise ValueError(f"Изображение слишком большое: больше {max_pixels // 1_000_000} Мп!")
+
+
+def oriented_size(info):
+    """Размер (ширина, высота) после поворота по EXIF."""
+    if info.orientation in (5, 6, 7, 8):  # повороты на 90 и 270 градусов
+        return info.height, info.width
+    return info.width, info.height
+
+
+def read_reduced(path, info, size):
+    """Превью размера size=(ширина, высота) из уменьшенного декодирования JPEG.
+
+    Возвращает None, если уменьшать нечего или результат не сошёлся с заголовком -
+    тогда превью нужно строить по полному изображению.
+    """
+    if info.format != "jpeg":
+        return None
+    width, height = oriented_size(info)
+    for factor, flag in _REDUCED_FLAGS:
+        # libjpeg округляет размер вверх; уменьшенное должно быть не меньше превью
+        if math.ceil(width / factor) >= size[0] and math.ceil(height / factor) >= size[1]:
+            break
+    else:
+        return None
+    image = cv2.imread(path, flag)
+    if image is None or image.shape[:2] != (math.ceil(height / factor), math.ceil(width / factor)):
+        return None
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
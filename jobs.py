@@ -0,0 +1,181 @@
+# Очередь фоновых задач для долгих вычислений (полное разрешение при скачивании).
+# Задачи выполняются в ограниченном пуле потоков. Очереди у каждого владельца
+# (рабочего пространства сессии) свои, и свободный поток берёт задачи из них
+# по кругу, поэтому одна сессия с десятком тяжёлых задач не задерживает
+# остальные; одновременно у владельца выполняется не больше per_owner задач.
+# Задача с тем же ключом, что уже стоит в очереди или выполнена, не создаётся
+# заново - возвращается существующая. Отмена кооперативная: задача проверяет
+# флаг между плитками и участками вычисления (см. tiles.cancel_check).
+
+from collections import OrderedDict, deque
+import secrets
+import threading
+import time
+
+import tiles
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, owner, key, func, version=None):
+        self.id = secrets.token_hex(8)
+        self.owner = owner
+        self.key = key
+        self.version = version  # версия состояния, для которой считается задача
+        self.func = func
+        self.status = "queued"  # queued, running, done, error, cancelled
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    def check(self):
+        """Вызывается из задачи: прерывает её, если задачу отменили."""
+        if self._cancel.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "queued_for": (self.started or self.finished or time.time()) - self.created,
+            "run_time": (self.finished or time.time()) - self.started if self.started else None,
+        }
+
+
+class JobQueue:
+    def __init__(self, workers, per_owner=1, ttl_seconds=600):
+        self.workers = workers
+        self.per_owner = per_owner
+        self.ttl_seconds = ttl_seconds  # сколько помнить завершённые задачи
+        self._condition = threading.Condition()
+        self._queues = OrderedDict()  # владелец -> deque задач, порядок - очередь обхода
+        self._running = {}  # владелец -> сколько задач выполняется
+        self._jobs = {}  # id -> задача
+        self._by_key = {}  # ключ -> задача, для склейки одинаковых задач
+        self._threads = []
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"job-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, owner, key, func, version=None):
+        """Ставит func(job) в очередь владельца owner или возвращает задачу с тем же ключом."""
+        with self._condition:
+            self._collect_garbage()
+            job = self._by_key.get(key)
+            if job is not None and job.status not in ("error", "cancelled"):
+                return job
+            job = Job(owner, key, func, version)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            self._queues.setdefault(owner, deque()).append(job)
+            self._start_workers()
+            self._condition.notify()
+            return job
+
+    def get(self, job_id):
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job):
+        with self._condition:
+            self._cancel(job)
+
+    def cancel_owner(self, owner, before_version):
+        """Отменяет задачи владельца, посчитанные для версий старше before_version."""
+        with self._condition:
+            for job in list(self._jobs.values()):
+                if job.owner == owner and job.version is not None and job.version < before_version:
+                    self._cancel(job)
+
+    def _cancel(self, job):
+        if job.status == "queued":
+            queue = self._queues.get(job.owner)
+            if queue is not None and job in queue:
+                queue.remove(job)
+            self._finish(job, "cancelled")
+        elif job.status == "running":
+            job._cancel.set()
+
+    def _finish(self, job, status, result=None, error=None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        job.func = None
+        if status in ("error", "cancelled") and self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+        job._done.set()
+
+    def _next_job(self):
+        # По кругу: владелец, у которого взяли задачу, уходит в конец очереди обхода
+        for owner in list(self._queues):
+            queue = self._queues[owner]
+            if not queue:
+                del self._queues[owner]
+                continue
+            if self._running.get(owner, 0) >= self.per_owner:
+                continue
+            job = queue.popleft()
+            self._queues.move_to_end(owner)
+            return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                self._running[job.owner] = self._running.get(job.owner, 0) + 1
+                job.status = "running"
+                job.started = time.time()
+                func = job.func
+
+            status, result, error = "done", None, None
+            try:
+                with tiles.cancel_check(job.check):
+                    result = func(job)
+            except Cancelled:
+                status = "cancelled"
+            except Exception as e:
+                status, error = "error", str(e)
+
+            with self._condition:
+                self._running[job.owner] -= 1
+                if not self._running[job.owner]:
+                    del self._running[job.owner]
+                self._finish(job, status, result, error)
+                # освободилось место у владельца - его задачи снова можно брать
+                self._condition.notify_all()
+
+    def _collect_garbage(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.ttl_seconds:
+                del self._jobs[job_id]
+                if self._by_key.get(job.key) is job:
+                    del self._by_key[job.key]
+
+    def stats(self):
+        with self._condition:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job.status] = statuses.get(job.status, 0) + 1
+            return {"workers": self.workers, "per_owner": self.per_owner,
+                    "queued_owners": len(self._queues), "jobs": statuses}
@@ -0,0 +1,274 @@
+# Метрики и профилирование запросов.
+# Время каждого запроса делится на этапы: read (загрузка и чтение изображений),
+# compute (вычисление правок), write (кодирование и запись файлов) и render
+# (шаблоны). Этап отмечается блоком with metrics.stage("compute"): время идёт
+# в гистограмму этапа и в заголовок Server-Timing текущего запроса.
+# Метрики отдаются в текстовом формате Prometheus (см. Registry.expose), без
+# сторонних библиотек. Счётчики кешей и очередей собираются в момент запроса
+# метрик функциями, зарегистрированными через Registry.collector.
+# SamplingProfiler - выборочный профилировщик: фоновый поток раз в interval
+# секунд снимает стеки потоков, которые сейчас обслуживают запросы, и копит
+# их по маршрутам в формате folded stacks (строка "f1;f2;f3 число"), который
+# понимают flamegraph.pl и speedscope.
+
+from contextlib import contextmanager
+import contextvars
+import os
+import sys
+import threading
+import time
+
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Замеры текущего запроса или фоновой задачи: (маршрут, {этап: секунды}) или None
+_scope = contextvars.ContextVar("metrics_scope", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # метки -> [счётчики корзин..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, data in sorted(self._values.items()):
+                for index, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', bound)])} {data[index]}")
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, [('le', '+Inf')])} {data[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {data[-2]:.6f}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {data[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """func() -> [(имя, тип, справка, {метки}, значение)] вызывается при каждом expose."""
+        self._collectors.append(func)
+        return func
+
+    def expose(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        rows = [row for collect in self._collectors for row in collect()]
+        # Строки одной метрики должны идти подряд, даже если их вернули разные сборщики
+        rows.sort(key=lambda row: row[0])
+        described = set()
+        for name, kind, help, labels, value in rows:
+            if name not in described:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+request_duration = registry.histogram(
+    "photoeditor_request_duration_seconds", "Время обработки запроса", ("route", "method", "status"))
+stage_duration = registry.histogram(
+    "photoeditor_stage_duration_seconds", "Время этапа обработки", ("route", "stage"))
+bytes_total = registry.counter(
+    "photoeditor_bytes_total", "Байты, принятые в запросах и отданные в ответах", ("direction",))
+pixels_total = registry.counter(
+    "photoeditor_pixels_total", "Обработанные пиксели по этапам", ("route", "stage"))
+
+
+def begin(route):
+    """Начинает замеры для route (запроса или задачи). Возвращает (токен для end, {этап: секунды})."""
+    timings = {}
+    return _scope.set((route, timings)), timings
+
+
+def end(token):
+    _scope.reset(token)
+
+
+@contextmanager
+def scope(route):
+    """То же, что begin/end, блоком with."""
+    token, timings = begin(route)
+    try:
+        yield timings
+    finally:
+        end(token)
+
+
+def current_route():
+    current = _scope.get()
+    return current[0] if current is not None else "none"
+
+
+@contextmanager
+def stage(name):
+    """Засекает этап name текущего запроса. Вложенные этапы не вычитаются из внешних."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        current = _scope.get()
+        route = "none"
+        if current is not None:
+            route, timings = current
+            timings[name] = timings.get(name, 0.0) + elapsed
+        stage_duration.observe(elapsed, route, name)
+
+
+def count_pixels(stage_name, image):
+    """Добавляет к счётчику пиксели изображения image, обработанные на этапе stage_name."""
+    if image is not None:
+        pixels_total.inc(image.shape[0] * image.shape[1], current_route(), stage_name)
+
+
+def server_timing(timings, total):
+    """Значение заголовка Server-Timing: этапы и общее время в миллисекундах."""
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._threads = {}  # id потока -> маршрут, который он сейчас обслуживает
+        self._stacks = {}  # маршрут -> {свёрнутый стек: число выборок}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+
+    def enter(self, route):
+        """Поток начал обслуживать route; снимается только пока профилировщик запущен."""
+        self._threads[threading.get_ident()] = route
+
+    def leave(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def _fold(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            threads = dict(self._threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, route in threads.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stacks = self._stacks.setdefault(route, {})
+                    stack = self._fold(frame)
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def routes(self):
+        with self._lock:
+            return {route: sum(stacks.values()) for route, stacks in self._stacks.items()}
+
+    def folded(self, route=None):
+        """Выборки в формате folded stacks; route=None - все маршруты, маршрут первым кадром."""
+        with self._lock:
+            lines = []
+            for name, stacks in sorted(self._stacks.items()):
+                if route is not None and name != route:
+                    continue
+                for stack, count in sorted(stacks.items()):
+                    lines.append(f"{stack} {count}" if route is not None else f"{name};{stack} {count}")
+        return "\n".join(lines) + ("\n" if lines else "")
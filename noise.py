@@ -0,0 +1,89 @@
+# Генерация шума на numpy.random.Generator.
+# Шум считается полосами по BLOCK_ROWS строк: у каждой полосы свой генератор,
+# заведённый от (seed, номер полосы), поэтому результат не зависит от размера
+# плиток и числа потоков, а одинаковое зерно всегда даёт одинаковый шум.
+# Временные массивы создаются только на одну полосу, во float32, и
+# обрезаются до 0..255 на месте, так что тёмные пиксели не переполняются
+# через ноль в белые.
+#
+# amount у всех типов означает примерно одно и то же - силу шума от 0 до 1:
+#   gaussian    - аддитивный шум с sigma = amount * 255;
+#   salt_pepper - доля пикселей, ставших белыми или чёрными (поровну);
+#   poisson     - дробовой шум, на среднем сером его sigma тоже около amount * 255;
+#   speckle     - мультипликативный шум x + x * n, n ~ N(0, amount).
+
+import numpy as np
+
+import tiles
+
+
+NOISE_TYPES = ("gaussian", "salt_pepper", "poisson", "speckle")
+BLOCK_ROWS = 256
+SEED_LIMIT = 2 ** 32  # зерно - целое от 0 до SEED_LIMIT - 1; отрицательное генератор не принимает
+
+
+def _block_rng(seed, start_row):
+    return np.random.default_rng([seed, start_row // BLOCK_ROWS])
+
+
+def _to_uint8(values, out):
+    # values - временный float32, его можно портить
+    np.rint(values, out=values)
+    np.clip(values, 0, 255, out=values)
+    out[...] = values
+
+
+def _noise_block(block, start_row, noise_type, amount, seed):
+    if block.ndim == 3 and block.shape[2] == 4:
+        # Прозрачность не шумим; цвет получает тот же шум, что и без неё
+        out = np.empty_like(block)
+        out[..., :3] = _noise_block(block[..., :3], start_row, noise_type, amount, seed)
+        out[..., 3] = block[..., 3]
+        return out
+
+    rng = _block_rng(seed, start_row)
+    out = np.empty_like(block)
+
+    if noise_type == "salt_pepper":
+        # Одно равномерное число на пиксель: [0, p/2) - соль, [p/2, p) - перец
+        draw = rng.random(block.shape[:2], dtype=np.float32)
+        out[...] = block
+        out[draw < amount / 2] = 255
+        out[(draw >= amount / 2) & (draw < amount)] = 0
+        return out
+
+    values = block.astype(np.float32)
+    if noise_type == "gaussian":
+        noise = rng.standard_normal(block.shape, dtype=np.float32)
+        noise *= amount * 255
+        values += noise
+    elif noise_type == "speckle":
+        noise = rng.standard_normal(block.shape, dtype=np.float32)
+        noise *= amount
+        noise *= values
+        values += noise
+    elif noise_type == "poisson":
+        # y = Poisson(x * k) / k, k подобран так, что sigma на x = 128 равна amount * 255
+        scale = 128.0 / max(amount * 255.0, 1e-6) ** 2
+        values *= scale
+        values[...] = rng.poisson(values)
+        values /= scale
+    else:
+        raise ValueError(f"Неверный тип шума: {noise_type}")
+    _to_uint8(values, out)
+    return out
+
+
+def add_noise(image, noise_type, amount, seed, out=None):
+    """Возвращает копию image (uint8) с шумом. seed - целое зерно генератора.
+
+    out=image добавляет шум на месте: строки блока читаются до того, как переписываются.
+    """
+    if noise_type not in NOISE_TYPES:
+        raise ValueError(f"Неверный тип шума: {noise_type}")
+    return tiles.run_tiled(
+        image,
+        lambda block, y, x: _noise_block(block, y, noise_type, amount, seed),
+        tile_shape=(BLOCK_ROWS, image.shape[1]),
+        out=out,
+    )
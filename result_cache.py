@@ -0,0 +1,180 @@
+# Общий кеш результатов правок на диске.
+# Один и тот же исходник с теми же правками встречается у разных сессий и в
+# пакетной обработке: одинаковые загрузки, типовые уменьшения и размытия.
+# Результат адресуется содержимым: ключ - отпечаток пикселей входного
+# изображения (content_hash) и отпечаток списка операций с параметрами
+# (edit_pipeline.ops_digest). Сами пиксели промежуточных результатов не
+# хешируются: их адрес однозначно задают вход и операции до них.
+# Файлы .npy пишутся атомарно (временный файл + os.replace), поэтому кешем
+# могут одновременно пользоваться потоки и процессы приложения и воркеры
+# пакетов. Объём ограничен бюджетом на диске; при переполнении удаляются
+# файлы, к которым дольше всего не обращались (время изменения обновляется
+# при каждом попадании). Слишком большие результаты и отображённые из файла
+# (полное разрешение огромных изображений) в кеш не пишутся.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from image_store import is_mapped, read_image, write_image
+
+
+HASH_ROWS = 256  # сколько строк изображения хешируем за раз
+TRIM_RATIO = 0.9  # при переполнении чистим до этой доли бюджета, чтобы не чистить на каждой записи
+STALE_TMP_SECONDS = 60 * 60  # недописанные временные файлы старше этого удаляются при чистке
+RESCAN_SECONDS = 60  # как часто статистика пересчитывает занятое место (в папку пишут и другие процессы)
+
+
+def content_hash(image):
+    """Отпечаток пикселей изображения (вместе с размером и типом)."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((image.shape, image.dtype.str)).encode("ascii"))
+    # Полосами, чтобы не копировать целиком отображённые или несмежные массивы
+    for row in range(0, image.shape[0], HASH_ROWS):
+        digest.update(np.ascontiguousarray(image[row:row + HASH_ROWS]).data)
+    return digest.hexdigest()
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def shared(directory, budget_bytes, mapped_min_bytes=None, max_entry_bytes=None):
+    """Один экземпляр кеша на папку в процессе - так его передаём в воркеры пакетов."""
+    with _instances_lock:
+        cache = _instances.get(directory)
+        if cache is None:
+            cache = _instances[directory] = ResultCache(directory, budget_bytes, mapped_min_bytes, max_entry_bytes)
+        return cache
+
+
+class ResultCache:
+    """Передаётся в edit_pipeline.render(shared=...): ключ - кортеж, первый элемент - content_hash входа."""
+
+    def __init__(self, directory, budget_bytes, mapped_min_bytes=None, max_entry_bytes=None):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.mapped_min_bytes = mapped_min_bytes  # большие результаты читаются через отображение
+        self.max_entry_bytes = max_entry_bytes  # результаты крупнее не пишутся; None - без ограничения
+        self._bytes = None  # сколько занято на диске; None - ещё не считали
+        self._scanned = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.skipped = 0
+
+    def __reduce__(self):
+        # В процесс пула уходит только адрес папки, там берётся свой экземпляр
+        return shared, (self.directory, self.budget_bytes, self.mapped_min_bytes, self.max_entry_bytes)
+
+    def address(self, key):
+        data = json.dumps(list(key), ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, address):
+        # Две первые цифры - подпапка, чтобы в одной папке не копились сотни тысяч файлов
+        return os.path.join(self.directory, address[:2], address + ".npy")
+
+    def get(self, key):
+        path = self._path(self.address(key))
+        image = None
+        if os.path.exists(path):
+            # Файл могли удалить между проверкой и чтением - это обычный промах
+            image = read_image(path, self.mapped_min_bytes)
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path)  # отметка для LRU
+        except OSError:
+            pass
+        return image
+
+    def put(self, key, image):
+        # Отображённый массив (выделитель mapped_allocator) уже лежит в файле, а копия
+        # крупного результата - ещё одна полная запись на диск на каждое вычисление,
+        # которая к тому же вытесняет из бюджета десятки мелких результатов
+        if is_mapped(image) or (self.max_entry_bytes is not None and image.nbytes > self.max_entry_bytes):
+            with self._lock:
+                self.skipped += 1
+            return
+        path = self._path(self.address(key))
+        if os.path.exists(path):
+            return  # тот же адрес - те же пиксели
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_image(path, image)
+        with self._lock:
+            self.writes += 1
+            if self._bytes is not None:
+                self._bytes += os.path.getsize(path)
+            if self._bytes is None or self._bytes > self.budget_bytes:
+                self._trim()
+
+    def _scan(self):
+        files = []
+        now = time.time()
+        if not os.path.isdir(self.directory):
+            return files
+        for folder in os.scandir(self.directory):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # удалил другой процесс
+                if entry.name.endswith(".npy"):
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith(".tmp") and now - stat.st_mtime > STALE_TMP_SECONDS:
+                    self._remove(entry.path)
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _trim(self):
+        # Список файлов берём с диска: в ту же папку пишут и другие процессы
+        files = self._scan()
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        if total > self.budget_bytes:
+            for _, size, path in files:
+                if total <= self.budget_bytes * TRIM_RATIO:
+                    break
+                if self._remove(path):
+                    self.evictions += 1
+                total -= size
+        self._bytes = total
+        self._scanned = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._scan():
+                self._remove(path)
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            if self._bytes is None or time.monotonic() - self._scanned > RESCAN_SECONDS:
+                self._trim()
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "skipped": self.skipped,
+            }
@@ -0,0 +1,196 @@
+# Экспорт 3D-сцены в файл сетки (GLB, OBJ, STL, PLY) через trimesh.
+# Сцена приходит в том же JSON, что сохраняет и загружает редактор: тип объекта,
+# position, rotation в градусах (порядок XYZ, как у Three.js), scale и
+# userData.originalScale - исходные размеры геометрии.
+# Базовые примитивы строятся один раз на каждый (тип, число сегментов) и
+# кешируются. Объекты одного примитива преобразуются все сразу: матрицы
+# поворота и масштаба собираются массивом (K, 3, 3) и применяются к вершинам
+# примитива одним einsum, без цикла по объектам.
+
+from functools import lru_cache
+
+import numpy as np
+import trimesh
+
+
+# формат -> MIME-тип
+EXPORT_FORMATS = {
+    "glb": "model/gltf-binary",
+    "obj": "model/obj",
+    "stl": "model/stl",
+    "ply": "application/octet-stream",
+}
+
+# Число сегментов по умолчанию - как в конструкторах Three.js в 3d_editor.js
+DEFAULT_SEGMENTS = {
+    "cube": (),
+    "sphere": (32, 32),
+    "cylinder": (32,),
+    "cone": (32,),
+    "torus": (16, 100),
+    "plane": (),
+}
+# Сторона плоскости при originalScale 1 (addPlane в 3d_editor.js)
+PLANE_SIZE = 5.0
+MIN_SEGMENTS = 3
+MAX_SEGMENTS = 256
+
+# Three.js строит цилиндр и конус вдоль Y, trimesh - вдоль Z
+_Z_TO_Y = trimesh.transformations.rotation_matrix(-np.pi / 2, [1, 0, 0])
+
+
+@lru_cache(maxsize=64)
+def base_mesh(kind, segments):
+    """Вершины и грани примитива при originalScale 1: (vertices, faces), только для чтения."""
+    if kind == "cube":
+        mesh = trimesh.creation.box(extents=(1, 1, 1))
+    elif kind == "sphere":
+        mesh = trimesh.creation.uv_sphere(radius=0.5, count=list(segments))
+    elif kind == "cylinder":
+        mesh = trimesh.creation.cylinder(radius=0.5, height=1, sections=segments[0], transform=_Z_TO_Y)
+    elif kind == "cone":
+        # у trimesh основание конуса в z=0, у Three.js конус отцентрован
+        shift = trimesh.transformations.translation_matrix([0, 0, -0.5])
+        mesh = trimesh.creation.cone(radius=0.5, height=1, sections=segments[0], transform=_Z_TO_Y @ shift)
+    elif kind == "torus":
+        # большой радиус 0.5 и малый 0.2, в плоскости XY - как TorusGeometry(0.5, 0.2)
+        mesh = trimesh.creation.torus(0.5, 0.2, major_sections=segments[1], minor_sections=segments[0])
+    elif kind == "plane":
+        # плоскость в редакторе - PlaneGeometry(5, 5) при originalScale 1
+        half = PLANE_SIZE / 2
+        mesh = trimesh.Trimesh(
+            vertices=[[-half, -half, 0], [half, -half, 0], [half, half, 0], [-half, half, 0]],
+            faces=[[0, 1, 2], [0, 2, 3]],
+            process=False,
+        )
+    else:
+        raise ValueError(f"Неизвестный тип объекта: {kind}")
+    vertices = np.array(mesh.vertices, dtype=np.float64)
+    faces = np.array(mesh.faces, dtype=np.int64)
+    vertices.flags.writeable = False
+    faces.flags.writeable = False
+    return vertices, faces
+
+
+def _vector(data, name, default):
+    value = data.get(name) or {}
+    try:
+        return [float(value.get(axis, default)) for axis in ("x", "y", "z")]
+    except (AttributeError, TypeError, ValueError):
+        raise ValueError(f"Неверное значение {name}: {value}")
+
+
+def _segments(kind, value):
+    if value is None:
+        return DEFAULT_SEGMENTS[kind]
+    if isinstance(value, (int, float)):
+        value = [value] * len(DEFAULT_SEGMENTS[kind])
+    try:
+        segments = tuple(int(v) for v in value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Неверное число сегментов: {value}")
+    if len(segments) != len(DEFAULT_SEGMENTS[kind]):
+        raise ValueError(f"Для {kind} нужно сегментов: {len(DEFAULT_SEGMENTS[kind])}")
+    return tuple(min(max(v, MIN_SEGMENTS), MAX_SEGMENTS) for v in segments)
+
+
+def _geometry_scale(kind, original):
+    # Как loadScene в 3d_editor.js: сфера и тор задаются одним радиусом из x,
+    # у цилиндра и конуса радиус из x и высота из y, у плоскости ширина x и высота z
+    x, y, z = original
+    if kind in ("sphere", "torus"):
+        return [x, x, x]
+    if kind in ("cylinder", "cone"):
+        return [x, y, x]
+    if kind == "plane":
+        return [x, z, 1]
+    return [x, y, z]
+
+
+def _color(obj):
+    try:
+        color = int(obj.get("color", 0xcccccc))
+        opacity = float(obj.get("opacity", 1.0))
+    except (TypeError, ValueError):
+        raise ValueError("Неверный цвет объекта")
+    alpha = int(round(min(max(opacity, 0.0), 1.0) * 255))
+    return [(color >> 16) & 255, (color >> 8) & 255, color & 255, alpha]
+
+
+def _rotation_matrices(degrees):
+    """Матрицы поворота (K, 3, 3) для углов Эйлера (K, 3) в порядке XYZ Three.js."""
+    ax, ay, az = np.radians(degrees).T
+    ones, zeros = np.ones_like(ax), np.zeros_like(ax)
+
+    def stack(rows):
+        return np.stack([np.stack(row, axis=-1) for row in rows], axis=-2)
+
+    rx = stack([[ones, zeros, zeros], [zeros, np.cos(ax), -np.sin(ax)], [zeros, np.sin(ax), np.cos(ax)]])
+    ry = stack([[np.cos(ay), zeros, np.sin(ay)], [zeros, ones, zeros], [-np.sin(ay), zeros, np.cos(ay)]])
+    rz = stack([[np.cos(az), -np.sin(az), zeros], [np.sin(az), np.cos(az), zeros], [zeros, zeros, ones]])
+    return rx @ ry @ rz
+
+
+def build_mesh(objects):
+    """Собирает все объекты сцены в один trimesh.Trimesh с цветами вершин."""
+    if not isinstance(objects, list) or not objects:
+        raise ValueError("В сцене нет объектов")
+
+    # Объекты группируются по примитиву, чтобы преобразовать каждую группу разом
+    groups = {}
+    for obj in objects:
+        if not isinstance(obj, dict):
+            raise ValueError("Неверное описание объекта")
+        kind = obj.get("type")
+        if kind not in DEFAULT_SEGMENTS:
+            kind = "cube"  # как при загрузке сцены в редакторе
+        user_data = obj.get("userData") or {}
+        segments = _segments(kind, obj.get("segments", user_data.get("segments")))
+        original = _vector(user_data, "originalScale", 1.0)
+        scale = np.multiply(_geometry_scale(kind, original), _vector(obj, "scale", 1.0))
+        group = groups.setdefault((kind, segments), {"scale": [], "rotation": [], "position": [], "color": []})
+        group["scale"].append(scale)
+        group["rotation"].append(_vector(obj, "rotation", 0.0))
+        group["position"].append(_vector(obj, "position", 0.0))
+        group["color"].append(_color(obj))
+
+    all_vertices, all_faces, all_colors = [], [], []
+    offset = 0
+    for (kind, segments), group in groups.items():
+        vertices, faces = base_mesh(kind, segments)
+        count = len(group["scale"])
+        scale = np.array(group["scale"])
+        # M = R * S, затем сдвиг; вершины всей группы за одну операцию
+        matrices = _rotation_matrices(np.array(group["rotation"])) * scale[:, None, :]
+        placed = np.einsum("kij,nj->kni", matrices, vertices) + np.array(group["position"])[:, None, :]
+
+        group_faces = np.broadcast_to(faces, (count,) + faces.shape).copy()
+        # Отражение (отрицательный масштаб) выворачивает грани - меняем обход
+        mirrored = np.prod(np.sign(scale), axis=1) < 0
+        group_faces[mirrored] = group_faces[mirrored][:, :, ::-1]
+        group_faces += (offset + np.arange(count) * len(vertices))[:, None, None]
+
+        all_vertices.append(placed.reshape(-1, 3))
+        all_faces.append(group_faces.reshape(-1, 3))
+        # У каждого объекта свои вершины, так что цвет задаётся прямо по вершинам
+        all_colors.append(np.repeat(np.array(group["color"], dtype=np.uint8), len(vertices), axis=0))
+        offset += count * len(vertices)
+
+    return trimesh.Trimesh(
+        vertices=np.concatenate(all_vertices),
+        faces=np.concatenate(all_faces),
+        vertex_colors=np.concatenate(all_colors),
+        process=False,
+    )
+
+
+def export_scene(scene, format):
+    """Возвращает (содержимое файла в bytes, MIME-тип) для сцены в формате format."""
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Неподдерживаемый формат: {format}")
+    objects = scene.get("objects") if isinstance(scene, dict) else None
+    mesh = build_mesh(objects)
+    data = mesh.export(file_type=format)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return data, EXPORT_FORMATS[format]
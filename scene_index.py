@@ -0,0 +1,187 @@
+# Индекс сохранённых сцен в SQLite.
+# Для списка сцен нужны только имя, число объектов и размер сцены, поэтому
+# они хранятся в базе рядом с файлами сцен и обновляются при каждом
+# сохранении. Список читается из базы с постраничной выдачей, сортировкой и
+# поиском по имени и не открывает файлы сцен.
+# Файлы, положенные в папку в обход API (или удалённые вручную), подхватывает
+# reconcile(): он сравнивает время изменения и размер файлов с индексом и
+# перечитывает только то, что изменилось.
+
+from contextlib import closing
+import json
+import os
+import sqlite3
+import threading
+
+
+INDEX_NAME = "index.sqlite3"
+
+# параметр sort -> столбец
+SORT_COLUMNS = {
+    "created": "created",
+    "modified": "modified",
+    "name": "name_lower",
+    "objects_count": "objects_count",
+}
+
+DEFAULT_SCENE_SIZE = {"width": 10, "height": 10, "depth": 10}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    filename TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    name_lower TEXT NOT NULL,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    file_size INTEGER NOT NULL,
+    objects_count INTEGER NOT NULL,
+    scene_size TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scenes_created ON scenes (created);
+CREATE INDEX IF NOT EXISTS scenes_name ON scenes (name_lower);
+"""
+
+
+def read_json_scene(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def scene_metadata(filename, scene):
+    """Поля индекса из содержимого сцены - то же, что раньше читал list_scenes."""
+    name = scene.get("name") or os.path.splitext(filename)[0]
+    return {
+        "name": str(name),
+        "objects_count": len(scene.get("objects", [])),
+        "scene_size": scene.get("sceneSize", DEFAULT_SCENE_SIZE),
+    }
+
+
+class SceneIndex:
+    """Индекс файлов сцен с расширениями extensions; reader(path) читает сцену из файла."""
+
+    def __init__(self, folder, index_name=INDEX_NAME, extensions=(".json",), reader=read_json_scene):
+        self.folder = folder
+        self.path = os.path.join(folder, index_name)
+        self.extensions = tuple(extensions)
+        self.reader = reader
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        # Соединение на каждый вызов: Flask обслуживает запросы в разных потоках
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _ensure(self):
+        with self._init_lock:
+            if self._initialized:
+                return
+            os.makedirs(self.folder, exist_ok=True)
+            is_new = not os.path.exists(self.path)
+            with closing(self._connect()) as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.executescript(_SCHEMA)
+            self._initialized = True
+        # Первый запуск с уже накопленными сценами - строим индекс по файлам
+        if is_new:
+            self.reconcile()
+
+    def add(self, filename, scene, connection=None):
+        """Записывает в индекс сцену filename; scene - уже прочитанный JSON сцены."""
+        self._ensure()
+        stat = os.stat(os.path.join(self.folder, filename))
+        meta = scene_metadata(filename, scene)
+        row = (filename, meta["name"], meta["name"].lower(), stat.st_ctime, stat.st_mtime, stat.st_size,
+               meta["objects_count"], json.dumps(meta["scene_size"], ensure_ascii=False))
+        query = "INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        if connection is not None:
+            connection.execute(query, row)
+            return
+        with closing(self._connect()) as connection, connection:
+            connection.execute(query, row)
+
+    def remove(self, filename):
+        self._ensure()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM scenes WHERE filename = ?", (filename,))
+
+    def latest(self, name, extension):
+        """Имя файла последней сохранённой сцены с таким именем или None."""
+        self._ensure()
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT filename FROM scenes WHERE name = ? AND substr(filename, -?) = ? "
+                "ORDER BY created DESC, filename DESC LIMIT 1",
+                (name, len(extension), extension),
+            ).fetchone()
+        return row["filename"] if row else None
+
+    def list(self, offset=0, limit=None, sort="created", descending=True, name=None):
+        """Возвращает (страница сцен, сколько всего сцен подходит под фильтр)."""
+        self._ensure()
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Нельзя сортировать по {sort}")
+        where, params = "", []
+        if name:
+            # lower() в SQLite понимает только латиницу, поэтому сравниваем с name_lower
+            where = "WHERE instr(name_lower, ?) > 0"
+            params.append(name.lower())
+        order = "DESC" if descending else "ASC"
+        with closing(self._connect()) as connection:
+            total = connection.execute(f"SELECT COUNT(*) FROM scenes {where}", params).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT * FROM scenes {where} ORDER BY {SORT_COLUMNS[sort]} {order}, filename {order} "
+                f"LIMIT ? OFFSET ?",
+                params + [-1 if limit is None else limit, offset],
+            ).fetchall()
+        scenes = [{
+            "filename": row["filename"],
+            "name": row["name"],
+            "created": row["created"],
+            "modified": row["modified"],
+            "objects_count": row["objects_count"],
+            "scene_size": json.loads(row["scene_size"]),
+        } for row in rows]
+        return scenes, total
+
+    def reconcile(self):
+        """Сверяет индекс с папкой: добавляет новые и изменённые файлы, убирает удалённые."""
+        self._ensure()
+        files = {}
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.extensions) and entry.is_file():
+                stat = entry.stat()
+                if stat.st_size == 0:  # имя уже занято, но сцена ещё пишется
+                    continue
+                files[entry.name] = (stat.st_mtime, stat.st_size)
+
+        added, updated, removed, failed = 0, 0, 0, []
+        with closing(self._connect()) as connection, connection:
+            known = {row["filename"]: (row["modified"], row["file_size"])
+                     for row in connection.execute("SELECT filename, modified, file_size FROM scenes")}
+            for filename in known.keys() - files.keys():
+                connection.execute("DELETE FROM scenes WHERE filename = ?", (filename,))
+                removed += 1
+            for filename, signature in files.items():
+                if known.get(filename) == signature:
+                    continue
+                try:
+                    scene = self.reader(os.path.join(self.folder, filename))
+                    self.add(filename, scene, connection=connection)
+                except (OSError, ValueError, KeyError, AttributeError) as e:
+                    failed.append({"filename": filename, "error": str(e)})
+                    continue
+                if filename in known:
+                    updated += 1
+                else:
+                    added += 1
+        return {"added": added, "updated": updated, "removed": removed, "failed": failed}
+
+    def rebuild(self):
+        """Строит индекс с нуля по файлам в папке."""
+        self._ensure()
+        with closing(self._connect()) as connection, connection:
+            connection.execute("DELETE FROM scenes")
+        return self.reconcile()
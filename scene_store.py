@@ -0,0 +1,234 @@
+# Компактное хранение сцен (включается SCENE_STORAGE=compact).
+# Вместо JSON с отступами сцена хранится так:
+#   - объекты лежат в пачках (packs): числовые поля всех объектов пачки -
+#     position, rotation, scale, color, opacity - это столбцы-массивы, остальное
+#     (тип, имя, userData) - общий JSON; пачка - сжатый .npz, имя файла - хеш
+#     содержимого, поэтому одинаковые пачки хранятся один раз;
+#   - версия сцены (.scene) - небольшой .npz со служебными полями сцены и для
+#     каждого объекта: хеш объекта и где он лежит (номер пачки и строка в ней).
+# При повторном сохранении сцены с тем же именем объекты сравниваются по хешу с
+# прошлой версией: неизменённые берутся из старых пачек, а в новую пачку
+# попадают только новые и изменённые объекты. Когда сцена расползается по
+# слишком многим пачкам, все её объекты переписываются в одну.
+# Столбцы хранятся во float32, только если это не меняет ни одного значения
+# (у редактора координаты округлены до 3 знаков, так что обычно это так),
+# иначе - во float64; load возвращает тот же JSON, что был сохранён.
+
+import hashlib
+import io
+import json
+import math
+import os
+
+import numpy as np
+
+
+SCENE_EXTENSION = ".scene"
+PACKS_DIR = "objects"
+MAX_PACKS = 16  # больше пачек на сцену - переписываем её объекты в одну
+DIGEST_SIZE = 8  # байт хеша объекта; хеш сравнивается только с объектами прошлой версии
+
+VECTOR_FIELDS = ("position", "rotation", "scale")
+AXES = ("x", "y", "z")
+# бит в маске: поле объекта лежит в столбце, а не в JSON
+_BITS = {"position": 1, "rotation": 2, "scale": 4, "color": 8, "opacity": 16}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _is_vector(value):
+    return isinstance(value, dict) and set(value) == set(AXES) and all(_is_number(value[a]) for a in AXES)
+
+
+def object_digest(obj):
+    data = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=DIGEST_SIZE).digest()
+
+
+def _float_column(values):
+    array = np.array(values, dtype=np.float64)
+    compact = array.astype(np.float32)
+    # float32 при записи коротким десятичным представлением должен дать то же число
+    if np.array_equal(compact.astype(str).astype(np.float64), array):
+        return compact
+    return array
+
+
+def _float_values(column):
+    if column.dtype == np.float32:
+        column = column.astype(str).astype(np.float64)
+    return column.tolist()
+
+
+def _save_npz(path, arrays):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(tmp_path, path)
+
+
+def _json_array(value):
+    return np.frombuffer(json.dumps(value, ensure_ascii=False).encode("utf-8"), dtype=np.uint8)
+
+
+def _load_json_array(array):
+    return json.loads(array.tobytes().decode("utf-8"))
+
+
+def encode_pack(objects):
+    """Объекты -> словарь столбцов для np.savez."""
+    count = len(objects)
+    mask = np.zeros(count, dtype=np.uint8)
+    vectors = {name: np.zeros((count, 3)) for name in VECTOR_FIELDS}
+    color = np.zeros(count, dtype=np.uint32)
+    opacity = np.zeros(count)
+    rest = []
+    for i, obj in enumerate(objects):
+        obj = dict(obj)
+        for name in VECTOR_FIELDS:
+            if _is_vector(obj.get(name)):
+                value = obj.pop(name)
+                vectors[name][i] = [value[a] for a in AXES]
+                mask[i] |= _BITS[name]
+        value = obj.get("color")
+        if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < 2 ** 32:
+            color[i] = obj.pop("color")
+            mask[i] |= _BITS["color"]
+        if _is_number(obj.get("opacity")):
+            opacity[i] = obj.pop("opacity")
+            mask[i] |= _BITS["opacity"]
+        rest.append(obj)
+    arrays = {name: _float_column(vectors[name]) for name in VECTOR_FIELDS}
+    arrays.update(mask=mask, color=color, opacity=_float_column(opacity), rest=_json_array(rest))
+    return arrays
+
+
+def decode_pack(arrays):
+    """Столбцы пачки -> список объектов в исходном виде."""
+    mask = arrays["mask"]
+    vectors = {name: _float_values(arrays[name]) for name in VECTOR_FIELDS}
+    color = arrays["color"].tolist()
+    opacity = _float_values(arrays["opacity"])
+    objects = _load_json_array(arrays["rest"])
+    for i, obj in enumerate(objects):
+        bits = int(mask[i])
+        for name in VECTOR_FIELDS:
+            if bits & _BITS[name]:
+                obj[name] = dict(zip(AXES, vectors[name][i]))
+        if bits & _BITS["color"]:
+            obj["color"] = color[i]
+        if bits & _BITS["opacity"]:
+            obj["opacity"] = opacity[i]
+    return objects
+
+
+class SceneStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.packs_folder = os.path.join(folder, PACKS_DIR)
+
+    def _pack_path(self, pack_id):
+        return os.path.join(self.packs_folder, pack_id[:2], pack_id + ".npz")
+
+    def _write_pack(self, objects):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **encode_pack(objects))
+        data = buffer.getvalue()
+        pack_id = hashlib.sha256(data).hexdigest()
+        path = self._pack_path(pack_id)
+        if not os.path.exists(path):  # такая пачка уже есть - не пишем второй раз
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return pack_id
+
+    def _read_pack(self, pack_id):
+        with np.load(self._pack_path(pack_id), allow_pickle=False) as arrays:
+            return decode_pack(arrays)
+
+    def _read_manifest(self, filename):
+        with np.load(os.path.join(self.folder, filename), allow_pickle=False) as arrays:
+            return {
+                "header": _load_json_array(arrays["header"]),
+                "pack": arrays["pack"],
+                "row": arrays["row"],
+                "digest": arrays["digest"],
+            }
+
+    def save(self, filename, scene, base=None):
+        """Сохраняет сцену в filename (.scene). base - прошлая версия этой сцены.
+
+        Возвращает, сколько объектов записано заново (остальные взяты из base).
+        """
+        objects = scene.get("objects", [])
+        header = {key: value for key, value in scene.items() if key != "objects"}
+        digests = [object_digest(obj) for obj in objects]
+
+        known = {}
+        packs = []
+        if base is not None:
+            try:
+                previous = self._read_manifest(base)
+            except (OSError, ValueError, KeyError):
+                previous = None
+            if previous is not None:
+                packs = previous["header"]["packs"]
+                for digest, pack, row in zip(previous["digest"], previous["pack"].tolist(), previous["row"].tolist()):
+                    known[digest.tobytes()] = (pack, row)
+
+        used_packs = {known[d][0] for d in digests if d in known}
+        if len(used_packs) >= MAX_PACKS:
+            # Сцена разошлась по слишком многим пачкам - собираем её в одну
+            known, packs = {}, []
+        # Новые объекты; одинаковые (например, копии) пишутся один раз
+        changed = {}
+        for i, digest in enumerate(digests):
+            if digest not in known and digest not in changed:
+                changed[digest] = i
+
+        # Пачки, на которые ссылается новая версия, нумеруются заново
+        pack_numbers = {}
+        new_packs = []
+
+        def number(pack_id):
+            if pack_id not in pack_numbers:
+                pack_numbers[pack_id] = len(new_packs)
+                new_packs.append(pack_id)
+            return pack_numbers[pack_id]
+
+        location = {}
+        if changed:
+            pack_id = self._write_pack([objects[i] for i in changed.values()])
+            for row, digest in enumerate(changed):
+                location[digest] = (number(pack_id), row)
+        pack_column = np.zeros(len(objects), dtype=np.uint32)
+        row_column = np.zeros(len(objects), dtype=np.uint32)
+        for i, digest in enumerate(digests):
+            if digest in location:
+                pack_column[i], row_column[i] = location[digest]
+            else:
+                pack, row = known[digest]
+                pack_column[i], row_column[i] = number(packs[pack]), row
+
+        header = {"scene": header, "packs": new_packs, "base": base}
+        _save_npz(os.path.join(self.folder, filename), {
+            "header": _json_array(header),
+            "pack": pack_column,
+            "row": row_column,
+            "digest": np.frombuffer(b"".join(digests), dtype=np.uint8).reshape(-1, DIGEST_SIZE),
+        })
+        return len(changed)
+
+    def load(self, filename):
+        """Возвращает сцену в том же виде, в каком её передали в save."""
+        manifest = self._read_manifest(filename)
+        packs = [self._read_pack(pack_id) for pack_id in manifest["header"]["packs"]]
+        scene = dict(manifest["header"]["scene"])
+        scene["objects"] = [packs[pack][row] for pack, row in zip(manifest["pack"].tolist(), manifest["row"].tolist())]
+        return scene
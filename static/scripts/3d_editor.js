@@ -1008,6 +1008,9 @@ async function loadScene() {
         result.scenes.forEach((scene, index) => {
             sceneList += `${index + 1}. ${scene.name} (${scene.objects_count} объектов, создана: ${scene.created})\n`;
         });
+        if (result.total > result.scenes.length) {
+            sceneList += `\n...показаны последние ${result.scenes.length} из ${result.total}\n`;
+        }
         
         const choice = prompt(`${sceneList}\n\nВведите номер сцены (1-${result.scenes.length}):`);
         if (choice === null) return; // Пользователь нажал отмена
@@ -1173,9 +1176,10 @@ function loadSceneData(sceneData) {
                             );
                             break;
                         case 'plane':
+                            // Как в addPlane: при originalScale 1 плоскость 5x5
                             geometry = new THREE.PlaneGeometry(
-                                originalScale.x,
-                                originalScale.z
+                                originalScale.x * 5,
+                                originalScale.z * 5
                             );
                             break;
                         default:
@@ -1265,17 +1269,15 @@ function loadSceneData(sceneData) {
 
 // Экспорт сцены
 async function exportScene() {
-    alert('Данная функция в разработке!');
-    return;
     if (!objects || objects.length === 0) {
         alert('Нет объектов для экспорта');
         return;
     }
     
-    const format = prompt('Выберите формат экспорта (obj/stl/ply):', 'obj')?.toLowerCase()?.trim();
+    const format = prompt('Выберите формат экспорта (glb/obj/stl/ply):', 'glb')?.toLowerCase()?.trim();
     
-    if (!format || !['obj', 'stl', 'ply'].includes(format)) {
-        alert('Неверный формат. Доступные форматы: obj, stl, ply');
+    if (!format || !['glb', 'obj', 'stl', 'ply'].includes(format)) {
+        alert('Неверный формат. Доступные форматы: glb, obj, stl, ply');
         return;
     }
     
@@ -1300,7 +1302,11 @@ async function exportScene() {
                 z: obj.scale.z 
             },
             color: obj.material.color.getHex(),
-            opacity: obj.material.opacity
+            opacity: obj.material.opacity,
+            // Размеры геометрии: scale выше задан относительно них
+            userData: {
+                originalScale: obj.userData?.originalScale || { x: 1, y: 1, z: 1 }
+            }
         }))
     };
     
@@ -0,0 +1,41 @@
+// Правки без перезагрузки страницы: форма правки уходит в JSON-версию маршрута
+// (/api/edit/<имя>), в ответ приходят адрес нового превью и размер - меняется
+// только картинка. Если картинки на странице ещё нет или запрос не удался,
+// форма отправляется обычным способом.
+const EDIT_ACTIONS = new Set([
+    '/load', '/checkpoint', '/undo', '/redo', '/brightcontr', '/gamma', '/mirror', '/rotate',
+    '/color_balance', '/add_noise', '/blur', '/resize', '/crop'
+]);
+
+document.addEventListener('submit', async function(event) {
+    const form = event.target;
+    const action = new URL(form.action, window.location.href).pathname;
+    const image = document.getElementById('workImage');
+    if (form.method.toLowerCase() !== 'post' || !EDIT_ACTIONS.has(action) || !image) {
+        return;
+    }
+    event.preventDefault();
+
+    let data;
+    try {
+        const response = await fetch('/api/edit' + action, {
+            method: 'POST',
+            body: new FormData(form),
+            headers: {'Accept': 'application/json'}
+        });
+        data = await response.json();
+    } catch (e) {
+        form.submit();
+        return;
+    }
+
+    if (!data.success) {
+        showError(data.error);
+        return;
+    }
+    image.src = data.image_url;
+    const size = document.getElementById('imageSize');
+    if (size) {
+        size.textContent = `${data.width} × ${data.height}`;
+    }
+});
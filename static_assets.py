@@ -0,0 +1,137 @@
+# Статические файлы (стили, скрипты) с отпечатком в имени и заранее сжатые.
+# При запуске каждый файл читается один раз: по содержимому считается отпечаток
+# (styles.css -> styles.1a2b3c4d5e.css), текстовые файлы сжимаются gzip и, если
+# установлен пакет brotli, brotli. Ссылки строит url_for('static', ...), и они
+# сразу указывают на имя с отпечатком. Файл под таким именем никогда не меняется,
+# поэтому браузер может хранить его вечно (Cache-Control: immutable). Запрос по
+# имени без отпечатка тоже работает, но ответ кешируется только до проверки ETag.
+# Отдаются только файлы из списка, собранного при запуске; auto_reload (режим
+# отладки) подхватывает изменённые и новые файлы без перезапуска. Его можно
+# передать функцией - тогда он проверяется при каждом обращении.
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:  # без пакета brotli отдаём только gzip
+    brotli = None
+
+
+COMPRESSIBLE = {".css", ".js", ".html", ".svg", ".json", ".txt", ".map"}
+MIN_COMPRESS_BYTES = 256  # меньшие файлы сжатие почти не уменьшает
+FINGERPRINT_LENGTH = 10
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Asset:
+    __slots__ = ("path", "fingerprinted", "mimetype", "etag", "mtime", "variants")
+
+    def __init__(self, path, fingerprinted, mimetype, etag, mtime, variants):
+        self.path = path  # путь относительно папки, через "/"
+        self.fingerprinted = fingerprinted
+        self.mimetype = mimetype
+        self.etag = etag
+        self.mtime = mtime
+        self.variants = variants  # кодирование ("br", "gzip", "identity") -> bytes
+
+    def select(self, accepted):
+        """Лучший вариант для Accept-Encoding: (кодирование, содержимое); accepted(имя) -> вес."""
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted(encoding):
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+
+def fingerprint_path(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+
+def _compress(data, ext):
+    variants = {"identity": data}
+    if ext not in COMPRESSIBLE or len(data) < MIN_COMPRESS_BYTES:
+        return variants
+    # mtime=0 - одинаковый файл всегда сжимается в одинаковые байты
+    compressed = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed["br"] = brotli.compress(data, quality=11)
+    for encoding, body in compressed.items():
+        if len(body) < len(data):
+            variants[encoding] = body
+    return variants
+
+
+class AssetManifest:
+    def __init__(self, directory, exclude=(), auto_reload=False):
+        self.directory = directory
+        self.exclude = set(exclude)  # папки верхнего уровня, которые не отдаём (загрузки)
+        self.auto_reload = auto_reload  # bool или функция без аргументов
+        self._assets = {}  # путь -> Asset
+        self._fingerprinted = {}  # путь с отпечатком -> Asset
+        self._lock = threading.Lock()
+        self.build()
+
+    def build(self):
+        assets = {}
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [name for name in dirs if name not in self.exclude]
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), self.directory).replace(os.sep, "/")
+                assets[path] = self._load(path)
+        with self._lock:
+            self._assets = assets
+            self._fingerprinted = {asset.fingerprinted: asset for asset in assets.values()}
+
+    def _load(self, path):
+        full_path = os.path.join(self.directory, *path.split("/"))
+        mtime = os.path.getmtime(full_path)
+        with open(full_path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        ext = os.path.splitext(path)[1].lower()
+        return Asset(path, fingerprint_path(path, digest), mimetype, digest[:2 * FINGERPRINT_LENGTH], mtime,
+                     _compress(data, ext))
+
+    def _allowed(self, path):
+        parts = path.split("/")
+        return all(part not in ("", ".", "..") for part in parts) and parts[0] not in self.exclude
+
+    def _reloading(self):
+        return self.auto_reload() if callable(self.auto_reload) else self.auto_reload
+
+    def _fresh(self, path):
+        """Asset для пути без отпечатка; в auto_reload перечитывает изменившийся файл."""
+        with self._lock:
+            asset = self._assets.get(path)
+        if not self._reloading() or not self._allowed(path):
+            return asset
+        full_path = os.path.join(self.directory, *path.split("/"))
+        if not os.path.isfile(full_path):
+            return None
+        mtime = os.path.getmtime(full_path)
+        if asset is None or asset.mtime != mtime:
+            asset = self._load(path)
+            with self._lock:
+                self._assets[path] = asset
+                self._fingerprinted[asset.fingerprinted] = asset
+        return asset
+
+    def url_path(self, path):
+        """Путь с отпечатком для ссылки; неизвестный файл остаётся как есть."""
+        asset = self._fresh(path)
+        return asset.fingerprinted if asset is not None else path
+
+    def find(self, path):
+        """(Asset, с отпечатком ли запрошен) или (None, False)."""
+        with self._lock:
+            asset = self._fingerprinted.get(path)
+        if asset is not None:
+            return asset, True
+        asset = self._fresh(path)
+        return asset, False
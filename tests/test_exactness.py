@@ -0,0 +1,115 @@
+# Точность ускорений конвейера: плиточная обработка, склеенная таблица тонов
+# и перестановки пикселей вместо warpAffine дают те же пиксели, что и прямой
+# расчёт.
+
+import itertools
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blur
+import edit_pipeline
+import noise
+import tiles
+
+
+@pytest.fixture
+def image():
+    # Не кратно размеру плиток, чтобы крайние плитки были неполными
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (301, 419, 3), dtype=np.uint8)
+
+
+@pytest.fixture(params=[(64, 1), (64, 3), (100, 2)], ids=lambda p: f"tile{p[0]}-workers{p[1]}")
+def tiling(request):
+    tile_size, workers = tiles.TILE_SIZE, tiles.WORKERS
+    tiles.configure(tile_size=request.param[0], workers=request.param[1])
+    yield request.param
+    tiles.configure(tile_size=tile_size, workers=workers)
+
+
+def _whole(image, blur_type, kernel_size):
+    if blur_type == "average":
+        return cv2.blur(image, (kernel_size, kernel_size))
+    if blur_type == "gaussian":
+        return cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
+    return cv2.medianBlur(image, kernel_size)
+
+
+@pytest.mark.parametrize("blur_type, kernel_size", [
+    ("average", 1), ("average", 4), ("average", 31), ("average", 101),
+    ("gaussian", 3), ("gaussian", 5), ("gaussian", 7), ("gaussian", 15), ("gaussian", 31),
+    ("median", 3), ("median", 5), ("median", 31), ("median", 101),
+])
+def test_tiled_blur_matches_single_call(image, tiling, blur_type, kernel_size):
+    result = edit_pipeline.render(image, [edit_pipeline.blur_op(blur_type, kernel_size)])
+    np.testing.assert_array_equal(result, _whole(image, blur_type, kernel_size))
+
+
+def test_tiled_noise_does_not_depend_on_tiling(image, tiling):
+    reference = noise.add_noise(image, "gaussian", 0.2, seed=7)
+    tiles.configure(tile_size=4096, workers=1)
+    try:
+        whole = noise.add_noise(image, "gaussian", 0.2, seed=7)
+    finally:
+        tiles.configure(tile_size=tiling[0], workers=tiling[1])
+    np.testing.assert_array_equal(reference, whole)
+
+
+TONE_CHAINS = [
+    [{"op": "brightcontr", "contrast": 1.3, "brightness": 20},
+     {"op": "color_balance", "red": 0.1, "green": 0.0, "blue": -0.1}],
+    [edit_pipeline.gamma_op(2.2), edit_pipeline.levels_op(16, 235, 0.8, 10, 245, "red"),
+     edit_pipeline.curves_op([[0, 0], [128, 160], [255, 255]], "green")],
+    [{"op": "brightcontr", "contrast": 0.7, "brightness": -40}, edit_pipeline.gamma_op(0.5, "blue"),
+     {"op": "color_balance", "red": -0.2, "green": 0.3, "blue": 0.0}, edit_pipeline.curves_op([[0, 30], [255, 200]]),
+     edit_pipeline.levels_op(0, 200)],
+]
+
+
+@pytest.mark.parametrize("ops", TONE_CHAINS, ids=range(len(TONE_CHAINS)))
+def test_fused_tone_lut_matches_sequential(image, ops):
+    assert edit_pipeline.segments(ops) == [("tone", 0, len(ops))]
+    sequential = image
+    for op in ops:
+        sequential = edit_pipeline.render(sequential, [op])
+    np.testing.assert_array_equal(edit_pipeline.render(image, ops), sequential)
+
+
+PERMUTATION_STEPS = [
+    {"op": "rotate", "angle": 90, "center": None, "keep_size": False},
+    {"op": "rotate", "angle": 180, "center": None, "keep_size": False},
+    {"op": "rotate", "angle": 270, "center": None, "keep_size": False},
+    {"op": "mirror", "axis": "x"},
+    {"op": "mirror", "axis": "y"},
+    "crop",
+]
+
+
+def _chain(steps, width, height):
+    ops = []
+    for step in steps:
+        if step == "crop":
+            step = {"op": "crop", "x": 3, "y": 5, "width": width - 10, "height": height - 7}
+        width, height = edit_pipeline.op_output_size(step, width, height)
+        ops.append(step)
+    return ops, width, height
+
+
+@pytest.mark.parametrize("steps", list(itertools.product(PERMUTATION_STEPS, repeat=3)),
+                         ids=lambda steps: "+".join(s if isinstance(s, str) else f"{s['op']}{s.get('angle', s.get('axis'))}"
+                                                    for s in steps))
+def test_permutation_chains_match_nearest_warp(image, steps):
+    height, width = image.shape[:2]
+    ops, out_width, out_height = _chain(steps, width, height)
+    total = np.eye(3)
+    for op in ops:
+        matrix, width, height, _ = edit_pipeline.op_matrix(op, width, height)
+        total = matrix @ total
+    expected = cv2.warpAffine(image, total[:2], (out_width, out_height), flags=cv2.INTER_NEAREST)
+    np.testing.assert_array_equal(edit_pipeline.render(image, ops), expected)
@@ -0,0 +1,46 @@
+# Загрузка изображения больше порога отображения (MAPPED_IMAGE_BYTES) через /load:
+# оно должно приниматься и дальше жить в файле, отображённом в память.
+
+import io
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # Пространства и кеши пишутся по относительным путям - уводим их во временную папку
+    monkeypatch.chdir(tmp_path)
+    import app
+    app.image_store.discard_if(lambda key: True)
+    return app, app.app.test_client()
+
+
+def test_load_image_over_mapped_threshold(client):
+    app, test_client = client
+    # 110 Мп - больше прежнего предела в 100 Мп и больше порога отображения
+    width, height = 12000, 9200
+    assert width * height * 3 >= app.MAPPED_IMAGE_BYTES
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, ::97] = (40, 120, 200)
+    ok, png = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    assert ok
+    del image
+
+    response = test_client.post("/load", data={"file": (io.BytesIO(png.tobytes()), "panorama.png")},
+                                content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert "слишком большое" not in response.get_data(as_text=True)
+
+    stats = app.image_store.stats()
+    assert stats["mapped_bytes"] >= width * height * 3
+    assert stats["used_bytes"] < app.MAPPED_IMAGE_BYTES
+
+    preview = test_client.get("/preview")
+    assert preview.status_code == 200
+    assert preview.mimetype.startswith("image/")
@@ -0,0 +1,46 @@
+# Экспорт сцены: размеры примитивов совпадают с тем, что строит 3d_editor.js.
+
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+import trimesh
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scene_export
+
+
+def _plane(**fields):
+    # Как saveScene в редакторе для плоскости из addPlane
+    obj = {
+        "type": "plane",
+        "position": {"x": 0, "y": 0, "z": 0},
+        "rotation": {"x": -90, "y": 0, "z": 0},
+        "scale": {"x": 1, "y": 1, "z": 1},
+        "color": 0x607d8b,
+        "opacity": 1,
+        "userData": {"type": "plane", "originalScale": {"x": 1, "y": 1, "z": 1}},
+    }
+    obj.update(fields)
+    return obj
+
+
+def test_plane_matches_editor_size():
+    mesh = scene_export.build_mesh([_plane()])
+    # PlaneGeometry(5, 5), повёрнутая на -90 градусов по X, лежит в плоскости XZ
+    np.testing.assert_allclose(mesh.extents, [5, 0, 5], atol=1e-9)
+
+
+def test_plane_scale_is_relative_to_editor_size():
+    mesh = scene_export.build_mesh([_plane(scale={"x": 2, "y": 1, "z": 0.5})])
+    np.testing.assert_allclose(mesh.extents, [10, 0, 5], atol=1e-9)
+
+
+@pytest.mark.parametrize("format", sorted(scene_export.EXPORT_FORMATS))
+def test_exported_plane_extent(format):
+    data, _ = scene_export.export_scene({"objects": [_plane()]}, format)
+    exported = trimesh.load(io.BytesIO(data), file_type=format, force="mesh")
+    np.testing.assert_allclose(exported.extents, [5, 0, 5], atol=1e-6)
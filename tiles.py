@@ -0,0 +1,140 @@
+# Плиточное выполнение фильтров на нескольких ядрах.
+# Изображение режется на плитки с перекрытием (halo) - полями шириной в радиус
+# ядра фильтра. Каждая плитка обрабатывается в пуле потоков (cv2 и NumPy
+# отпускают GIL), из результата вырезается середина без полей и кладётся в
+# общий выходной массив. На границах изображения поля нет, там фильтр
+# применяет свою обычную обработку края, поэтому результат совпадает с
+# обработкой целого изображения пиксель в пиксель.
+# Выходные массивы создаются через allocate(): внутри use_allocator() их может
+# выделять вызывающий код, например в отображённом в память файле
+# (image_store.mapped_allocator) - тогда плитки пишутся прямо в файл.
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import os
+import threading
+
+import numpy as np
+
+
+TILE_SIZE = 1024  # сторона плитки в пикселях, без учёта полей
+WORKERS = os.cpu_count() or 1  # сколько плиток обрабатывается одновременно
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Проверка отмены для фоновых задач (jobs.py): вызывается перед каждой плиткой
+_cancel_check = contextvars.ContextVar("tiles_cancel_check", default=None)
+# Чем выделять выходные массивы: allocator(shape, dtype); None - обычный np.empty
+_allocator = contextvars.ContextVar("tiles_allocator", default=None)
+
+
+def configure(tile_size=None, workers=None):
+    global TILE_SIZE, WORKERS, _executor
+    with _executor_lock:
+        if tile_size is not None:
+            TILE_SIZE = tile_size
+        if workers is not None and workers != WORKERS:
+            WORKERS = workers
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+                _executor = None
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="tile")
+        return _executor
+
+
+@contextmanager
+def cancel_check(check):
+    """Внутри блока with плиточные функции вызывают check() и прерываются его исключением."""
+    token = _cancel_check.set(check)
+    try:
+        yield
+    finally:
+        _cancel_check.reset(token)
+
+
+def check_cancelled():
+    check = _cancel_check.get()
+    if check is not None:
+        check()
+
+
+@contextmanager
+def use_allocator(allocator):
+    """Внутри блока with выходные массивы выделяет allocator(shape, dtype)."""
+    token = _allocator.set(allocator)
+    try:
+        yield
+    finally:
+        _allocator.reset(token)
+
+
+def allocate(shape, dtype):
+    allocator = _allocator.get()
+    if allocator is None:
+        return np.empty(shape, dtype)
+    return allocator(shape, dtype)
+
+
+def tile_grid(height, width, tile_height, tile_width):
+    """Прямоугольники плиток без полей: [(y0, y1, x0, x1)]."""
+    return [
+        (y, min(y + tile_height, height), x, min(x + tile_width, width))
+        for y in range(0, height, tile_height)
+        for x in range(0, width, tile_width)
+    ]
+
+
+def run_tiled(image, func, halo=0, tile_size=None, tile_shape=None, workers=None, out=None):
+    """Применяет func(tile, y, x) по плиткам и склеивает результат.
+
+    func получает плитку вместе с полями и координаты её левого верхнего угла
+    в изображении и должна вернуть массив того же размера. halo - ширина полей,
+    для фильтра с ядром k это k // 2. tile_shape=(высота, ширина) задаёт форму
+    плитки явно, иначе плитка квадратная со стороной tile_size.
+    workers=1 обрабатывает плитки по очереди в текущем потоке.
+    out - куда писать результат; может совпадать с image, если func не читает
+    соседние пиксели (halo=0).
+    """
+    height, width = image.shape[:2]
+    tile_height, tile_width = tile_shape or (tile_size or TILE_SIZE,) * 2
+    workers = workers or WORKERS
+    # Плитки выполняются в других потоках, поэтому проверку берём в вызывающем
+    check = _cancel_check.get()
+
+    if height <= tile_height and width <= tile_width:
+        result = func(image, 0, 0)
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    if out is None:
+        out = allocate(image.shape, image.dtype)
+    if out is image and halo > 0:
+        raise ValueError("Обработка на месте невозможна, если плитки перекрываются")
+
+    def process(rect):
+        if check is not None:
+            check()
+        y0, y1, x0, x1 = rect
+        hy0, hy1 = max(y0 - halo, 0), min(y1 + halo, height)
+        hx0, hx1 = max(x0 - halo, 0), min(x1 + halo, width)
+        result = func(image[hy0:hy1, hx0:hx1], hy0, hx0)
+        out[y0:y1, x0:x1] = result[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+    rects = tile_grid(height, width, tile_height, tile_width)
+    if workers <= 1:
+        for rect in rects:
+            process(rect)
+    else:
+        # list() дожидается всех плиток и пробрасывает исключение, если оно было
+        list(_get_executor().map(process, rects))
+    return out
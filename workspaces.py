@@ -0,0 +1,151 @@
+# Рабочие пространства пользователей.
+# Каждой сессии Flask выдаётся свой id и своя папка в UPLOAD_PATH, где лежат
+# загруженное изображение и state.json с состоянием редактора. Состояние
+# хранится на диске, поэтому его видят все потоки и все процессы gunicorn.
+# Доступ к пространству сериализуется блокировкой: threading.Lock внутри
+# процесса и flock на файл .lock между процессами.
+# Пространства, к которым долго не обращались, удаляются сборщиком по TTL.
+
+from contextlib import contextmanager
+import json
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows - межпроцессной блокировки нет, только потоки
+    fcntl = None
+
+
+SESSION_KEY = "workspace_id"
+STATE_FILE = "state.json"
+LOCK_FILE = ".lock"
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class Workspace:
+    def __init__(self, manager, workspace_id):
+        self.manager = manager
+        self.id = workspace_id
+        self.path = os.path.join(manager.root, workspace_id)
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load_state(self):
+        try:
+            with open(self.file(STATE_FILE), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        # Пишем во временный файл и атомарно подменяем, чтобы другой процесс
+        # никогда не прочитал наполовину записанный state.json
+        tmp_path = self.file(f"{STATE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.file(STATE_FILE))
+
+    def touch(self):
+        try:
+            os.utime(self.file(STATE_FILE))
+        except FileNotFoundError:
+            self.save_state({})
+
+    def last_access(self):
+        try:
+            return os.path.getmtime(self.file(STATE_FILE))
+        except FileNotFoundError:
+            return os.path.getmtime(self.path)
+
+    @contextmanager
+    def lock(self):
+        with self.manager.thread_lock(self.id):
+            if fcntl is None:
+                yield
+                return
+            with open(self.file(LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class WorkspaceManager:
+    def __init__(self, root, ttl_seconds, gc_interval_seconds=60, on_remove=None):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+        self.on_remove = on_remove  # вызывается с id удалённого пространства
+        self._thread_locks = {}
+        self._thread_locks_guard = threading.Lock()
+        self._last_gc = 0.0
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, workspace_id):
+        if not workspace_id or not _ID_RE.match(workspace_id):
+            return None
+        workspace = Workspace(self, workspace_id)
+        if not os.path.isdir(workspace.path):
+            return None
+        return workspace
+
+    def for_session(self, session):
+        """Возвращает пространство текущей сессии, при необходимости создаёт новое."""
+        workspace = self.get(session.get(SESSION_KEY))
+        if workspace is None:
+            workspace = self.create()
+            session[SESSION_KEY] = workspace.id
+        workspace.touch()
+        return workspace
+
+    def create(self):
+        while True:
+            workspace = Workspace(self, secrets.token_hex(16))
+            try:
+                os.makedirs(workspace.path)
+            except FileExistsError:
+                continue
+            workspace.save_state({})
+            return workspace
+
+    def thread_lock(self, workspace_id):
+        with self._thread_locks_guard:
+            lock = self._thread_locks.get(workspace_id)
+            if lock is None:
+                lock = self._thread_locks[workspace_id] = threading.Lock()
+            return lock
+
+    def collect_garbage(self, force=False):
+        """Удаляет пространства, простаивающие дольше TTL. Возвращает их число."""
+        now = time.time()
+        if not force and now - self._last_gc < self.gc_interval_seconds:
+            return 0
+        self._last_gc = now
+        removed = 0
+        for name in os.listdir(self.root):
+            workspace = self.get(name)
+            if workspace is None:
+                continue
+            try:
+                if now - workspace.last_access() < self.ttl_seconds:
+                    continue
+                with workspace.lock():
+                    # Пока ждали блокировку, пространством могли воспользоваться
+                    if now - workspace.last_access() < self.ttl_seconds:
+                        continue
+                    shutil.rmtree(workspace.path, ignore_errors=True)
+            except FileNotFoundError:
+                continue  # уже удалено другим процессом
+            with self._thread_locks_guard:
+                self._thread_locks.pop(workspace.id, None)
+            if self.on_remove is not None:
+                self.on_remove(workspace.id)
+            removed += 1
+        return removed